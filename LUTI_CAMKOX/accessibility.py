@@ -0,0 +1,264 @@
+"""
+accessibility.py
+
+Accessibility of every zone to opportunities (e.g. residential or employment
+totals) with a cost impedance function f:
+Ai[i] = sum over j of Dj[j] * f(cij[i,j])
+The impedance functions (see impedances) are
+- power: f(c) = c^-param, param = 2 is the inverse square impedance of the
+  jobs and housing accessibility in main.py
+- exponential: f(c) = exp(-param * c)
+- gaussian: f(c) = exp(-c^2 / (2 * param^2))
+- cumulative: f(c) = 1 if c <= param else 0, the opportunities within param
+  (see also SortedCostIndex for many thresholds)
+The impedance matrix f(cij) is the same for every run on the same costs, so
+it is computed once and kept in the kernel cache (see kernelcache.py). The
+accessibility of one opportunity vector is then a matrix vector product, and
+that of all the modes, scenarios and measures of a run a single batched
+matrix product.
+"""
+import numpy as np
+
+from LUTI_CAMKOX import kernels
+from LUTI_CAMKOX.kernelcache import kernelCache
+
+impedances = {
+    'power': lambda cij, param: np.asarray(cij, dtype=float) ** -param,
+    'exponential': lambda cij, param: np.exp(np.asarray(cij, dtype=float) * -param),
+    'gaussian': lambda cij, param: np.exp(np.asarray(cij, dtype=float) ** 2 * (-0.5 / (param * param))),
+    'cumulative': lambda cij, param: (np.asarray(cij) <= param).astype(float),
+}
+
+###############################################################################
+
+"""
+impedanceMatrix
+The impedance f(cij) of a cost matrix, or of a (n_modes, m, n) cost tensor,
+from the kernel cache
+@param impedance name of the impedance function (see impedances)
+@param param its parameter
+@returns the impedance, or None if it is too large for the kernel cache
+"""
+def impedanceMatrix(cij, impedance='power', param=2.0):
+    assert impedance in impedances, "FATAL: unknown impedance function " + str(impedance) + ", use one of " + str(list(impedances))
+    if not kernelCache.fits(int(np.prod(np.shape(cij))) * 8):
+        return None
+    return kernelCache.fetch(cij, impedance, param, lambda: impedances[impedance](cij, param))
+
+###############################################################################
+
+"""
+accessibility
+Accessibility of every zone i to the opportunities Dj over the costs cij
+@param Dj opportunities at each zone j, or a (..., n) batch of them
+@param cij (m, n) cost matrix
+@param impedance, param impedance function and its parameter (see impedances)
+@param backend see kernels.useNumba (the Numba kernel is used for a single
+    vector with the inverse square impedance)
+@returns Ai (m,), or (..., m) for a batch
+"""
+def accessibility(Dj, cij, impedance='power', param=2.0, backend=None):
+    Dj = np.asarray(Dj, dtype=float)
+    if Dj.ndim == 1 and impedance == 'power' and param == 2.0 and kernels.useNumba(backend):
+        return kernels.accessibilityNumba(Dj, np.asarray(cij))
+    kernel = impedanceMatrix(cij, impedance, param)
+    if kernel is None:
+        kernel = impedances[impedance](cij, param)  # too large to keep, computed for this call only
+    return Dj @ kernel.T
+
+###############################################################################
+
+"""
+modeAccessibility
+Accessibility for every mode, each over its own costs, in one batched matrix
+product: Ai[..., k, i] = sum over j of Dj[..., k, j] * f(cij[k,i,j])
+@param Dj (n_modes, n) opportunities per mode, or (n_scenarios, n_modes, n)
+@param cij (n_modes, m, n) cost tensor (e.g. QUANTLHModel.cij)
+@param impedance, param impedance function and its parameter (see impedances)
+@returns Ai with the shape of Dj, n replaced by m
+"""
+def modeAccessibility(Dj, cij, impedance='power', param=2.0):
+    Dj = np.asarray(Dj, dtype=float)
+    kernel = impedanceMatrix(cij, impedance, param)
+    if kernel is None:
+        return np.stack([accessibility(Dj[..., k, :], cij[k], impedance, param) for k in range(len(cij))], axis=-2)
+    batch = Dj.reshape(-1, len(cij), Dj.shape[-1]).transpose(1, 2, 0)  # (n_modes, n, batch)
+    Ai = np.matmul(kernel, batch)  # (n_modes, m, batch)
+    return Ai.transpose(2, 0, 1).reshape(Dj.shape[:-1] + (cij.shape[1],))
+
+###############################################################################
+
+"""
+accessibilityGrid
+Accessibility for every combination of measure, opportunities, scenario and
+mode in one call: each measure is one batched matrix product over the cached
+impedance kernels of all the modes (see modeAccessibility), applied to all the
+opportunity vectors at once.
+@param Dj (..., n_modes, n) opportunities, e.g. (n_opportunities, n_scenarios,
+    n_modes, n) for the population and jobs of every scenario
+@param cij (n_modes, m, n) cost tensor
+@param measures list of (impedance, param), e.g. [('power', 2.0), ('cumulative', 30.0)]
+@returns (n_measures, ..., n_modes, m) array
+"""
+def accessibilityGrid(Dj, cij, measures):
+    Dj = np.asarray(Dj, dtype=float)
+    return np.stack([modeAccessibility(Dj, cij, impedance, param) for impedance, param in measures])
+
+###############################################################################
+
+"""
+scaleTo100
+Scale accessibilities so that each one (the last axis) sums to 100
+"""
+def scaleTo100(Ai):
+    return 100.0 * Ai / Ai.sum(axis=-1, keepdims=True)
+
+###############################################################################
+
+"""
+costChanges
+The OD pairs whose cost differs between two cost matrices, e.g. the rail pairs
+affected by EWR between the 2021 (Cij_gbrail_min_CAMKOX.bin) and 2050
+(Cij_rail_min_CAMKOX.bin) costs
+@returns (rows, cols, costs) of the changed pairs, costs from cijNew
+"""
+def costChanges(cij, cijNew):
+    rows, cols = np.nonzero(np.asarray(cij) != np.asarray(cijNew))
+    return rows, cols, np.asarray(cijNew)[rows, cols]
+
+###############################################################################
+
+"""
+updateAccessibility
+Update a base accessibility for sparse changes of the costs and of the
+opportunities without recomputing it: with the changed opportunities J, the
+changed OD pairs P, K = f(cij) and K' the impedance of the new costs,
+Ai' = Ai + sum over j in J of K[i,j] * dDj[j] + sum over (i,j) in P of (K'[i,j] - K[i,j]) * Dj'[j]
+so only the columns J of the base costs and the changed pairs are evaluated.
+@param Ai base accessibility (not scaled to 100), (m,) or a (..., m) batch
+@param Dj base opportunities, (n,) or a (..., n) batch matching Ai
+@param cij base cost matrix
+@param costs optional (rows, cols, costs) of the changed OD pairs (see costChanges),
+    the last cost of a pair listed more than once is used
+@param opportunities optional (zones, deltas) of the changed opportunities,
+    deltas (len(zones),) or (..., len(zones)) for a batch, the deltas of a
+    zone listed more than once are added up
+@param impedance, param impedance function and its parameter (see impedances)
+@returns Ai', Dj' the updated accessibility and opportunities, and the percentage
+    change of the accessibility scaled to 100 (as in maps.py), 100 * (Ai' - Ai) / Ai
+"""
+def updateAccessibility(Ai, Dj, cij, costs=None, opportunities=None, impedance='power', param=2.0):
+    assert impedance in impedances, "FATAL: unknown impedance function " + str(impedance) + ", use one of " + str(list(impedances))
+    f = impedances[impedance]
+    AiNew = np.array(Ai, dtype=float)
+    DjNew = np.array(Dj, dtype=float)
+    if opportunities is not None:
+        zones, deltas = opportunities
+        zones = np.asarray(zones, dtype=np.intp)
+        deltas = np.asarray(deltas, dtype=float)
+        AiNew += deltas @ f(np.asarray(cij)[:, zones], param).T
+        np.add.at(DjNew, (Ellipsis, zones), deltas)  # unbuffered, so a zone listed twice gets both deltas, as in AiNew
+    if costs is not None:
+        rows, cols, newCosts = costs
+        rows = np.asarray(rows, dtype=np.intp)
+        cols = np.asarray(cols, dtype=np.intp)
+        newCosts = np.asarray(newCosts)
+        # a pair listed more than once takes its last cost, as cijNew[rows, cols] = newCosts would
+        _, last = np.unique((rows * np.shape(cij)[-1] + cols)[::-1], return_index=True)
+        last = len(rows) - 1 - last
+        rows, cols, newCosts = rows[last], cols[last], newCosts[last]
+        dK = f(np.asarray(newCosts), param) - f(np.asarray(cij)[rows, cols], param)
+        flat = AiNew.reshape(-1, AiNew.shape[-1])
+        np.add.at(flat, (slice(None), rows), dK * DjNew.reshape(-1, DjNew.shape[-1])[:, cols])
+    change = (scaleTo100(AiNew) - scaleTo100(np.asarray(Ai, dtype=float))) / scaleTo100(np.asarray(Ai, dtype=float)) * 100.0
+    return AiNew, DjNew, change
+
+###############################################################################
+
+"""
+SortedCostIndex
+Index for cumulative opportunity accessibility, i.e. the opportunities
+reachable from every origin within a cost threshold (e.g. the jobs within
+30, 45 and 60 minutes by rail). The destinations of every origin row are
+sorted by cost once per cost matrix, so:
+- the number of destinations within t of row i is a binary search, done for
+  all the rows and thresholds in a single np.searchsorted: every cost is
+  replaced by its rank among the distinct costs, and the key
+  row * (number of distinct costs) + rank is sorted over the whole matrix;
+- the opportunities within t are then a lookup in the prefix sums of the
+  opportunities taken in the sorted order of the row.
+The order and keys are kept in the kernel cache (see kernelcache.py).
+@param cij (m, n) cost matrix or (n_modes, m, n) cost tensor
+"""
+class SortedCostIndex:
+    def __init__(self, cij):
+        self.shape = np.shape(cij)
+        n = self.shape[-1]
+        self.order = kernelCache.fetch(cij, 'sorted_order', None, lambda: np.argsort(cij, axis=-1, kind='stable').astype(np.int32 if n < 2**31 else np.intp))
+        self.costs, self.keys = self.buildKeys(cij)
+
+    ################################################################################
+
+    """
+    buildKeys
+    @returns the distinct costs (sorted) and the keys row * len(costs) + rank
+        of every cost in sorted order of the rows, flattened (see class comment)
+    """
+    def buildKeys(self, cij):
+        costs = kernelCache.fetch(cij, 'sorted_costs', None, lambda: np.unique(cij))
+        def build():
+            ranks = np.searchsorted(costs, np.take_along_axis(np.asarray(cij), self.order, axis=-1)).reshape(-1, self.shape[-1])
+            rows = np.arange(len(ranks), dtype=np.int64)[:, None]
+            return (rows * len(costs) + ranks).ravel()
+        return costs, kernelCache.fetch(cij, 'sorted_keys', None, build)
+
+    ################################################################################
+
+    """
+    counts
+    Number of destinations of every origin within each threshold (cost <= t)
+    @param thresholds cost thresholds (e.g. [30, 45, 60] minutes)
+    @returns (m, n_thresholds), or (n_modes, m, n_thresholds) for a cost tensor
+    """
+    def counts(self, thresholds):
+        thresholds = np.atleast_1d(np.asarray(thresholds, dtype=float))
+        n = self.shape[-1]
+        rows = np.arange(len(self.keys) // n, dtype=np.int64)[:, None]
+        ranks = np.searchsorted(self.costs, thresholds, side='right')  # number of distinct costs <= t
+        counts = np.searchsorted(self.keys, rows * len(self.costs) + ranks) - rows * n
+        return counts.reshape(self.shape[:-1] + (len(thresholds),))
+
+    ################################################################################
+
+    """
+    prefixSums
+    Prefix sums of the opportunities Dj in the sorted order of every origin row,
+    prefix[..., i, c] = opportunities at the c closest destinations of i
+    @param Dj (n,) opportunities, or (n_modes, n) for a cost tensor, or a
+        (n_scenarios, ...) batch of them
+    @returns (..., m, n + 1) array
+    """
+    def prefixSums(self, Dj):
+        Dj = np.asarray(Dj, dtype=float)
+        order = self.order.reshape((1,) * (Dj.ndim + 1 - len(self.shape)) + self.order.shape)  # same dimensions as Dj[..., None, :]
+        sortedDj = np.take_along_axis(Dj[..., None, :], order, axis=-1)
+        prefix = np.zeros(sortedDj.shape[:-1] + (sortedDj.shape[-1] + 1,))
+        np.cumsum(sortedDj, axis=-1, out=prefix[..., 1:])
+        return prefix
+
+    ################################################################################
+
+    """
+    cumulativeOpportunities
+    Opportunities reachable from every origin within each threshold, for all
+    the thresholds (and modes and scenarios) in one pass
+    @param Dj opportunities (see prefixSums)
+    @param thresholds cost thresholds
+    @param prefix optional prefixSums(Dj), to query the same opportunities again
+        (e.g. for other thresholds) without sorting them again
+    @returns (..., m, n_thresholds) array
+    """
+    def cumulativeOpportunities(self, Dj, thresholds, prefix=None):
+        prefix = self.prefixSums(Dj) if prefix is None else prefix
+        counts = self.counts(thresholds)
+        return np.take_along_axis(prefix, np.broadcast_to(counts, prefix.shape[:-1] + counts.shape[-1:]), axis=-1)
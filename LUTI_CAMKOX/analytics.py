@@ -5,6 +5,25 @@ Produce analytic data for debugging and visualisation
 """
 from geojson import FeatureCollection, Feature, LineString
 from math import sqrt
+import numpy as np
+
+from LUTI_CAMKOX.kernelcache import kernelCache
+
+"""
+unitDirections
+Unit vectors between all pairs of zone centroids
+@param centroids n x 2 array of (east, north)
+@returns (2, n, n) array of the x and y components of the unit vector from
+    centroid j to centroid i at [i,j], zero where the centroids coincide
+"""
+def unitDirections(centroids):
+    dx = centroids[:,0][:,None] - centroids[:,0][None,:]
+    dy = centroids[:,1][:,None] - centroids[:,1][None,:]
+    mag = np.sqrt(dx*dx+dy*dy)
+    u = np.zeros((2,) + mag.shape)
+    np.divide(dx, mag, out=u[0], where=mag>0)
+    np.divide(dy, mag, out=u[1], where=mag>0)
+    return u
 
 """
 flowArrowsGeoJSON
@@ -35,26 +54,19 @@ def flowArrowsGeoJSON(Tij,dfZoneCodes):
 
     features = []
     m, n = Tij.shape
+    #unit vectors between the centroids j->i, the same for every Tij on these zones, so they come
+    #from the kernel cache: ux[i,j] = dx/mag with dx = xci-xcj (zero for the self flow i==j)
+    centroids = np.array([zonelookup[z] for z in range(max(m,n))], dtype=float)
+    ux, uy = kernelCache.fetch(centroids, 'unit_direction', None, lambda: unitDirections(centroids))
+    #sum normalised direction times value of number of people travelling on link, over all work zones i
+    DX = np.einsum('ij,ij->j', Tij, ux[:m,:n])
+    DY = np.einsum('ij,ij->j', Tij, uy[:m,:n])
     for j in range(n): #for all residential zones
         centroidj = zonelookup[j]
         xcj = centroidj[0]
         ycj = centroidj[1]
-        dxji=0
-        dyji=0
-        for i in range(m): #sum all work zone flows to get average flow
-            if j==i:
-                continue #don't do the self flow
-            value=Tij[i,j] #this is flow from originj (residence) to desti (work)
-            centroidi = zonelookup[i]
-            xci = centroidi[0]
-            yci = centroidi[1]
-            dx = xci-xcj # j->i vector between centroids - need to normalise this
-            dy = yci-ycj
-            mag = sqrt(dx*dx+dy*dy)
-            #sum normalised direction times value of number of people travelling on link
-            dxji+= value * dx/mag
-            dyji+= value * dy/mag
-        #end for i
+        dxji = DX[j]
+        dyji = DY[j]
         #and make an arrow (xcj,ycj)+(dxji,dyji)*value
         #print("i=",i,"dxji=",dxji,"dyji=",dyji)
         r = sqrt(dxji*dxji+dyji*dyji) #need magnitude of vector as we have to rotate and scale it
@@ -0,0 +1,126 @@
+"""
+asyncwriter.py
+
+Background output stage: the model outputs (CSV tables, flow and probability
+matrices, GeoJSON files) are handed to worker threads through a bounded queue
+and written while the next scenario computes, so disk I/O is off the critical
+path. The queue bounds the number of pending results held in memory: submit
+blocks while it is full.
+The buffers submitted MUST NOT be modified afterwards, as they are written
+some time later. The first error of a write is raised again by every later
+submit and flush, so a failed output is never silently lost, and the writes
+still queued after it are skipped.
+"""
+import queue
+import threading
+
+from LUTI_CAMKOX.globals import outputWriterThreads, outputWriterQueueSize
+
+class AsyncWriter:
+    """
+    constructor
+    @param workers number of writer threads (default outputWriterThreads in
+        globals), 0 to write synchronously in submit
+    @param maxPending size of the queue of pending writes (default outputWriterQueueSize)
+    """
+
+    def __init__(self, workers=None, maxPending=None):
+        self.workers = outputWriterThreads if workers is None else workers
+        self.queue = queue.Queue(outputWriterQueueSize if maxPending is None else maxPending)
+        self.error = None  # first write error
+        self.failed = False  # a write failed, the remaining ones are skipped
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.run, name="AsyncWriter-" + str(t), daemon=True) for t in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    ################################################################################
+
+    """
+    run
+    Worker thread: write the queued outputs until the None sentinel. After an
+    error (failed) the remaining writes are skipped, but still drained so flush
+    does not block.
+    """
+    def run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                fn, args, kwargs = task
+                if not self.failed:
+                    fn(*args, **kwargs)
+            except BaseException as e:
+                with self.lock:
+                    if not self.failed:
+                        self.failed = True
+                        self.error = e
+            finally:
+                self.queue.task_done()
+
+    ################################################################################
+
+    """
+    check
+    Raise the first error of the writes so far, if any (again on every call)
+    """
+    def check(self):
+        with self.lock:
+            failed, error = self.failed, self.error
+        if failed:
+            raise RuntimeError("FATAL: AsyncWriter output write failed: " + repr(error)) from error
+
+    ################################################################################
+
+    """
+    submit
+    Queue fn(*args, **kwargs), e.g. submit(saveOutputMatrix, Tij[0], filename),
+    blocking while the queue is full
+    """
+    def submit(self, fn, *args, **kwargs):
+        self.check()
+        if self.workers == 0:
+            fn(*args, **kwargs)
+            return
+        self.queue.put((fn, args, kwargs))
+
+    ################################################################################
+
+    """
+    flush
+    Barrier: wait until all the outputs submitted so far are written, then
+    raise the first error, if any
+    """
+    def flush(self):
+        self.queue.join()
+        self.check()
+
+    ################################################################################
+
+    """
+    close
+    Flush and stop the worker threads
+    """
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for thread in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        else:
+            try:
+                self.close()
+            except RuntimeError:
+                pass  # the exception already raised takes precedence
+        return False
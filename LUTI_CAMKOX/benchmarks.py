@@ -0,0 +1,471 @@
+"""
+benchmarks.py
+
+Timing comparisons between the current implementations and the original ones
+they replaced. The original implementations are kept here as references.
+Run with: python -m LUTI_CAMKOX.benchmarks
+"""
+import os
+import struct
+import tempfile
+import time
+import numpy as np
+
+from LUTI_CAMKOX.globals import flowThreads
+from LUTI_CAMKOX.utils import loadQUANTMatrix, saveOutputMatrix, loadOutputMatrix
+from LUTI_CAMKOX.quantlhmodel import QUANTLHModel
+from LUTI_CAMKOX.calibration import calibrate, solvers
+from LUTI_CAMKOX.accessibility import accessibility, modeAccessibility, scaleTo100, SortedCostIndex, costChanges, updateAccessibility
+from LUTI_CAMKOX.kernelcache import kernelCache
+from LUTI_CAMKOX import kernels
+
+###############################################################################
+
+"""
+loadQUANTMatrixLoop
+The original QUANT matrix reader: unpack each row with struct and copy it
+into a float64 matrix element by element.
+"""
+def loadQUANTMatrixLoop(filename):
+    with open(filename,'rb') as f:
+        (m,) = struct.unpack('i', f.read(4))
+        (n,) = struct.unpack('i', f.read(4))
+        matrix = np.arange(m*n,dtype=float).reshape(m, n)
+        for i in range(0,m):
+            data = struct.unpack('{0}f'.format(n), f.read(4*n))
+            for j in range(0,n):
+                matrix[i,j] = data[j]
+    return matrix
+
+###############################################################################
+
+"""
+writeQUANTMatrix
+Write a matrix in QUANT format (row count, column count, m x n float32 data).
+Used to make synthetic input files for the benchmarks.
+"""
+def writeQUANTMatrix(matrix, filename):
+    m, n = matrix.shape
+    with open(filename,'wb') as f:
+        f.write(struct.pack('ii', m, n))
+        f.write(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+
+###############################################################################
+
+"""
+timeit
+Return the best wall time in seconds of repeats calls of fn(*args)
+"""
+def timeit(fn, *args, repeats=3):
+    best = None
+    for r in range(repeats):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+###############################################################################
+
+"""
+benchmarkLoadQUANTMatrix
+Compare the original struct loop reader with the vectorised reader.
+@param filename A QUANT .bin file
+"""
+def benchmarkLoadQUANTMatrix(filename, repeats=3):
+    reference = loadQUANTMatrixLoop(filename)
+    assert np.array_equal(reference, loadQUANTMatrix(filename)), "FATAL: loadQUANTMatrix differs from the loop reader"
+    t_loop = timeit(loadQUANTMatrixLoop, filename, repeats=1)
+    t_float64 = timeit(loadQUANTMatrix, filename, repeats=repeats)
+    t_float32 = timeit(lambda f: loadQUANTMatrix(f, dtype=np.float32), filename, repeats=repeats)
+    t_mmap = timeit(lambda f: loadQUANTMatrix(f, dtype=np.float32, mmap=True), filename, repeats=repeats)
+    print("loadQUANTMatrix", reference.shape, "loop (secs) =", t_loop)
+    print("loadQUANTMatrix", reference.shape, "float64 (secs) =", t_float64, "speedup =", t_loop / t_float64)
+    print("loadQUANTMatrix", reference.shape, "float32 (secs) =", t_float32, "speedup =", t_loop / t_float32)
+    print("loadQUANTMatrix", reference.shape, "float32 mmap (secs) =", t_mmap, "speedup =", t_loop / t_mmap)
+
+###############################################################################
+
+"""
+computeSijLoop
+The original Sij computation of run3modes: for every mode loop over all
+origin rows and recompute the denominator over all modes.
+"""
+def computeSijLoop(Ei, Aj, Beta, cij_k):
+    n_modes = len(cij_k)
+    m, n = cij_k[0].shape
+    Sij = [[] for i in range(n_modes)]
+    ExpMBetaCijk = [[] for k in range(n_modes)]
+    for kk in range(n_modes):
+        ExpMBetaCijk[kk] = np.exp(-Beta[kk] * cij_k[kk])
+    for k in range(n_modes):
+        Sij[k] = np.zeros(m * n).reshape(m, n)
+        for i in range(m):
+            denom = 0
+            for kk in range(n_modes):
+                denom += np.sum(Aj * ExpMBetaCijk[kk][i, :])
+            Sij[k][i, :] = Ei[i] * (Aj * ExpMBetaCijk[k][i, :] / denom)
+    return Sij
+
+###############################################################################
+
+"""
+makeSyntheticModel
+Build a QUANTLHModel with random jobs, dwellings and travel times (minutes,
+clamped to at least 1) for n_modes modes on an n x n zone system. The observed
+trips come from the model itself at known Betas, with multiplicative noise, so
+calibration has a realistic target.
+"""
+def makeSyntheticModel(n, n_modes=3, seed=0):
+    rng = np.random.default_rng(seed)
+    model = QUANTLHModel(n, n)
+    model.setPopulationVectorEi(rng.uniform(100.0, 5000.0, n))
+    model.Aj = rng.uniform(100.0, 3000.0, n)
+    model.setCostMatrixCij(*[np.maximum(rng.uniform(1.0, 180.0, (n, n)), 1.0) for k in range(n_modes)])
+    BetaObs = np.linspace(0.06, 0.02, n_modes)
+    SObs = model.computeSij(BetaObs) * rng.uniform(0.8, 1.2, (n_modes, n, n))
+    model.setObsMatrix(SObs)
+    return model
+
+###############################################################################
+
+"""
+benchmarkComputeSij
+Compare the original per row Sij loop with the vectorised kernel.
+@param n number of zones of the synthetic model
+"""
+def benchmarkComputeSij(n, repeats=3):
+    model = makeSyntheticModel(n)
+    Beta = np.array([0.05, 0.03, 0.02])
+    cij_k = list(model.cij)
+    reference = computeSijLoop(model.Ei, model.Aj, Beta, cij_k)
+    out = np.empty((3, n, n))
+    Sij = model.computeSij(Beta, out=out)
+    for k in range(3):
+        assert np.allclose(reference[k], Sij[k], rtol=1e-12, atol=0), "FATAL: computeSij differs from the loop kernel"
+    t_loop = timeit(computeSijLoop, model.Ei, model.Aj, Beta, cij_k, repeats=repeats)
+    t_vec = timeit(model.computeSij, Beta, repeats=repeats)
+    t_out = timeit(lambda: model.computeSij(Beta, out=out), repeats=repeats)
+    t_one = timeit(lambda: model.evaluateFlows(Beta, sink=out, threads=1), repeats=repeats)
+    threads = flowThreads
+    print("computeSij", (3, n, n), "loop (secs) =", t_loop)
+    print("computeSij", (3, n, n), "vectorised (secs) =", t_vec, "speedup =", t_loop / t_vec)
+    print("computeSij", (3, n, n), "vectorised, out buffer, 1 thread (secs) =", t_one, "speedup =", t_loop / t_one)
+    print("computeSij", (3, n, n), "vectorised, out buffer,", threads, "threads (secs) =", t_out, "speedup =", t_loop / t_out)
+
+###############################################################################
+
+"""
+benchmarkCalibration
+Number of model evaluations and time taken by each calibration solver.
+@param n number of zones of the synthetic model
+"""
+def benchmarkCalibration(n):
+    model = makeSyntheticModel(n)
+    for solver in solvers:
+        result = calibrate(model, solver=solver, materialize=False)
+        print("calibrate", (3, n, n), solver, "iterations =", result.iterations, "(secs) =", result.elapsed, "Beta =", result.Beta)
+
+###############################################################################
+
+"""
+benchmarkIncremental
+Compare a full run with an incremental update of a base run when the jobs and
+dwellings of a few zones change.
+@param n number of zones of the synthetic model
+@param changed number of zones with new jobs and new dwellings
+"""
+def benchmarkIncremental(n, changed=10, repeats=3):
+    model = makeSyntheticModel(n)
+    Beta = np.array([0.05, 0.03, 0.02])
+    model.setBaseRun(Beta)
+    rng = np.random.default_rng(1)
+    Ei = model.Ei.copy()
+    Aj = model.Aj.copy()
+    Ei[rng.choice(n, changed, replace=False)] += 500.0
+    Aj[rng.choice(n, changed, replace=False)] += 300.0
+    reference = makeSyntheticModel(n)
+    reference.setPopulationVectorEi(Ei)
+    reference.Aj = Aj
+    assert np.allclose(reference.evaluateFlows(Beta).CBar, model.updateFlows(Ei, Aj).CBar, rtol=1e-12), "FATAL: updateFlows differs from a full run"
+    out = np.empty((3, n, n))
+    t_full = timeit(lambda: reference.evaluateFlows(Beta, sink=out), repeats=repeats)
+    t_stats = timeit(lambda: model.updateFlows(Ei, Aj), repeats=repeats)
+    t_flows = timeit(lambda: model.updateFlows(Ei, Aj, out=out), repeats=repeats)
+    print("updateFlows", (3, n, n), changed, "zones changed, full run (secs) =", t_full)
+    print("updateFlows", (3, n, n), changed, "zones changed, statistics (secs) =", t_stats, "speedup =", t_full / t_stats)
+    print("updateFlows", (3, n, n), changed, "zones changed, statistics and Sij (secs) =", t_flows, "speedup =", t_full / t_flows)
+
+###############################################################################
+
+"""
+benchmarkScenarios
+Compare separate runs of several (Ei, Aj) scenarios with one batched run
+sharing the kernels.
+@param n number of zones of the synthetic model
+@param scenarios number of scenarios
+"""
+def benchmarkScenarios(n, scenarios=10, repeats=3):
+    model = makeSyntheticModel(n)
+    Beta = np.array([0.05, 0.03, 0.02])
+    rng = np.random.default_rng(2)
+    Ei = model.Ei * rng.uniform(0.9, 1.1, (scenarios, n))
+    Aj = model.Aj * rng.uniform(0.9, 1.1, (scenarios, n))
+    sinks = np.empty((scenarios, 3, n, n))
+
+    def separate():
+        for s in range(scenarios):
+            model.setPopulationVectorEi(Ei[s])
+            model.Aj = Aj[s]
+            model.evaluateFlows(Beta, sink=sinks[s])
+
+    t_separate = timeit(separate, repeats=repeats)
+    t_batched = timeit(lambda: model.evaluateScenarios(Beta, Ei, Aj, sinks=sinks), repeats=repeats)
+    print("evaluateScenarios", (3, n, n), scenarios, "scenarios, separate runs (secs) =", t_separate)
+    print("evaluateScenarios", (3, n, n), scenarios, "scenarios, batched (secs) =", t_batched, "speedup =", t_separate / t_batched)
+
+###############################################################################
+
+"""
+benchmarkCostTable
+Compare the exp kernels computed for every cell with the lookup table over
+the costs quantized to resolution (see QUANTLHModel.setCostResolution), and
+the effect on the predicted mean trip cost.
+@param n number of zones of the synthetic model
+@param resolution cost resolution in minutes
+"""
+def benchmarkCostTable(n, resolution=0.1, repeats=3):
+    model = makeSyntheticModel(n)
+    Beta = np.array([0.05, 0.03, 0.02])
+    out = np.empty((3, n, n))
+    CBar = model.evaluateFlows(Beta).CBar
+    t_exp = timeit(lambda: model.kernelBlock(-Beta, None, 0, n, out), repeats=repeats)
+    t_flows = timeit(lambda: model.evaluateFlows(Beta), repeats=repeats)
+    costBytes = model.cij.nbytes
+    model.setCostResolution(resolution)
+    error = np.max(np.absolute(model.evaluateFlows(Beta).CBar - CBar) / CBar)
+    t_table = timeit(lambda: model.kernelBlock(-Beta, model.exponentialTable(Beta), 0, n, out), repeats=repeats)
+    t_flows_table = timeit(lambda: model.evaluateFlows(Beta), repeats=repeats)
+    print("kernelBlock", (3, n, n), "exp (secs) =", t_exp)
+    print("kernelBlock", (3, n, n), "lookup table, resolution", resolution, "(secs) =", t_table, "speedup =", t_exp / t_table)
+    print("evaluateFlows", (3, n, n), "lookup table (secs) =", t_flows_table, "speedup =", t_flows / t_flows_table, "CBar relative error =", error)
+    print("costIndex", model.costIndex.dtype, model.costIndex.nbytes, "bytes, replacing float64 costs of", costBytes, "bytes")
+
+###############################################################################
+
+"""
+accessibilityLoop
+The original Calculate_Job_Accessibility (and Calculate_Housing_Accessibility)
+of main.py: a double loop over all the zone pairs, then scaled to 100.
+"""
+def accessibilityLoop(DjPred, cij):
+    Ji = np.zeros(len(DjPred))
+    for i in range(len(Ji)):
+        for j in range(len(Ji)):
+            Ji[i] += DjPred[j] / (cij[i, j] * cij[i, j])
+    Sum = 0
+    for i in range(len(Ji)): Sum += Ji[i]
+    for i in range(len(Ji)): Ji[i] = 100.0 * Ji[i] / Sum
+    return Ji
+
+###############################################################################
+
+"""
+benchmarkAccessibility
+Compare the original accessibility loop (timed on one mode, which takes a
+while) with the jobs and housing accessibility of all the modes and scenarios
+in one batched product over the cached impedances (see accessibility.py).
+@param n number of zones of the synthetic model
+@param scenarios number of scenarios
+"""
+def benchmarkAccessibility(n, scenarios=2, repeats=3):
+    model = makeSyntheticModel(n)
+    rng = np.random.default_rng(3)
+    Dj = rng.uniform(0.0, 1000.0, (2 * scenarios, 3, n))  # jobs and housing opportunities
+    t_loop = timeit(lambda: accessibilityLoop(Dj[0, 0], model.cij[0]), repeats=1)
+    error = np.max(np.absolute(scaleTo100(modeAccessibility(Dj, model.cij))[0, 0] - accessibilityLoop(Dj[0, 0], model.cij[0])))
+    t_batched = timeit(lambda: scaleTo100(modeAccessibility(Dj, model.cij)), repeats=repeats)
+    print("accessibility", (n, n), "loop, one mode (secs) =", t_loop, "estimated for", Dj.shape[0] * 3, "=", t_loop * Dj.shape[0] * 3)
+    print("accessibility", (3, n, n), Dj.shape[0], "batches, batched (secs) =", t_batched, "speedup =", t_loop * Dj.shape[0] * 3 / t_batched, "max error =", error)
+
+###############################################################################
+
+"""
+benchmarkCumulativeOpportunities
+Compare the opportunities within each of many thresholds (an isochrone table,
+e.g. every minute up to two hours) by thresholding the whole cost tensor per
+threshold with the sorted cost index (see accessibility.SortedCostIndex), for
+all the modes and scenarios.
+@param n number of zones of the synthetic model
+@param thresholds cost thresholds
+"""
+def benchmarkCumulativeOpportunities(n, thresholds=np.arange(1.0, 121.0), scenarios=2, repeats=3):
+    model = makeSyntheticModel(n)
+    rng = np.random.default_rng(4)
+    Dj = rng.uniform(0.0, 1000.0, (scenarios, 3, n))
+
+    def brute():
+        return np.stack([np.einsum('kij,skj->ski', model.cij <= t, Dj) for t in thresholds], axis=-1)
+
+    t_brute = timeit(brute, repeats=1)
+    start = time.perf_counter()
+    index = SortedCostIndex(model.cij)
+    t_build = time.perf_counter() - start
+    start = time.perf_counter()
+    prefix = index.prefixSums(Dj)
+    t_prefix = time.perf_counter() - start
+    t_index = timeit(lambda: index.cumulativeOpportunities(Dj, thresholds, prefix), repeats=repeats)
+    error = np.max(np.absolute(index.cumulativeOpportunities(Dj, thresholds, prefix) - brute()))
+    print("cumulative opportunities", (3, n, n), len(thresholds), "thresholds,", scenarios, "scenarios, thresholding (secs) =", t_brute)
+    print("cumulative opportunities", (3, n, n), "index build (secs) =", t_build, "prefix sums (secs) =", t_prefix,
+          "query (secs) =", t_index, "speedup =", t_brute / t_index, "max error =", error)
+
+###############################################################################
+
+"""
+benchmarkAccessibilityUpdate
+Compare recomputing the accessibility for new costs (a new impedance kernel)
+with updating the base accessibility for the changed OD pairs and zones only
+(see accessibility.updateAccessibility).
+@param n number of zones
+@param pairs number of changed OD pairs
+@param zones number of zones with changed opportunities
+"""
+def benchmarkAccessibilityUpdate(n, pairs=5000, zones=20, repeats=3):
+    rng = np.random.default_rng(5)
+    cij = rng.uniform(1.0, 300.0, (n, n))
+    cijNew = cij.copy()
+    cijNew[rng.integers(0, n, pairs), rng.integers(0, n, pairs)] *= 0.7
+    Dj = rng.uniform(0.0, 1000.0, n)
+    changed = (rng.choice(n, zones, replace=False), rng.uniform(0.0, 100.0, zones))
+    Ai = accessibility(Dj, cij)
+    changes = costChanges(cij, cijNew)
+    DjNew = Dj.copy()
+    DjNew[changed[0]] += changed[1]
+
+    def full():
+        kernelCache.clear()  # new costs, so no cached kernel
+        return accessibility(DjNew, cijNew)
+
+    t_full = timeit(full, repeats=repeats)
+    t_update = timeit(lambda: updateAccessibility(Ai, Dj, cij, changes, changed), repeats=repeats)
+    error = np.max(np.absolute(updateAccessibility(Ai, Dj, cij, changes, changed)[0] - full()) / full())
+    print("accessibility", (n, n), "recomputed for new costs (secs) =", t_full)
+    print("accessibility", (n, n), len(changes[0]), "pairs and", zones, "zones changed, update (secs) =", t_update,
+          "speedup =", t_full / t_update, "max relative error =", error)
+
+    # zones and pairs listed twice: the deltas of a zone add up, a pair takes its last cost
+    rows, cols, costs = changes
+    duplicates = (np.append(rows, rows[0]), np.append(cols, cols[0]), np.append(costs, costs[0] * 0.5))
+    cijDuplicates = cijNew.copy()
+    cijDuplicates[rows[0], cols[0]] = costs[0] * 0.5
+    DjDuplicates = Dj.copy()
+    DjDuplicates[changed[0][0]] += 2 * changed[1][0]
+    AiNew, DjNew, _ = updateAccessibility(Ai, Dj, cij, duplicates, ([changed[0][0], changed[0][0]], [changed[1][0], changed[1][0]]))
+    kernelCache.clear()
+    assert np.allclose(DjNew, DjDuplicates) and np.allclose(AiNew, accessibility(DjDuplicates, cijDuplicates)), "FATAL: updateAccessibility differs from a full recompute with duplicate zones and pairs"
+
+###############################################################################
+
+"""
+benchmarkNumbaKernels
+Check the Numba kernels (see kernels.py) against the NumPy implementations
+they replace: evaluateFlows (statistics, derivative and Sij), computeCBar,
+computeProbabilities3modes and accessibility, and compare their times (the
+first call of each Numba kernel, which compiles it, is not timed).
+Skipped if Numba is not installed.
+@param tolerance maximum relative difference
+"""
+def benchmarkNumbaKernels(n, threads=flowThreads, tolerance=1e-10, repeats=3):
+    if kernels.numba is None:
+        print("Numba kernels skipped: numba is not installed")
+        return
+    backend = kernels.kernelBackend
+    kernels.kernelBackend = 'numpy'  # the model methods are the NumPy references, the Numba kernels are called directly
+    try:
+        compareNumbaKernels(n, threads, tolerance, repeats)
+    finally:
+        kernels.kernelBackend = backend
+
+def compareNumbaKernels(n, threads, tolerance, repeats):
+    model = makeSyntheticModel(n)
+    Beta = np.array([0.05, 0.03, 0.02])
+
+    def check(name, numpyResult, numbaResult):
+        error = np.max(np.absolute(numbaResult - numpyResult) / np.maximum(np.absolute(numpyResult), 1e-300))
+        assert error <= tolerance, "FATAL: Numba " + name + " differs from NumPy, max relative error = " + str(error)
+        return error
+
+    def numbaFlows(sink):
+        Ni, Mi, Dj, Nc2 = kernels.flows(model.cij, model.Ei, model.Aj, Beta, sink=sink, derivatives=True, threads=threads)
+        return model.flowStatistics(Ni, Mi, Dj, Nc2, True)
+
+    Sij, SijNumba = np.empty(model.cij.shape), np.empty(model.cij.shape)
+    stats = model.evaluateFlows(Beta, sink=Sij, derivatives=True, threads=threads)
+    statsNumba = numbaFlows(SijNumba)
+    errors = [check("flows CBar", stats.CBar, statsNumba.CBar), check("flows dCBar", stats.dCBar, statsNumba.dCBar),
+              check("flows Oi", stats.Oi, statsNumba.Oi), check("flows Dj", stats.Dj, statsNumba.Dj), check("flows Sij", Sij, SijNumba)]
+    t_numpy = timeit(lambda: model.evaluateFlows(Beta, derivatives=True, threads=threads), repeats=repeats)
+    t_numba = timeit(lambda: numbaFlows(None), repeats=repeats)
+    print("evaluateFlows", model.cij.shape, "numpy (secs) =", t_numpy, "numba (secs) =", t_numba, "speedup =", t_numpy / t_numba, "max relative error =", max(errors))
+
+    CBar = model.computeCBar(Sij, model.cij)
+    error = check("computeCBar", CBar, kernels.cbarNumba(Sij, model.cij))
+    t_numpy = timeit(lambda: model.computeCBar(Sij, model.cij), repeats=repeats)
+    t_numba = timeit(lambda: kernels.cbarNumba(Sij, model.cij), repeats=repeats)
+    print("computeCBar", model.cij.shape, "numpy (secs) =", t_numpy, "numba (secs) =", t_numba, "speedup =", t_numpy / t_numba, "max relative error =", error)
+
+    probabilities = np.array(model.computeProbabilities3modes(Sij))
+    out = np.empty(model.cij.shape)
+    error = check("computeProbabilities3modes", probabilities, kernels.probabilitiesNumba(Sij, out))
+    t_numpy = timeit(lambda: model.computeProbabilities3modes(Sij), repeats=repeats)
+    t_numba = timeit(lambda: kernels.probabilitiesNumba(Sij, out), repeats=repeats)
+    print("computeProbabilities3modes", model.cij.shape, "numpy (secs) =", t_numpy, "numba (secs) =", t_numba, "speedup =", t_numpy / t_numba, "max relative error =", error)
+
+    Dj = stats.Dj[0]
+    Ai = accessibility(Dj, model.cij[0], backend='numpy')
+    error = check("accessibility", Ai, accessibility(Dj, model.cij[0], backend='numba'))
+    t_numpy = timeit(lambda: accessibility(Dj, model.cij[0], backend='numpy'), repeats=repeats)
+    t_numba = timeit(lambda: accessibility(Dj, model.cij[0], backend='numba'), repeats=repeats)
+    print("accessibility", (n, n), "numpy (secs) =", t_numpy, "numba (secs) =", t_numba, "speedup =", t_numpy / t_numba, "max relative error =", error)
+
+###############################################################################
+
+"""
+benchmarkOutputMatrix
+Compare writing and reading back an n x n output matrix in the output formats
+(see utils.saveOutputMatrix)
+@param directory where to write the files
+"""
+def benchmarkOutputMatrix(n, directory, formats=('.csv', '.npy', '.parquet'), repeats=3):
+    matrix = np.random.default_rng(6).uniform(0.0, 100.0, (n, n))
+    for extension in formats:
+        filename = os.path.join(directory, 'output_bench' + extension)
+        try:
+            t_write = timeit(saveOutputMatrix, matrix, filename, repeats=repeats)
+        except AssertionError as e:
+            print("outputMatrix", extension, "skipped:", e)
+            continue
+        t_read = timeit(lambda: np.asarray(loadOutputMatrix(filename)), repeats=repeats)
+        print("outputMatrix", (n, n), extension, "write (secs) =", t_write, "read (secs) =", t_read, "bytes =", os.path.getsize(filename))
+
+###############################################################################
+
+if __name__ == '__main__':
+    n = 1000
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'dis_bench.bin')
+        writeQUANTMatrix(rng.uniform(1.0, 300.0, (n, n)), filename)
+        benchmarkLoadQUANTMatrix(filename)
+        benchmarkOutputMatrix(n, tmpdir)
+    benchmarkComputeSij(n)
+    benchmarkNumbaKernels(n)
+    benchmarkCalibration(n)
+    benchmarkIncremental(n)
+    benchmarkScenarios(n)
+    benchmarkCostTable(n)
+    benchmarkAccessibility(n)
+    benchmarkCumulativeOpportunities(n)
+    benchmarkAccessibilityUpdate(n)
@@ -0,0 +1,289 @@
+"""
+calibration.py
+
+Calibration of the Beta parameters of the QUANT model: find Beta[k] for every
+mode so that the predicted mean trip cost CBarPred[k] matches the observed one
+CBarObs[k]. The solver is pluggable:
+- multiplicative: the original update Beta[k] *= CBarPred[k] / CBarObs[k]
+- newton: Newton's method (on log Beta) on CBarPred[k](Beta[k]) - CBarObs[k]
+  using the analytic derivative of the mean trip cost with respect to Beta[k]
+- secant: like newton, with the derivative estimated from the last two iterates
+Calibrated Betas are persisted in a CalibrationStore, keyed by the hashes of
+the model inputs, so later runs can start from the closest previous solution.
+"""
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+from LUTI_CAMKOX.globals import *
+from LUTI_CAMKOX.utils import arrayHash
+
+###############################################################################
+
+"""
+MultiplicativeSolver
+The original fixed point update: a mode whose mean trip cost is too high gets
+a larger Beta (shorter trips) and vice versa.
+"""
+class MultiplicativeSolver:
+    name = 'multiplicative'
+    derivatives = False
+
+    def update(self, Beta, CBarPred, CBarObs, dCBar, active):
+        Beta[active] = Beta[active] * CBarPred[active] / CBarObs[active]
+        return Beta
+
+###############################################################################
+
+"""
+NewtonSolver
+Newton's method on f(Beta[k]) = CBarPred[k] - CBarObs[k], per mode, with the
+analytic derivative dCBarPred[k]/dBeta[k] (the diagonal of the Jacobian: the
+modes are only coupled through the shared denominator). The step is taken
+on log(Beta), where CBar is much closer to linear than in Beta, which also
+keeps Beta positive: Beta *= exp(-f / (Beta * dCBar)).
+Far from the solution (relative error above newtonRange, e.g. from the
+initial Beta = 1) CBar is flat in Beta and the multiplicative update makes
+much better progress, so it is used there. It is also the fallback when the
+derivative is not negative (CBar decreases with Beta).
+"""
+class NewtonSolver:
+    name = 'newton'
+    derivatives = True
+
+    def __init__(self, newtonRange=0.25):
+        self.newtonRange = newtonRange
+
+    def update(self, Beta, CBarPred, CBarObs, dCBar, active):
+        multiplicative = Beta * CBarPred / CBarObs
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            newton = Beta * np.exp(-(CBarPred - CBarObs) / (Beta * dCBar))
+        ok = np.isfinite(newton) & (newton > 0) & (dCBar < 0) & (np.absolute(CBarPred - CBarObs) / CBarObs <= self.newtonRange)
+        step = np.where(ok, newton, multiplicative)
+        Beta[active] = step[active]
+        return Beta
+
+###############################################################################
+
+"""
+SecantSolver
+Like NewtonSolver, but the derivative is the slope through the last two
+iterates of each mode, so no derivative has to be computed. The first step
+of each mode is multiplicative.
+"""
+class SecantSolver:
+    name = 'secant'
+    derivatives = False
+
+    def __init__(self):
+        self.lastBeta = None
+        self.lastF = None
+
+    def update(self, Beta, CBarPred, CBarObs, dCBar, active):
+        f = CBarPred - CBarObs
+        multiplicative = Beta * CBarPred / CBarObs
+        step = multiplicative
+        if self.lastBeta is not None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                slope = (f - self.lastF) / (Beta - self.lastBeta)
+                secant = Beta - f / slope
+            ok = np.isfinite(secant) & (slope < 0) & (secant > 0)
+            step = np.where(ok, secant, multiplicative)
+        self.lastBeta = Beta.copy()
+        self.lastF = f
+        Beta[active] = step[active]
+        return Beta
+
+###############################################################################
+
+solvers = {
+    MultiplicativeSolver.name: MultiplicativeSolver,
+    NewtonSolver.name: NewtonSolver,
+    SecantSolver.name: SecantSolver,
+}
+
+"""
+makeSolver
+@param solver a solver name (see solvers), a solver object, or None for the
+    default from globals (calibrationSolver)
+"""
+def makeSolver(solver=None):
+    if solver is None:
+        solver = calibrationSolver
+    if isinstance(solver, str):
+        assert solver in solvers, "FATAL: unknown calibration solver " + solver + ", use one of " + str(list(solvers))
+        solver = solvers[solver]()
+    return solver
+
+###############################################################################
+
+"""
+CalibrationResult
+Outcome of a calibration run: the calibrated Beta, predicted and observed
+CBar, the flows Sij at the calibrated Beta, and how the solver got there.
+"""
+class CalibrationResult:
+    def __init__(self, solver, Beta, CBarPred, CBarObs, Sij, iterations, elapsed, converged):
+        self.solver = solver
+        self.Beta = Beta
+        self.CBarPred = CBarPred
+        self.CBarObs = CBarObs
+        self.Sij = Sij
+        self.iterations = iterations
+        self.elapsed = elapsed
+        self.converged = converged
+
+    def __repr__(self):
+        return ("CalibrationResult(solver=" + self.solver + ", iterations=" + str(self.iterations)
+                + ", elapsed=" + "{0:.3f}".format(self.elapsed) + "s, converged=" + str(self.converged)
+                + ", Beta=" + str(self.Beta) + ")")
+
+###############################################################################
+
+"""
+CalibrationStore
+Persist calibrated Betas, CBar values and convergence metadata in a JSON file
+(next to the matrix cache by default), keyed by the hashes of the model inputs
+(costs, observed trips, Ei, Aj) and the tolerance.
+A run with exactly the same inputs starts from the stored Betas, so it only
+needs the one model evaluation that confirms convergence. Otherwise the run
+starts from the entry with the same zone system and number of modes whose
+observed mean trip costs (the calibration targets) are closest.
+@param filename the JSON file
+@param maxEntries the oldest entries are dropped above this number
+"""
+class CalibrationStore:
+    def __init__(self, filename, maxEntries=100):
+        self.filename = filename
+        self.maxEntries = maxEntries
+
+    ################################################################################
+
+    """
+    makeKey
+    Hash of the inputs of a calibration run
+    """
+    @staticmethod
+    def makeKey(model, tolerance):
+        text = json.dumps({'cij': arrayHash(model.cij), 'SObs': arrayHash(model.SObs),
+                           'Ei': arrayHash(np.asarray(model.Ei, dtype=float)), 'Aj': arrayHash(np.asarray(model.Aj, dtype=float)),
+                           'tolerance': tolerance}, sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    ################################################################################
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            return []
+        with open(self.filename) as f:
+            return json.load(f)
+
+    ################################################################################
+
+    """
+    lookup
+    @returns (Beta, exact) for the stored calibration matching key exactly, or
+        else the closest one for the same shape (see the class comment), or
+        (None, False) if there is none
+    """
+    def lookup(self, key, shape, CBarObs):
+        best = None
+        bestDistance = None
+        for entry in self.load():
+            if entry['key'] == key and entry['converged']:
+                return np.array(entry['Beta']), True
+            if tuple(entry['shape']) != tuple(shape) or not entry['converged']:
+                continue
+            distance = np.max(np.absolute(np.array(entry['CBarObs']) - CBarObs) / CBarObs)
+            if bestDistance is None or distance < bestDistance:
+                best = entry
+                bestDistance = distance
+        if best is None:
+            return None, False
+        return np.array(best['Beta']), False
+
+    ################################################################################
+
+    """
+    save
+    Store (or replace) the calibration result for key
+    """
+    def save(self, key, shape, result):
+        entries = [e for e in self.load() if e['key'] != key]
+        entries.append({'key': key, 'shape': list(shape), 'solver': result.solver,
+                        'Beta': result.Beta.tolist(), 'CBarPred': result.CBarPred.tolist(), 'CBarObs': result.CBarObs.tolist(),
+                        'iterations': result.iterations, 'elapsed': result.elapsed, 'converged': result.converged,
+                        'time': time.time()})
+        entries = entries[-self.maxEntries:]
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        tmpname = self.filename + '.tmp' + str(os.getpid())
+        with open(tmpname, 'w') as f:
+            json.dump(entries, f, indent=1)
+        os.replace(tmpname, self.filename)
+
+###############################################################################
+
+"""
+calibrate
+Calibrate the Betas of a QUANTLHModel so that the predicted mean trip cost of
+every mode is within tolerance (relative) of the observed one.
+@param model QUANTLHModel with Ei, Aj, cij and SObs set
+@param solver solver name or object (see makeSolver)
+@param tolerance relative tolerance on |CBarPred - CBarObs| / CBarObs
+@param maxIterations stop after this many evaluations of the model
+@param maxTime stop after this many seconds (None for no limit)
+@param Beta initial Betas (default 1.0 for every mode, or the closest stored solution)
+@param store optional CalibrationStore to warm start from and save the result to
+@param materialize if True compute the flows Sij at the calibrated Beta, else Sij is None
+@returns CalibrationResult
+"""
+def calibrate(model, solver=None, tolerance=None, maxIterations=None, maxTime=None, Beta=None, store=None, materialize=True):
+    solver = makeSolver(solver)
+    tolerance = calibrationTolerance if tolerance is None else tolerance
+    maxIterations = calibrationMaxIterations if maxIterations is None else maxIterations
+    maxTime = calibrationMaxTime if maxTime is None else maxTime
+
+    # the observed statistics do not depend on Beta, so compute them once
+    CBarObs = model.computeCBar(model.SObs, model.cij)
+
+    if store is not None:
+        key = CalibrationStore.makeKey(model, tolerance)
+        if Beta is None:
+            Beta, exact = store.lookup(key, model.cij.shape, CBarObs)
+            if Beta is not None:
+                print("Warm starting calibration from", "the identical" if exact else "the closest", "previous run, Beta =", Beta)
+    Beta = np.ones(model.n_modes) if Beta is None else np.array(Beta, dtype=float)
+
+    print("Calibrating the model with the", solver.name, "solver...")
+    start = time.perf_counter()
+    iteration = 0
+    converged = False
+    while True:
+        iteration += 1
+        # the iterations only need the mean trip costs, which are reduced block by block of
+        # origin rows (small blocks, see calibrationMemoryBudget) without keeping Sij
+        stats = model.evaluateFlows(Beta, derivatives=solver.derivatives, memoryBudget=calibrationMemoryBudget)
+        CBarPred, dCBar = stats.CBar, stats.dCBar
+        active = np.absolute(CBarPred - CBarObs) / CBarObs > tolerance
+        elapsed = time.perf_counter() - start
+        print("Iteration: ", iteration, "Beta =", Beta, "CBarPred =", CBarPred)
+        if not active.any():
+            converged = True
+            break
+        if iteration >= maxIterations or (maxTime is not None and elapsed >= maxTime):
+            print("WARNING: calibration stopped before convergence after", iteration, "iterations and", elapsed, "secs")
+            break
+        Beta = solver.update(Beta, CBarPred, CBarObs, dCBar, active)
+
+    # the flows are only computed once, at the calibrated Beta
+    Sij = model.computeSij(Beta) if materialize else None
+    elapsed = time.perf_counter() - start
+    result = CalibrationResult(solver.name, Beta, CBarPred, CBarObs, Sij, iteration, elapsed, converged)
+    print(result)
+    if store is not None:
+        store.save(key, model.cij.shape, result)
+    return result
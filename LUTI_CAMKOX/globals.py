@@ -8,6 +8,37 @@ import os
 ########################################################################################################################
 # Directories paths
 modelRunsDir = "./LUTI_CAMKOX/model-runs"
+matrixCacheDir = os.path.join(modelRunsDir, "matrix-cache") # content addressed cache of the CAMKOX matrices
+
+########################################################################################################################
+# Matrix cache settings
+matrixCacheMaxBytes = 8 * 1024**3 # least recently used cache entries are evicted above this size
+
+# Ingestion of the QUANT matrices
+ingestWorkers = os.cpu_count() or 1 # threads used to build the CAMKOX matrices
+ingestMemoryLimit = 4 * 1024**3 # ceiling on the memory used by the builds running at the same time
+
+########################################################################################################################
+# Model calibration settings (see calibration.py)
+calibrationSolver = 'newton' # 'multiplicative' (original update), 'newton' or 'secant'
+calibrationTolerance = 0.001 # relative tolerance on |CBarPred - CBarObs| / CBarObs for every mode
+calibrationMaxIterations = 100 # maximum number of model evaluations
+calibrationMaxTime = None # maximum calibration time in seconds, None for no limit
+calibrationWarmStart = True # start from the Betas of the closest previous calibration (stored next to the matrix cache)
+calibrationStoreFilename = os.path.join(matrixCacheDir, "calibration.json")
+calibrationStoreMaxEntries = 100 # oldest calibrations are dropped above this number
+calibrationMemoryBudget = 32 * 1024**2 # working memory of a calibration iteration (statistics only, Sij is computed once at the end)
+
+# Model evaluation settings
+flowMemoryBudget = 1 * 1024**3 # working memory for the row blocks of the flow evaluation (see QUANTLHModel.evaluateFlows)
+flowThreads = os.cpu_count() or 1 # threads sharing the origin rows of the flow evaluation
+flowUseNumexpr = False # evaluate the exp kernel with numexpr (if installed) instead of the row thread pool
+kernelBackend = 'numpy' # 'numpy', 'numba' or 'auto' (numba if installed, else numpy), see kernels.py and benchmarks.benchmarkNumbaKernels
+costResolution = None # if set (e.g. 0.1 minutes), the costs are kept quantized to this resolution (uint16 instead of float64) and exp(-Beta * cij) comes from a lookup table
+kernelCacheMaxBytes = 2 * 1024**3 # budget of the in memory cache of impedance kernels (see kernelcache.py)
+accessibilityMeasure = ('power', 2.0) # impedance function of the jobs and housing accessibility outputs, ('power', 2.0) is 1/cij^2 (see accessibility.py)
+outputWriterThreads = 2 # threads writing the model outputs in the background (see asyncwriter.py), 0 to write them synchronously
+outputWriterQueueSize = 16 # outputs waiting to be written, the model waits when there are more
 
 ########################################################################################################################
 # These are download urls for big external data that can't go in the GitHub repo
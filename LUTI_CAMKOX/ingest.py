@@ -0,0 +1,137 @@
+"""
+ingest.py
+
+Ingestion of the QUANT matrices: clip each national matrix to the CAMKOX zones
+through the matrix cache. The matrices are independent, so they are built on a
+thread pool, with a memory ceiling on the builds running at the same time.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from LUTI_CAMKOX.globals import *
+from LUTI_CAMKOX.matrixcache import MatrixCache
+from LUTI_CAMKOX.utils import loadQUANTSubMatrix, readQUANTHeader, saveMatrix, readMatrixHeader
+
+###############################################################################
+
+"""
+IngestJob
+One QUANT matrix to ingest.
+@param name key of the matrix in the dictionary returned by ingestQUANTMatrices
+@param quantFilename the national QUANT .bin file
+@param camkoxFilename file name of the CAMKOX matrix in model-runs
+@param min_cost if not None, lower limit applied to the matrix (e.g. 1 minute links)
+@param csvFilename if not None, also export the matrix as csv in model-runs when it is built
+"""
+class IngestJob:
+    def __init__(self, name, quantFilename, camkoxFilename, min_cost=None, csvFilename=None):
+        self.name = name
+        self.quantFilename = quantFilename
+        self.camkoxFilename = camkoxFilename
+        self.min_cost = min_cost
+        self.csvFilename = csvFilename
+
+###############################################################################
+
+"""
+MemoryBudget
+Counting semaphore over bytes: acquire blocks until the requested bytes fit
+under the limit. A request larger than the whole limit is let through when
+nothing else is running, so it can never deadlock.
+"""
+class MemoryBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self.cond:
+            while self.used > 0 and self.used + nbytes > self.limit:
+                self.cond.wait()
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self.cond:
+            self.used -= nbytes
+            self.cond.notify_all()
+
+###############################################################################
+
+"""
+estimateIngestBytes
+Peak memory of building one CAMKOX matrix: the float32 row slab read from the
+QUANT file, plus the float64 result and the temporaries of the clamp.
+"""
+def estimateIngestBytes(quantFilename, nZones):
+    m, n = readQUANTHeader(quantFilename)
+    return nZones * n * 4 + 3 * nZones * nZones * 8
+
+###############################################################################
+
+"""
+importQUANTMatrix
+Clip a QUANT matrix to the CAMKOX zones through the matrix cache and publish it
+in model-runs under its CAMKOX file name.
+@param cache MatrixCache
+@param job IngestJob
+@param zone_idx positions of the CAMKOX zones in the QUANT matrix
+@param zones_hash hash of the CAMKOX zone list
+@param budget optional MemoryBudget to hold while the matrix is built
+@returns the CAMKOX matrix (read only, memory mapped)
+"""
+def importQUANTMatrix(cache, job, zone_idx, zones_hash, budget=None):
+    source_hash = cache.sourceHash(job.quantFilename)
+    key = MatrixCache.makeKey(source_hash, zones_hash, min_cost=job.min_cost)
+
+    def build():
+        nbytes = estimateIngestBytes(job.quantFilename, len(zone_idx))
+        if budget is not None:
+            budget.acquire(nbytes)
+        try:
+            print("Building", job.name, "for CAMKOX and London")
+            matrix = loadQUANTSubMatrix(job.quantFilename, zone_idx)
+            if job.min_cost is not None:
+                matrix[matrix < job.min_cost] = job.min_cost  # lower limit of min_cost minute links
+        finally:
+            if budget is not None:
+                budget.release(nbytes)
+        if job.csvFilename is not None:
+            np.savetxt(os.path.join(modelRunsDir, job.csvFilename), matrix, delimiter=",")
+        return matrix
+
+    matrix = cache.fetch(key, build, zonesHash=zones_hash, sourceHash=source_hash, min_cost=job.min_cost)
+
+    # keep the copy in model-runs in step with the cache (the model loads SObs from there)
+    filename = os.path.join(modelRunsDir, job.camkoxFilename)
+    header = readMatrixHeader(filename) if os.path.isfile(filename) else None
+    if header is None or header.get('key') != key:
+        saveMatrix(matrix, filename, key=key, zonesHash=zones_hash, sourceHash=source_hash, min_cost=job.min_cost)
+    return matrix
+
+###############################################################################
+
+"""
+ingestQUANTMatrices
+Run a list of IngestJobs on a thread pool. Reading, clipping and saving the
+matrices is mostly I/O and NumPy work that releases the GIL, so threads are
+enough and the results are shared without copies.
+@param jobs list of IngestJob
+@param cache MatrixCache
+@param zone_idx positions of the CAMKOX zones in the QUANT matrices
+@param zones_hash hash of the CAMKOX zone list
+@param workers number of threads (default ingestWorkers)
+@param memoryLimit ceiling in bytes for the builds running at the same time (default ingestMemoryLimit)
+@returns dict of job name -> CAMKOX matrix
+"""
+def ingestQUANTMatrices(jobs, cache, zone_idx, zones_hash, workers=None, memoryLimit=None):
+    workers = ingestWorkers if workers is None else workers
+    workers = max(1, min(workers, len(jobs)))
+    budget = MemoryBudget(ingestMemoryLimit if memoryLimit is None else memoryLimit)
+    print("Ingesting", len(jobs), "QUANT matrices with", workers, "workers")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {job.name: pool.submit(importQUANTMatrix, cache, job, zone_idx, zones_hash, budget) for job in jobs}
+        matrices = {name: future.result() for name, future in futures.items()}
+    return matrices
@@ -0,0 +1,134 @@
+"""
+kernelcache.py
+
+Process wide memoization of the impedance kernels computed from the cost
+matrices, e.g. exp(-Beta[k] * cij[k]) for the model and 1/cij^2 for the
+accessibility (see accessibility.py). An entry is keyed by the fingerprint of the cost matrix, the
+name of the impedance function and its parameter, so a repeated run (or a
+scenario that shares the costs and Betas) never computes the same kernel
+twice. The least recently used entries are evicted above a byte budget.
+"""
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+
+from LUTI_CAMKOX.globals import kernelCacheMaxBytes
+from LUTI_CAMKOX.utils import arrayHash
+
+class KernelCache:
+    """
+    constructor
+    @param maxBytes size budget for the cached kernels, the least recently used
+        kernels are evicted when it is exceeded
+    """
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self.fingerprints = {} # id(array) -> (weakref to the array, fingerprint)
+
+    ################################################################################
+
+    """
+    fingerprint
+    Hash of the dtype, shape and contents of a cost matrix. Hashing a large
+    matrix takes a while, so the result is remembered for as long as the array
+    object is alive. The cost matrices MUST NOT be modified in place once used.
+    """
+    def fingerprint(self, array):
+        with self.lock:
+            entry = self.fingerprints.get(id(array))
+            if entry is not None and entry[0]() is array:
+                return entry[1]
+        fingerprint = arrayHash(array)
+        key = id(array)
+        try:
+            ref = weakref.ref(array, lambda ref: self.fingerprints.pop(key, None))
+        except TypeError: # not an ndarray, hash it every time
+            return fingerprint
+        with self.lock:
+            self.fingerprints[key] = (ref, fingerprint)
+        return fingerprint
+
+    ################################################################################
+
+    """
+    makeKey
+    @param cij the cost matrix (or tensor) the kernel is computed from
+    @param impedance name of the impedance function, e.g. 'exp' or 'power'
+    @param param parameters of the impedance function (e.g. Beta), or None
+    """
+    def makeKey(self, cij, impedance, param=None):
+        param = None if param is None else tuple(np.atleast_1d(np.asarray(param, dtype=float)).tolist())
+        return (self.fingerprint(cij), impedance, param)
+
+    ################################################################################
+
+    """
+    fits
+    True if a kernel of nbytes can be kept in the cache at all. Callers that
+    can work without the whole kernel in memory (e.g. in row blocks) should
+    check this first.
+    """
+    def fits(self, nbytes):
+        return nbytes <= self.maxBytes
+
+    ################################################################################
+
+    """
+    fetch
+    Return the kernel for (cij, impedance, param) from the cache, calling
+    build() to make it (and storing the result, read only) if there is no entry.
+    """
+    def fetch(self, cij, impedance, param, build):
+        key = self.makeKey(cij, impedance, param)
+        with self.lock:
+            kernel = self.entries.get(key)
+            if kernel is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return kernel
+            self.misses += 1
+        kernel = build()
+        kernel.flags.writeable = False
+        with self.lock:
+            if key not in self.entries and self.fits(kernel.nbytes):
+                self.entries[key] = kernel
+                self.nbytes += kernel.nbytes
+                self.evict()
+        return kernel
+
+    ################################################################################
+
+    """
+    evict
+    Drop the least recently used kernels until the total size is within maxBytes.
+    """
+    def evict(self):
+        with self.lock:
+            while self.nbytes > self.maxBytes and self.entries:
+                key, kernel = self.entries.popitem(last=False)
+                self.nbytes -= kernel.nbytes
+
+    ################################################################################
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    ################################################################################
+
+    def __repr__(self):
+        return ("KernelCache(entries=" + str(len(self.entries)) + ", bytes=" + str(self.nbytes)
+                + ", hits=" + str(self.hits) + ", misses=" + str(self.misses) + ")")
+
+###############################################################################
+
+# the cache shared by the model, accessibility and analytics code
+kernelCache = KernelCache(kernelCacheMaxBytes)
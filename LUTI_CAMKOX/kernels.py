@@ -0,0 +1,178 @@
+"""
+kernels.py
+
+Compute kernels of the model with an optional Numba backend: the predicted
+flows and their statistics, the mean trip cost, the probabilities and the
+accessibility. The Numba kernels are fused loops over the origin rows, run in
+parallel with prange, so none of the m x n temporaries of the NumPy versions
+(exp kernels, Sij * cij products, placeholders) are allocated.
+The backend is chosen at runtime with kernelBackend in globals: 'auto' uses
+Numba if it is installed, 'numba' asks for it (falling back to NumPy with a
+warning if it is not installed) and 'numpy' never uses it.
+"""
+import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from LUTI_CAMKOX.globals import kernelBackend
+
+if numba is not None:
+    prange = numba.prange
+    jit = numba.njit(parallel=True, cache=True)
+else:
+    prange = range
+    jit = None
+
+warnedNoNumba = False
+
+###############################################################################
+
+"""
+useNumba
+@param backend 'auto', 'numba' or 'numpy' (default kernelBackend in globals)
+@returns True if the Numba kernels are to be used
+"""
+def useNumba(backend=None):
+    global warnedNoNumba
+    backend = kernelBackend if backend is None else backend
+    assert backend in ('auto', 'numba', 'numpy'), "FATAL: unknown kernel backend " + str(backend) + ", use 'auto', 'numba' or 'numpy'"
+    if backend == 'numpy':
+        return False
+    if numba is None:
+        if backend == 'numba' and not warnedNoNumba:
+            print("WARNING: numba is not installed, using the numpy kernels")
+            warnedNoNumba = True
+        return False
+    return True
+
+###############################################################################
+
+"""
+flowsLoop
+Fused loop version of QUANTLHModel.evaluateFlows (see there for the model and
+the statistics). The rows are split into nChunks ranges run in parallel, each
+with its own partial column sums.
+@param cij (n_modes, m, n) costs
+@param Ei, Aj float64 vectors
+@param mBeta -Beta, one per mode
+@param sink (n_modes, m, n) array for Sij, written if writeSink
+@returns Ni, Mi, Dj, Nc2 the row numerators and denominators of CBar, the
+    column sums and the sum of Sij * cij^2
+"""
+def flowsLoop(cij, Ei, Aj, mBeta, sink, writeSink, derivatives, nChunks):
+    n_modes, m, n = cij.shape
+    Ni = np.zeros((n_modes, m))
+    Mi = np.zeros((n_modes, m))
+    Nc2i = np.zeros((n_modes, m))
+    DjChunks = np.zeros((nChunks, n_modes, n))
+    for c in prange(nChunks):
+        row = np.empty((n_modes, n))
+        for i in range(c * m // nChunks, (c + 1) * m // nChunks):
+            denom = 0.0
+            for k in range(n_modes):
+                for j in range(n):
+                    e = Aj[j] * np.exp(mBeta[k] * cij[k, i, j])
+                    row[k, j] = e
+                    denom += e
+            scale = Ei[i] / denom
+            for k in range(n_modes):
+                for j in range(n):
+                    s = row[k, j] * scale
+                    c_ij = cij[k, i, j]
+                    Ni[k, i] += s * c_ij
+                    Mi[k, i] += s
+                    DjChunks[c, k, j] += s
+                    if derivatives:
+                        Nc2i[k, i] += s * c_ij * c_ij
+                    if writeSink:
+                        sink[k, i, j] = s
+    return Ni, Mi, DjChunks.sum(axis=0), Nc2i.sum(axis=1)
+
+###############################################################################
+
+"""
+cbarLoop
+Fused loop version of QUANTLHModel.computeCBar for (n_modes, m, n) tensors
+"""
+def cbarLoop(Sij, cij):
+    n_modes, m, n = Sij.shape
+    Ni = np.zeros((n_modes, m))
+    Mi = np.zeros((n_modes, m))
+    for i in prange(m):
+        for k in range(n_modes):
+            for j in range(n):
+                Ni[k, i] += Sij[k, i, j] * cij[k, i, j]
+                Mi[k, i] += Sij[k, i, j]
+    return Ni.sum(axis=1) / Mi.sum(axis=1)
+
+###############################################################################
+
+"""
+probabilitiesLoop
+Fused loop version of QUANTLHModel.computeProbabilities3modes for a
+(n_modes, m, n) tensor: each row divided by its sum, rows summing to zero or
+less are divided by one instead.
+"""
+def probabilitiesLoop(Sij, out):
+    n_modes, m, n = Sij.shape
+    for i in prange(m):
+        for k in range(n_modes):
+            total = 0.0
+            for j in range(n):
+                total += Sij[k, i, j]
+            if total <= 0:
+                total = 1.0
+            for j in range(n):
+                out[k, i, j] = Sij[k, i, j] / total
+    return out
+
+###############################################################################
+
+"""
+accessibilityLoop
+Fused loop version of accessibility.accessibility: Ai[i] = sum over j of Dj[j] / cij[i,j]^2
+"""
+def accessibilityLoop(Dj, cij):
+    m, n = cij.shape
+    Ai = np.zeros(m)
+    for i in prange(m):
+        total = 0.0
+        for j in range(n):
+            total += Dj[j] / (cij[i, j] * cij[i, j])
+        Ai[i] = total
+    return Ai
+
+###############################################################################
+
+if jit is not None:
+    flowsNumba = jit(flowsLoop)
+    cbarNumba = jit(cbarLoop)
+    probabilitiesNumba = jit(probabilitiesLoop)
+    accessibilityNumba = jit(accessibilityLoop)
+
+###############################################################################
+
+"""
+setThreads
+Set the number of threads of the Numba kernels (at most the number Numba was
+started with).
+"""
+def setThreads(threads):
+    numba.set_num_threads(max(1, min(threads, numba.config.NUMBA_NUM_THREADS)))
+
+###############################################################################
+
+"""
+flows
+Run the Numba flow kernel (see flowsLoop) on threads threads.
+@param sink optional (n_modes, m, n) array (or memory mapped file) to write Sij into
+"""
+def flows(cij, Ei, Aj, Beta, sink=None, derivatives=False, threads=1):
+    setThreads(threads)
+    mBeta = -np.asarray(Beta, dtype=float)
+    writeSink = sink is not None
+    sink = np.asarray(sink) if writeSink else np.empty((0, 0, 0))
+    return flowsNumba(np.asarray(cij), np.asarray(Ei, dtype=float), np.asarray(Aj, dtype=float),
+                      mBeta, sink, writeSink, derivatives, max(1, min(threads, cij.shape[1])))
@@ -18,10 +18,15 @@ from geojson import dump
 
 from LUTI_CAMKOX.globals import *
 from LUTI_CAMKOX.maps import *
-from LUTI_CAMKOX.utils import loadQUANTMatrix, loadMatrix, saveMatrix
+from LUTI_CAMKOX.utils import zoneIndices, listHash, saveOutputMatrix
+from LUTI_CAMKOX.matrixcache import MatrixCache
+from LUTI_CAMKOX.ingest import IngestJob, ingestQUANTMatrices
 from LUTI_CAMKOX.databuilder import ensureFile
 from LUTI_CAMKOX.quantjobsmodel import QUANTJobsModel
+from LUTI_CAMKOX.accessibility import accessibility, accessibilityGrid, scaleTo100
+from LUTI_CAMKOX.kernelcache import kernelCache
 from LUTI_CAMKOX.analytics import flowArrowsGeoJSON
+from LUTI_CAMKOX.asyncwriter import AsyncWriter
 
 
 def start_main(inputs, outputs):
@@ -57,155 +62,47 @@ def start_main(inputs, outputs):
     zonecodes_EWS = pd.read_csv(os.path.join(modelRunsDir,ZoneCodesFilename))
     zonecodes_EWS.set_index('areakey')
     zonecodes_EWS_list = zonecodes_EWS['areakey'].tolist()
+    CAMKOX_zone_idx = zoneIndices(zonecodes_EWS_list, CAMKOX_MSOA_list) # positions of the CAMKOX MSOAs in the EWS QUANT matrices
+    CAMKOX_zones_hash = listHash(CAMKOX_MSOA_list) # part of the matrix cache keys
 
     #_____________________________________________________________________________________
-    # IMPORT cij QUANT matrices
-    # ROADS cij
+    # IMPORT cij and SObs QUANT matrices
+    # Each CAMKOX matrix is taken from the matrix cache, keyed by the hash of the QUANT file, the
+    # zone list and the transform applied, so it is only rebuilt when one of those changes.
+    # Missing matrices are built in parallel (see ingestWorkers and ingestMemoryLimit in globals).
     print()
-    print("Importing QUANT roads cij for CAMKOX and London")
-
-    if not os.path.isfile(os.path.join(modelRunsDir,QUANTCijRoadMinFilename_CAMKOX)):
-        # load cost matrix, time in minutes between MSOA zones for roads:
-        cij_road_EWS = loadQUANTMatrix(inputs["QUANTCijRoadMinFilename"])
-        cij_road_EWS_df = pd.DataFrame(cij_road_EWS, index=zonecodes_EWS_list, columns=zonecodes_EWS_list) # turn the numpy array into a pd dataframe, (index and columns: MSOA codes)
-        cij_road_CAMKOX_df = cij_road_EWS_df[CAMKOX_MSOA_list]  # Create CAMKOX df filtering EWS columns
-        cij_road_CAMKOX_df = cij_road_CAMKOX_df.loc[CAMKOX_MSOA_list]  # Filter rows
-        cij_road_CAMKOX = cij_road_CAMKOX_df.to_numpy()  # numpy matrix for CAMKOX (same format as utils loadQUANTMatrix)
-        cij_road_CAMKOX[cij_road_CAMKOX < 1] = 1  # lower limit of 1 minute links
-        saveMatrix(cij_road_CAMKOX, os.path.join(modelRunsDir,QUANTCijRoadMinFilename_CAMKOX))
-        # save as csv file
-        np.savetxt(os.path.join(modelRunsDir, "cij_road_CAMKOX.csv"), cij_road_CAMKOX, delimiter=",")
-    else:
-        cij_road_CAMKOX = loadMatrix(os.path.join(modelRunsDir,QUANTCijRoadMinFilename_CAMKOX))
-        print('cij roads shape: ', cij_road_CAMKOX.shape)
+    print("Importing QUANT cij and SObs matrices for CAMKOX and London")
+    cache = MatrixCache(matrixCacheDir, matrixCacheMaxBytes)
+    jobs = [
+        # cost matrices, time in minutes between MSOA zones for roads, bus and ferries network, railways 2021 and 2050 (with consideration of new rail route)
+        IngestJob("cij_road", inputs["QUANTCijRoadMinFilename"], QUANTCijRoadMinFilename_CAMKOX, min_cost=1, csvFilename="cij_road_CAMKOX.csv"),
+        IngestJob("cij_bus", inputs["QUANTCijBusMinFilename"], QUANTCijBusMinFilename_CAMKOX, min_cost=1, csvFilename="cij_bus_CAMKOX.csv"),
+        IngestJob("cij_rail_2021", inputs["QUANTCijRailMinFilename2021"], QUANTCijRailMinFilename2021_CAMKOX, min_cost=1, csvFilename="cij_rail_CAMKOX_2021.csv"),
+        IngestJob("cij_rail_2050", inputs["QUANTCijRailMinFilename2050"], QUANTCijRailMinFilename2050_CAMKOX, min_cost=1, csvFilename="cij_rail_CAMKOX_2050.csv"),
+        # observed trips (these are loaded by the model for calibration from the files in model-runs)
+        IngestJob("SObs_road", inputs["SObsRoadFilename"], SObsRoadFilename_CAMKOX),
+        IngestJob("SObs_bus", inputs["SObsBusFilename"], SObsBusFilename_CAMKOX),
+        IngestJob("SObs_rail", inputs["SObsRailFilename"], SObsRailFilename_CAMKOX),
+    ]
+    matrices = ingestQUANTMatrices(jobs, cache, CAMKOX_zone_idx, CAMKOX_zones_hash)
+
+    cij_road_CAMKOX = matrices["cij_road"]
+    cij_bus_CAMKOX = matrices["cij_bus"]
+    cij_rail_CAMKOX_2021 = matrices["cij_rail_2021"]
+    cij_rail_CAMKOX_2050 = matrices["cij_rail_2050"]
+    print('cij roads shape: ', cij_road_CAMKOX.shape)
+    print('cij bus shape: ', cij_bus_CAMKOX.shape)
+    print('2021 cij rail shape: ', cij_rail_CAMKOX_2021.shape)
+    print('2050 cij rail shape: ', cij_rail_CAMKOX_2050.shape)
 
     # Export cij matrices for checking
     # np.savetxt(os.path.join(modelRunsDir,'debug_cij_roads.csv'), cij_road_CAMKOX, delimiter=',', fmt='%i')
 
-    #_____________________________________________________________________________________
-    # BUS & FERRIES cij
-    print()
-    print("Importing QUANT bus cij for CAMKOX and London")
-
-    if not os.path.isfile(os.path.join(modelRunsDir,QUANTCijBusMinFilename_CAMKOX)):
-        # load cost matrix, time in minutes between MSOA zones for bus and ferries network:
-        cij_bus_EWS = loadQUANTMatrix(inputs["QUANTCijBusMinFilename"])
-        cij_bus_EWS_df = pd.DataFrame(cij_bus_EWS, index=zonecodes_EWS_list, columns=zonecodes_EWS_list) # turn the numpy array into a pd dataframe, (index and columns: MSOA codes)
-        cij_bus_CAMKOX_df = cij_bus_EWS_df[CAMKOX_MSOA_list]  # Create CAMKOX df filtering EWS columns
-        cij_bus_CAMKOX_df = cij_bus_CAMKOX_df.loc[CAMKOX_MSOA_list]  # Filter rows
-        cij_bus_CAMKOX = cij_bus_CAMKOX_df.to_numpy()  # numpy matrix for CAMKOX (same format as utils loadQUANTMatrix)
-        cij_bus_CAMKOX[cij_bus_CAMKOX < 1] = 1  # lower limit of 1 minute links
-        saveMatrix(cij_bus_CAMKOX, os.path.join(modelRunsDir, QUANTCijBusMinFilename_CAMKOX))
-        # save as csv file
-        np.savetxt(os.path.join(modelRunsDir, "cij_bus_CAMKOX.csv"), cij_bus_CAMKOX, delimiter=",")
-    else:
-        cij_bus_CAMKOX = loadMatrix(os.path.join(modelRunsDir,QUANTCijBusMinFilename_CAMKOX))
-        print('cij bus shape: ', cij_bus_CAMKOX.shape)
-
-    # Export cij matrices for checking
-    # np.savetxt(os.path.join(modelRunsDir,'debug_cij_bus.csv'), cij_bus_CAMKOX, delimiter=',', fmt='%i')
-
-    #_____________________________________________________________________________________
-    # RAILWAYS cij
-    print()
-    print("Importing 2021 & 2050 QUANT rail cij for CAMKOX and London")
-    
-    # load matrices for 2021
-    if not os.path.isfile(os.path.join(modelRunsDir,QUANTCijRailMinFilename2021_CAMKOX)):
-        # load cost matrix, time in minutes between MSOA zones for railways:
-        cij_rail_EWS_2021 = loadQUANTMatrix(inputs["QUANTCijRailMinFilename2021"])
-        cij_rail_EWS_df_2021 = pd.DataFrame(cij_rail_EWS_2021, index=zonecodes_EWS_list, columns=zonecodes_EWS_list) # turn the numpy array into a pd dataframe, (index and columns: MSOA codes)
-        cij_rail_CAMKOX_df_2021 = cij_rail_EWS_df_2021[CAMKOX_MSOA_list]  # Create CAMKOX df filtering EWS columns
-        cij_rail_CAMKOX_df_2021 = cij_rail_CAMKOX_df_2021.loc[CAMKOX_MSOA_list]  # Filter rows
-        cij_rail_CAMKOX_2021 = cij_rail_CAMKOX_df_2021.to_numpy()  # numpy matrix for CAMKOX (same format as utils loadQUANTMatrix)
-        cij_rail_CAMKOX_2021[cij_rail_CAMKOX_2021 < 1] = 1  # lower limit of 1 minute links
-        saveMatrix(cij_rail_CAMKOX_2021, os.path.join(modelRunsDir, QUANTCijRailMinFilename2021_CAMKOX))
-        # save as csv file
-        np.savetxt(os.path.join(modelRunsDir, "cij_rail_CAMKOX_2021.csv"), cij_rail_CAMKOX_2021, delimiter=",")
-    else:
-        cij_rail_CAMKOX_2021 = loadMatrix(os.path.join(modelRunsDir,QUANTCijRailMinFilename2021_CAMKOX))
-        print('2021 cij rail shape: ', cij_rail_CAMKOX_2021.shape)
-        
-    # load matrices for 2050 (with consideration of new rail route)
-    if not os.path.isfile(os.path.join(modelRunsDir,QUANTCijRailMinFilename2050_CAMKOX)):
-        # load cost matrix, time in minutes between MSOA zones for railways:
-        cij_rail_EWS_2050 = loadQUANTMatrix(inputs["QUANTCijRailMinFilename2050"])
-        cij_rail_EWS_df_2050 = pd.DataFrame(cij_rail_EWS_2050, index=zonecodes_EWS_list, columns=zonecodes_EWS_list) # turn the numpy array into a pd dataframe, (index and columns: MSOA codes)
-        cij_rail_CAMKOX_df_2050 = cij_rail_EWS_df_2050[CAMKOX_MSOA_list]  # Create CAMKOX df filtering EWS columns
-        cij_rail_CAMKOX_df_2050 = cij_rail_CAMKOX_df_2050.loc[CAMKOX_MSOA_list]  # Filter rows
-        cij_rail_CAMKOX_2050 = cij_rail_CAMKOX_df_2050.to_numpy()  # numpy matrix for CAMKOX (same format as utils loadQUANTMatrix)
-        cij_rail_CAMKOX_2050[cij_rail_CAMKOX_2050 < 1] = 1  # lower limit of 1 minute links
-        saveMatrix(cij_rail_CAMKOX_2050, os.path.join(modelRunsDir, QUANTCijRailMinFilename2050_CAMKOX))
-        # save as csv file
-        np.savetxt(os.path.join(modelRunsDir, "cij_rail_CAMKOX_2050.csv"), cij_rail_CAMKOX_2050, delimiter=",")
-    else:
-        cij_rail_CAMKOX_2050 = loadMatrix(os.path.join(modelRunsDir,QUANTCijRailMinFilename2050_CAMKOX))
-        print('2050 cij rail shape: ', cij_rail_CAMKOX_2050.shape)
-
-    # Export cij matrices for checking
-    # np.savetxt(os.path.join(modelRunsDir,'debug_cij_rail.csv'), cij_rail_CAMKOX, delimiter=',', fmt='%i')
-
-    print()
-    print("Importing 2021 & 2050 QUANT cij matrices completed.")
-    print()
-    #_____________________________________________________________________________________
-
-    # IMPORT SObs QUANT matrices: observed trips
-    print("Importing SObs matrices")
-
-    # SObs ROADS
     print()
-    print("Importing SObs for roads for CAMKOX and London")
-
-    if not os.path.isfile(os.path.join(modelRunsDir,SObsRoadFilename_CAMKOX)):
-        # load observed trips matrix for roads:
-        SObs_road_EWS = loadQUANTMatrix(inputs["SObsRoadFilename"])
-        SObs_road_EWS_df = pd.DataFrame(SObs_road_EWS, index=zonecodes_EWS_list, columns=zonecodes_EWS_list) # turn the numpy array into a pd dataframe, (index and columns: MSOA codes)
-        SObs_road_CAMKOX_df = SObs_road_EWS_df[CAMKOX_MSOA_list]  # Create CAMKOX df filtering EWS columns
-        SObs_road_CAMKOX_df = SObs_road_CAMKOX_df.loc[CAMKOX_MSOA_list]  # Filter rows
-        SObs_road_CAMKOX = SObs_road_CAMKOX_df.to_numpy()  # numpy matrix for CAMKOX (same format as utils loadQUANTMatrix)
-        saveMatrix(SObs_road_CAMKOX, os.path.join(modelRunsDir, SObsRoadFilename_CAMKOX))
-    # else:
-    #     SObs_road_CAMKOX = loadMatrix(os.path.join(modelRunsDir,SObsRoadFilename_CAMKOX))
-    #     print('Sobs road shape: ', SObs_road_CAMKOX.shape)
-    #_____________________________________________________________________________________
-
-    # SObs BUS & FERRIES
-    print()
-    print("Importing SObs for bus & ferries for CAMKOX and London")
-
-    if not os.path.isfile(os.path.join(modelRunsDir,SObsBusFilename_CAMKOX)):
-        # load observed trips matrix for bus and ferries:
-        SObs_bus_EWS = loadQUANTMatrix(inputs["SObsBusFilename"])
-        SObs_bus_EWS_df = pd.DataFrame(SObs_bus_EWS, index=zonecodes_EWS_list, columns=zonecodes_EWS_list)  # turn the numpy array into a pd dataframe, (index and columns: MSOA codes)
-        SObs_bus_CAMKOX_df = SObs_bus_EWS_df[CAMKOX_MSOA_list]  # Create CAMKOX df filtering EWS columns
-        SObs_bus_CAMKOX_df = SObs_bus_CAMKOX_df.loc[CAMKOX_MSOA_list]  # Filter rows
-        SObs_bus_CAMKOX = SObs_bus_CAMKOX_df.to_numpy()  # numpy matrix for CAMKOX (same format as utils loadQUANTMatrix)
-        saveMatrix(SObs_bus_CAMKOX, os.path.join(modelRunsDir,SObsBusFilename_CAMKOX))
-    # else:
-    #     SObs_bus_CAMKOX = loadMatrix(os.path.join(modelRunsDir,SObsBusFilename_CAMKOX))
-    #     print('Sobs bus shape: ', SObs_bus_CAMKOX.shape)
-    #_____________________________________________________________________________________
-
-    # SObs RAIL
+    print("Importing 2021 & 2050 QUANT cij and SObs matrices completed.")
     print()
-    print("Importing SObs for rail for CAMKOX and London")
-
-    if not os.path.isfile(os.path.join(modelRunsDir,SObsRailFilename_CAMKOX)):
-        # load observed trips matrix for rails:
-        SObs_rail_EWS = loadQUANTMatrix(inputs["SObsRailFilename"])
-        SObs_rail_EWS_df = pd.DataFrame(SObs_rail_EWS, index=zonecodes_EWS_list, columns=zonecodes_EWS_list)  # turn the numpy array into a pd dataframe, (index and columns: MSOA codes)
-        SObs_rail_CAMKOX_df = SObs_rail_EWS_df[CAMKOX_MSOA_list]  # Create CAMKOX df filtering EWS columns
-        SObs_rail_CAMKOX_df = SObs_rail_CAMKOX_df.loc[CAMKOX_MSOA_list]  # Filter rows
-        SObs_rail_CAMKOX = SObs_rail_CAMKOX_df.to_numpy()  # numpy matrix for CAMKOX (same format as utils loadQUANTMatrix)
-        saveMatrix(SObs_rail_CAMKOX, os.path.join(modelRunsDir,SObsRailFilename_CAMKOX))
-    # else:
-    #     SObs_rail_CAMKOX = loadMatrix(os.path.join(modelRunsDir,SObsRailFilename_CAMKOX))
-    #     print('Sobs bus shape: ', SObs_rail_CAMKOX.shape)
-    #     print()
     #_____________________________________________________________________________________
 
-
     # now run the relevant models to produce the outputs
     runNewHousingDev(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX_2021, cij_rail_CAMKOX_2050, inputs, outputs)
 
@@ -243,9 +140,16 @@ New housing development scenario:
 """
 
 def runNewHousingDev(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX_2021, cij_rail_CAMKOX_2050, inputs, outputs):
+    # The outputs are written in the background while the next model runs (see asyncwriter.py),
+    # they are all on disk when the with block ends
+    with AsyncWriter() as writer:
+        runNewHousingDevModels(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX_2021, cij_rail_CAMKOX_2050, inputs, outputs, writer)
+    print("Impedance kernels:", kernelCache)
+
+def runNewHousingDevModels(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX_2021, cij_rail_CAMKOX_2050, inputs, outputs, writer):
     # First run the base model to calibrate it with 2011 observed trip data:
     # Run Journey to work model:
-    beta_2021, DjPred_JtW_2021 = runJourneyToWorkModel(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX_2021, inputs, outputs)
+    beta_2021, DjPred_JtW_2021 = runJourneyToWorkModel(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX_2021, inputs, outputs, writer=writer)
 
     # CAMKOX new housing development scenario:
     # base year: 2021, projection year: 2050
@@ -275,10 +179,10 @@ def runNewHousingDev(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_C
     NS_NewHousingPop_2050 = NS_NewHousingDev_table_2050[['Area Description', 'NS_NewPop_2021_2050']] # drop the n of houses column
 
     # Now run the JtW model with 2011 beta and updated pop (without calibration)
-    #New Housing Development - Expansion
-    beta_2021, DjPred_JtW_2050 = runJourneyToWorkModel(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX_2050, inputs, outputs, 'NewHousingDev_Expand_2050', NewHousingPop_2050, beta_2021)
-    #New Housing Development - New Settlement
-    beta_2021, DjPred_JtW_2050 = runJourneyToWorkModel(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX_2050, inputs, outputs, 'NewHousingDev_NewSettle_2050', NS_NewHousingPop_2050, beta_2021)
+    # Both scenarios use the 2050 cost matrices and the same Betas, so they are run together
+    # New Housing Development - Expansion and New Settlement
+    Scenarios_2050 = [('NewHousingDev_Expand_2050', NewHousingPop_2050), ('NewHousingDev_NewSettle_2050', NS_NewHousingPop_2050)]
+    DjPred_JtW_2050, NS_DjPred_JtW_2050 = runJourneyToWorkScenarios(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX_2050, inputs, outputs, Scenarios_2050, beta_2021, writer)
 
 
 # Areas abbreviations for models' data:
@@ -293,11 +197,13 @@ def runNewHousingDev(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_C
 """
 runJourneyToWorkModel
 Origins: workplaces, Destinations: households' population
+@param writer optional AsyncWriter to write the outputs in the background, else they are written before returning
 """
 # Journey to work model with households (HH) number of dwellings as attractor
-def runJourneyToWorkModel(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX, inputs, outputs, Scenario='2021', Scenario_pop_table=None, Beta_calibrated=None):
+def runJourneyToWorkModel(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX, inputs, outputs, Scenario='2021', Scenario_pop_table=None, Beta_calibrated=None, writer=None):
     print("Running Journey to Work ", Scenario, " model.")
     start = time.perf_counter()
+    writer = AsyncWriter(workers=0) if writer is None else writer
     # Singly constrained model:
     # conserve the number of jobs and predict the population residing in MSOA zones
     # journeys to work generated by jobs
@@ -314,81 +220,7 @@ def runJourneyToWorkModel(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_
      attractor:     Number of dwellings     
     """
 
-    # Now run the model with or without calibration according to the scenario:
-    # Data is transformed from 2021 MSOA to 2011 MSOA by Excel lookup with area filtered
-    if not os.path.isfile(data_census_TS007_CAMKOX):
-        data_census_TS007_CAMKOX_df = pd.read_csv(inputs["DataCensusTS007"], index_col='geography code')
-        data_census_TS007_CAMKOX_df['geography code'] = data_census_TS007_CAMKOX_df.index # turn the index (i.e. MSOA codes) back into a columm
-        data_census_TS007_CAMKOX_df.reset_index(drop=True, inplace=True)
-        data_census_TS007_CAMKOX_df.to_csv(data_census_TS007_CAMKOX)
-
-    HHZones, HHAttractors = QUANTJobsModel.loadEmploymentData_HHAttractiveness(data_census_TS007_CAMKOX, inputs["DwellingsCAMKOX"], Scenario)
-    # if we are running a scenario, update the HHZones with the new population
-    if Scenario == '2021':
-        dfEi = pd.read_csv(inputs["Employment2021"])  # select the columns that I need from file
-        dfEi.rename(columns={'geography code': 'msoa', 'Occupation (current): Total': 'employment_tot'}, inplace=True)
-        # drop columns:
-        dfEi = dfEi[['msoa','employment_tot']]
-        jobs = dfEi.join(other=zonecodes_EWS.set_index('areakey'), on='msoa')  # this codes dfEi by zonei
-        jobs.to_csv(data_jobs_employment) # save file to csv in model-runs directory
-
-        HHZones.to_csv(data_HH_zones_2021)  # save file to csv in model-runs directory
-        HHAttractors.to_csv(data_HH_attractors_2021)  # save file to csv in model-runs directory
-
-        HHZones = HHZones[['zonei', 'Population_tot']]
-        HHAttractors = HHAttractors[['zonei', 'N_of_Dwellings']]
-
-    elif Scenario == 'NewHousingDev_Expand_2050':
-        dfEi = pd.read_csv(inputs["Employment2050"])  # select the columns that I need from file
-        dfEi.rename(columns={'Jobs': 'employment_tot'}, inplace=True)
-        jobs = dfEi.join(other=zonecodes_EWS.set_index('areakey'), on='msoa')  # this codes dfEi by zonei
-
-        # Rename Scenario_pop_table's columns:
-        Scenario_pop_table.rename(columns={'Area Description':'zonei'}, inplace=True)
-
-        # Update the population with the 2050 projection
-        HHZones = HHZones.join(Scenario_pop_table.set_index('zonei'), on=['zonei'])
-        HHZones['NewPop_2021_2050'] = HHZones['NewPop_2021_2050'].fillna(0)  # Replace NaN with 0
-        HHZones['Population_tot'] = HHZones['Population_tot'] + HHZones['NewPop_2021_2050']
-        HHZones = HHZones[['zonei', 'Population_tot']]
-
-        # Update the number of dwellings with the 2050 projection
-        NewHousingDev_table_2050 = pd.read_csv(inputs["CAMKOXNewHousingDev"], usecols=['Area Description', 'Tot_Alloc_E'])  # for 2050 read the entry up to year 2031
-        NewHousingDev_table_2050.rename(columns={'Area Description': 'zonei', 'Tot_Alloc_E': 'Expansion_2021_2050'}, inplace=True)
-
-        HHAttractors = HHAttractors.join(NewHousingDev_table_2050.set_index('zonei'), on=['zonei'])  # Join the Attractors df with the new houses df
-        HHAttractors['Expansion_2021_2050'] = HHAttractors['Expansion_2021_2050'].fillna(0)  # Replace NaN with 0
-        HHAttractors['N_of_Dwellings'] = HHAttractors['N_of_Dwellings'] + HHAttractors['Expansion_2021_2050']
-        HHAttractors = HHAttractors[['zonei', 'N_of_Dwellings']]
-
-        HHZones.to_csv(data_HH_zones_2050)  # save file to csv in model-runs directory
-        HHAttractors.to_csv(data_HH_attractors_2050)  # save file to csv in model-runs directory
-    
-    elif Scenario == 'NewHousingDev_NewSettle_2050':
-        dfEi = pd.read_csv(inputs["Employment2050"])  # select the columns that I need from file
-        dfEi.rename(columns={'Jobs': 'employment_tot'}, inplace=True)
-        jobs = dfEi.join(other=zonecodes_EWS.set_index('areakey'), on='msoa')  # this codes dfEi by zonei
-
-        # Rename Scenario_pop_table's columns:
-        Scenario_pop_table.rename(columns={'Area Description':'zonei'}, inplace=True)
-
-        # Update the population with the 2050 projection
-        HHZones = HHZones.join(Scenario_pop_table.set_index('zonei'), on=['zonei'])
-        HHZones['NS_NewPop_2021_2050'] = HHZones['NS_NewPop_2021_2050'].fillna(0)  # Replace NaN with 0
-        HHZones['Population_tot'] = HHZones['Population_tot'] + HHZones['NS_NewPop_2021_2050']
-        HHZones = HHZones[['zonei', 'Population_tot']]
-
-        # Update the number of dwellings with the 2050 projection
-        NS_NewHousingDev_table_2050 = pd.read_csv(inputs["CAMKOXNewHousingDev"], usecols=['Area Description', 'Tot_Alloc_N'])  # for 2050 read the entry up to year 2031
-        NS_NewHousingDev_table_2050.rename(columns={'Area Description': 'zonei', 'Tot_Alloc_N': 'NS_Newhouses_2021_2050'}, inplace=True)
-
-        HHAttractors = HHAttractors.join(NS_NewHousingDev_table_2050.set_index('zonei'), on=['zonei'])  # Join the Attractors df with the new houses df
-        HHAttractors['NS_Newhouses_2021_2050'] = HHAttractors['NS_Newhouses_2021_2050'].fillna(0)  # Replace NaN with 0
-        HHAttractors['N_of_Dwellings'] = HHAttractors['N_of_Dwellings'] + HHAttractors['NS_Newhouses_2021_2050']
-        HHAttractors = HHAttractors[['zonei', 'N_of_Dwellings']]
-
-        HHZones.to_csv(NS_data_HH_zones_2050)  # save file to csv in model-runs directory
-        HHAttractors.to_csv(NS_data_HH_attractors_2050)  # save file to csv in model-runs directory
+    jobs, HHZones, HHAttractors = loadJourneyToWorkData(zonecodes_EWS, inputs, Scenario, Scenario_pop_table)
 
     # Now run the model with or without calibration according to the scenario:
     if Scenario == '2021':
@@ -406,89 +238,74 @@ def runJourneyToWorkModel(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_
         Tij, beta_k, cbar_k = model.run3modes() # run the model with 3 modes + calibration
 
         # Compute the probability of a flow from an MSOA zone to any (i.e. all) of the possible point zones.
-        jobs_probTij = model.computeProbabilities3modes(Tij)
+        # (lazily: each mode is computed when it is saved, so only one probability matrix is in memory)
+        jobs_probTij = Tij.probabilities
 
         # Jobs accessibility:
         # Job accessibility is the distribution of population around a job location.
+        # Housing accessibility is the distribution of jobs around a housing location.
+        # Both, for all the modes, in one call over the cached impedance kernels (see accessibility.py)
 
-        DjPred_road = Tij[0].sum(axis=1)
-        Ji_road = Calculate_Job_Accessibility(DjPred_road, cij_road_CAMKOX)
-
-        DjPred_bus = Tij[1].sum(axis=1)
-        Ji_bus = Calculate_Job_Accessibility(DjPred_bus, cij_bus_CAMKOX)
-
-        DjPred_rail = Tij[2].sum(axis=1)
-        Ji_rail = Calculate_Job_Accessibility(DjPred_rail, cij_rail_CAMKOX)
+        DjPred_k = Tij.rowSums  # residential totals per mode
+        OiPred_k = Tij.columnSums  # employment totals per mode
+        Ji, Hi = scaleTo100(accessibilityGrid([DjPred_k, OiPred_k], model.cij, [accessibilityMeasure])[0])
+        Ji_road, Ji_bus, Ji_rail = Ji
 
         # Save output:
         Jobs_accessibility_df = pd.DataFrame( {'areakey': CAMKOX_MSOA_list, 'JAcar21': Ji_road, 'JAbus21': Ji_bus, 'JArail21': Ji_rail})
-        Jobs_accessibility_df.to_csv(outputs["JobsAccessibility2021"])
+        writer.submit(Jobs_accessibility_df.to_csv, outputs["JobsAccessibility2021"])
 
         # Housing Accessibility:
-        # Housing accessibility is the distribution of jobs around a housing location.
-
-        OiPred_road = Tij[0].sum(axis=0)
-        Hi_road = Calculate_Housing_Accessibility(OiPred_road, cij_road_CAMKOX)
-
-        OiPred_bus = Tij[1].sum(axis=0)
-        Hi_bus = Calculate_Housing_Accessibility(OiPred_bus, cij_bus_CAMKOX)
-
-        OiPred_rail = Tij[2].sum(axis=0)
-        Hi_rail = Calculate_Housing_Accessibility(OiPred_rail, cij_rail_CAMKOX)
+        Hi_road, Hi_bus, Hi_rail = Hi
 
         # Save output:
         Housing_accessibility_df = pd.DataFrame({'areakey': CAMKOX_MSOA_list, 'HAcar21': Hi_road, 'HAbus21': Hi_bus, 'HArail21': Hi_rail})
-        Housing_accessibility_df.to_csv(outputs["HousingAccessibility2021"])
+        writer.submit(Housing_accessibility_df.to_csv, outputs["HousingAccessibility2021"])
 
         # Create a Oi Dj table
-        jobs['DjPred_Car_21'] = Tij[0].sum(axis=1)
-        jobs['DjPred_Bus_21'] = Tij[1].sum(axis=1)
-        jobs['DjPred_Rail_21'] = Tij[2].sum(axis=1)
-        jobs['DjPred_Tot_21'] = Tij[0].sum(axis=1) + Tij[1].sum(axis=1) + Tij[2].sum(axis=1)
-        jobs['OiPred_Car_21'] = Tij[0].sum(axis=0)
-        jobs['OiPred_Bus_21'] = Tij[1].sum(axis=0)
-        jobs['OiPred_Rail_21'] = Tij[2].sum(axis=0)
-        jobs['OiPred_Tot_21'] = Tij[0].sum(axis=0) + Tij[1].sum(axis=0) + Tij[2].sum(axis=0)
+        jobs['DjPred_Car_21'] = Tij.rowSums[0]
+        jobs['DjPred_Bus_21'] = Tij.rowSums[1]
+        jobs['DjPred_Rail_21'] = Tij.rowSums[2]
+        jobs['DjPred_Tot_21'] = Tij.rowTotals
+        jobs['OiPred_Car_21'] = Tij.columnSums[0]
+        jobs['OiPred_Bus_21'] = Tij.columnSums[1]
+        jobs['OiPred_Rail_21'] = Tij.columnSums[2]
+        jobs['OiPred_Tot_21'] = Tij.columnTotals
         jobs['Job_accessibility_roads'] = Jobs_accessibility_df['JAcar21']
         jobs['Jobs_accessibility_bus'] = Jobs_accessibility_df['JAbus21']
         jobs['Jobs_accessibility_rail'] = Jobs_accessibility_df['JArail21']
         jobs['Housing_accessibility_roads'] = Housing_accessibility_df['HAcar21']
         jobs['Housing_accessibility_bus'] = Housing_accessibility_df['HAbus21']
         jobs['Housing_accessibility_rail'] = Housing_accessibility_df['HArail21']
-        jobs.to_csv(outputs["JobsDjOi2021"])
+        writer.submit(jobs.to_csv, outputs["JobsDjOi2021"])
 
-        # Save output matrices
+        # Save output matrices (in the background if writer has worker threads)
         print("Saving output matrices...")
 
         # Probabilities:
-        np.savetxt(outputs["JobsProbTijRoads2021"], jobs_probTij[0], delimiter=",")
-        np.savetxt(outputs["JobsProbTijBus2021"], jobs_probTij[1], delimiter=",")
-        np.savetxt(outputs["JobsProbTijRail2021"], jobs_probTij[2], delimiter=",")
+        writer.submit(saveProbabilities, jobs_probTij, 0, outputs["JobsProbTijRoads2021"])
+        writer.submit(saveProbabilities, jobs_probTij, 1, outputs["JobsProbTijBus2021"])
+        writer.submit(saveProbabilities, jobs_probTij, 2, outputs["JobsProbTijRail2021"])
 
         # People flows
-        np.savetxt(outputs["JobsTijRoads2021"], Tij[0], delimiter=",")
-        np.savetxt(outputs["JobsTijBus2021"], Tij[1], delimiter=",")
-        np.savetxt(outputs["JobsTijRail2021"], Tij[2], delimiter=",")
+        writer.submit(saveOutputMatrix, Tij[0], outputs["JobsTijRoads2021"])
+        writer.submit(saveOutputMatrix, Tij[1], outputs["JobsTijBus2021"])
+        writer.submit(saveOutputMatrix, Tij[2], outputs["JobsTijRail2021"])
 
         # Geojson flows files - arrows
         flow_zonecodes = pd.read_csv(inputs["ZonesCoordinates"])
         flow_car = flowArrowsGeoJSON(Tij[0], flow_zonecodes)
-        with open(outputs["ArrowsFlowsCar2021"], 'w') as f:
-            dump(flow_car, f)
+        writer.submit(saveGeoJSON, flow_car, outputs["ArrowsFlowsCar2021"])
         flow_bus = flowArrowsGeoJSON(Tij[1], flow_zonecodes)
-        with open(outputs["ArrowsFlowsBus2021"], 'w') as f:
-            dump(flow_bus, f)
+        writer.submit(saveGeoJSON, flow_bus, outputs["ArrowsFlowsBus2021"])
         flow_rail = flowArrowsGeoJSON(Tij[2], flow_zonecodes)
-        with open(outputs["ArrowsFlowsRail2021"], 'w') as f:
-            dump(flow_rail, f)
+        writer.submit(saveGeoJSON, flow_rail, outputs["ArrowsFlowsRail2021"])
 
         print("JtW model", Scenario, "cbar [roads, bus, rail] = ", cbar_k)
         print("JtW model", Scenario, "beta [roads, bus, rail] = ", beta_k)
 
         # Calculate predicted population
-        DjPred = np.zeros(n)
-        for k in range(len(Tij)):
-            DjPred += Tij[k].sum(axis=1)
+        DjPred = Tij.rowTotals
         # Create a dataframe with Zone and people count
         DjPred = pd.DataFrame(DjPred, columns=['population'])
         DjPred['zonei'] = CAMKOX_MSOA_list
@@ -499,235 +316,263 @@ def runJourneyToWorkModel(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_
 
         return beta_k, DjPred
 
-    elif Scenario == 'NewHousingDev_Expand_2050':
-        # Use cij as cost matrix (MSOA to MSOA)
-        m, n = cij_road_CAMKOX.shape
-        model = QUANTJobsModel(m, n)
-        model.setAttractorsAj(HHAttractors, 'zonei', 'N_of_Dwellings')
-        model.setPopulationEi(jobs, 'zonei', 'employment_tot')
-        model.setCostMatrixCij(cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX)
-
-        Tij, cbar_k = model.run3modes_NoCalibration(Beta_calibrated)
-        # Compute the probability of a flow from an MSOA zone to any (i.e. all) of the possible point zones.
-        jobs_probTij = model.computeProbabilities3modes(Tij)
-
-        # Jobs accessibility:
-        DjPred_road = Tij[0].sum(axis=1)
-        Ji_road = Calculate_Job_Accessibility(DjPred_road, cij_road_CAMKOX)
-
-        DjPred_bus = Tij[1].sum(axis=1)
-        Ji_bus = Calculate_Job_Accessibility(DjPred_bus, cij_bus_CAMKOX)
-
-        DjPred_rail = Tij[2].sum(axis=1)
-        Ji_rail = Calculate_Job_Accessibility(DjPred_rail, cij_rail_CAMKOX)
-
-        # Save output:
-        Jobs_accessibility_df = pd.DataFrame({'areakey': CAMKOX_MSOA_list, 'JAcar50': Ji_road, 'JAbus50': Ji_bus, 'JArail50': Ji_rail})
-        Jobs_accessibility_df.to_csv(outputs["JobsAccessibility2050"])
-
-        # Housing Accessibility:
-        OiPred_road = Tij[0].sum(axis=0)
-        Hi_road = Calculate_Housing_Accessibility(OiPred_road, cij_road_CAMKOX)
+    else:
+        # 2050 scenarios (no calibration), see runJourneyToWorkScenarios to run several at once
+        DjPred = runJourneyToWorkScenarios(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX, inputs, outputs, [(Scenario, Scenario_pop_table)], Beta_calibrated, writer)[0]
 
-        OiPred_bus = Tij[1].sum(axis=0)
-        Hi_bus = Calculate_Housing_Accessibility(OiPred_bus, cij_bus_CAMKOX)
+        return Beta_calibrated, DjPred
 
-        OiPred_rail = Tij[2].sum(axis=0)
-        Hi_rail = Calculate_Housing_Accessibility(OiPred_rail, cij_bus_CAMKOX)
+"""
+loadJourneyToWorkData
+Jobs (Ei), households and dwellings (Aj) tables of the Journey to work model for a scenario:
+2021 census data, or 2050 with the new population and dwellings of Scenario_pop_table
+@returns jobs, HHZones, HHAttractors dataframes
+"""
+def loadJourneyToWorkData(zonecodes_EWS, inputs, Scenario='2021', Scenario_pop_table=None):
+    # Data is transformed from 2021 MSOA to 2011 MSOA by Excel lookup with area filtered
+    if not os.path.isfile(data_census_TS007_CAMKOX):
+        data_census_TS007_CAMKOX_df = pd.read_csv(inputs["DataCensusTS007"], index_col='geography code')
+        data_census_TS007_CAMKOX_df['geography code'] = data_census_TS007_CAMKOX_df.index # turn the index (i.e. MSOA codes) back into a columm
+        data_census_TS007_CAMKOX_df.reset_index(drop=True, inplace=True)
+        data_census_TS007_CAMKOX_df.to_csv(data_census_TS007_CAMKOX)
 
-        # Save output:
-        Housing_accessibility_df = pd.DataFrame({'areakey': CAMKOX_MSOA_list, 'HAcar50': Hi_road, 'HAbus50': Hi_bus,'HArail50': Hi_rail})
-        Housing_accessibility_df.to_csv(outputs["HousingAccessibility2050"])
+    HHZones, HHAttractors = QUANTJobsModel.loadEmploymentData_HHAttractiveness(data_census_TS007_CAMKOX, inputs["DwellingsCAMKOX"], Scenario)
+    # if we are running a scenario, update the HHZones with the new population
+    if Scenario == '2021':
+        dfEi = pd.read_csv(inputs["Employment2021"])  # select the columns that I need from file
+        dfEi.rename(columns={'geography code': 'msoa', 'Occupation (current): Total': 'employment_tot'}, inplace=True)
+        # drop columns:
+        dfEi = dfEi[['msoa','employment_tot']]
+        jobs = dfEi.join(other=zonecodes_EWS.set_index('areakey'), on='msoa')  # this codes dfEi by zonei
+        jobs.to_csv(data_jobs_employment) # save file to csv in model-runs directory
 
-        # Create a Oi Dj table
-        jobs['DjPred_Car_50'] = Tij[0].sum(axis=1)
-        jobs['DjPred_Bus_50'] = Tij[1].sum(axis=1)
-        jobs['DjPred_Rail_50'] = Tij[2].sum(axis=1)
-        jobs['DjPred_Tot_50'] = Tij[0].sum(axis=1) + Tij[1].sum(axis=1) + Tij[2].sum(axis=1)
-        jobs['OiPred_Car_50'] = Tij[0].sum(axis=0)
-        jobs['OiPred_Bus_50'] = Tij[1].sum(axis=0)
-        jobs['OiPred_Rail_50'] = Tij[2].sum(axis=0)
-        jobs['OiPred_Tot_50'] = Tij[0].sum(axis=0) + Tij[1].sum(axis=0) + Tij[2].sum(axis=0)
-        jobs['Job_accessibility_roads'] = Jobs_accessibility_df['JAcar50']
-        jobs['Jobs_accessibility_bus'] = Jobs_accessibility_df['JAbus50']
-        jobs['Jobs_accessibility_rail'] = Jobs_accessibility_df['JArail50']
-        jobs['Housing_accessibility_roads'] = Housing_accessibility_df['HAcar50']
-        jobs['Housing_accessibility_bus'] = Housing_accessibility_df['HAbus50']
-        jobs['Housing_accessibility_rail'] = Housing_accessibility_df['HArail50']
-        jobs.to_csv(outputs["JobsDjOi2050"])
-
-
-        # Save output matrices
-        print("Saving output matrices...")
+        HHZones.to_csv(data_HH_zones_2021)  # save file to csv in model-runs directory
+        HHAttractors.to_csv(data_HH_attractors_2021)  # save file to csv in model-runs directory
 
-        # Probabilities:
-        np.savetxt(outputs["JobsProbTijRoads2050"], jobs_probTij[0], delimiter=",")
-        np.savetxt(outputs["JobsProbTijBus2050"], jobs_probTij[1], delimiter=",")
-        np.savetxt(outputs["JobsProbTijRail2050"], jobs_probTij[2], delimiter=",")
+        HHZones = HHZones[['zonei', 'Population_tot']]
+        HHAttractors = HHAttractors[['zonei', 'N_of_Dwellings']]
 
-        # People flows
-        np.savetxt(outputs["JobsTijRoads2050"], Tij[0], delimiter=",")
-        np.savetxt(outputs["JobsTijBus2050"], Tij[1], delimiter=",")
-        np.savetxt(outputs["JobsTijRail2050"], Tij[2], delimiter=",")
+    elif Scenario == 'NewHousingDev_Expand_2050':
+        dfEi = pd.read_csv(inputs["Employment2050"])  # select the columns that I need from file
+        dfEi.rename(columns={'Jobs': 'employment_tot'}, inplace=True)
+        jobs = dfEi.join(other=zonecodes_EWS.set_index('areakey'), on='msoa')  # this codes dfEi by zonei
 
-        # Geojson flows files - arrows
-        flow_zonecodes = pd.read_csv(inputs["ZonesCoordinates"])
-        flow_car = flowArrowsGeoJSON(Tij[0], flow_zonecodes)
-        with open(outputs["ArrowsFlowsCar2050"], 'w') as f:
-            dump(flow_car, f)
-        flow_bus = flowArrowsGeoJSON(Tij[1], flow_zonecodes)
-        with open(outputs["ArrowsFlowsBus2050"], 'w') as f:
-            dump(flow_bus, f)
-        flow_rail = flowArrowsGeoJSON(Tij[2], flow_zonecodes)
-        with open(outputs["ArrowsFlowsRail2050"], 'w') as f:
-            dump(flow_rail, f)
+        # Rename Scenario_pop_table's columns:
+        Scenario_pop_table.rename(columns={'Area Description':'zonei'}, inplace=True)
 
-        print("JtW model", Scenario, " cbar [roads, bus, rail] = ", cbar_k)
+        # Update the population with the 2050 projection
+        HHZones = HHZones.join(Scenario_pop_table.set_index('zonei'), on=['zonei'])
+        HHZones['NewPop_2021_2050'] = HHZones['NewPop_2021_2050'].fillna(0)  # Replace NaN with 0
+        HHZones['Population_tot'] = HHZones['Population_tot'] + HHZones['NewPop_2021_2050']
+        HHZones = HHZones[['zonei', 'Population_tot']]
 
-        # Calculate predicted population
-        DjPred = np.zeros(n)
-        for k in range(len(Tij)):
-            DjPred += Tij[k].sum(axis=1)
-        # Create a dataframe with Zone and people count
-        DjPred = pd.DataFrame(DjPred, columns=['population'])
-        DjPred['zonei'] = CAMKOX_MSOA_list
+        # Update the number of dwellings with the 2050 projection
+        NewHousingDev_table_2050 = pd.read_csv(inputs["CAMKOXNewHousingDev"], usecols=['Area Description', 'Tot_Alloc_E'])  # for 2050 read the entry up to year 2031
+        NewHousingDev_table_2050.rename(columns={'Area Description': 'zonei', 'Tot_Alloc_E': 'Expansion_2021_2050'}, inplace=True)
 
-        end = time.perf_counter()
-        print("Journey to work model run elapsed time (secs)=", end - start)
-        # print("Journey to work model run elapsed time (mins)=", (end - start) / 60)
-        print()
+        HHAttractors = HHAttractors.join(NewHousingDev_table_2050.set_index('zonei'), on=['zonei'])  # Join the Attractors df with the new houses df
+        HHAttractors['Expansion_2021_2050'] = HHAttractors['Expansion_2021_2050'].fillna(0)  # Replace NaN with 0
+        HHAttractors['N_of_Dwellings'] = HHAttractors['N_of_Dwellings'] + HHAttractors['Expansion_2021_2050']
+        HHAttractors = HHAttractors[['zonei', 'N_of_Dwellings']]
 
-        return Beta_calibrated, DjPred
+        HHZones.to_csv(data_HH_zones_2050)  # save file to csv in model-runs directory
+        HHAttractors.to_csv(data_HH_attractors_2050)  # save file to csv in model-runs directory
     
     elif Scenario == 'NewHousingDev_NewSettle_2050':
-        # Use cij as cost matrix (MSOA to MSOA)
-        m, n = cij_road_CAMKOX.shape
-        model = QUANTJobsModel(m, n)
-        model.setAttractorsAj(HHAttractors, 'zonei', 'N_of_Dwellings')
-        model.setPopulationEi(jobs, 'zonei', 'employment_tot')
-        model.setCostMatrixCij(cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX)
-
-        Tij, cbar_k = model.run3modes_NoCalibration(Beta_calibrated)
-        # Compute the probability of a flow from an MSOA zone to any (i.e. all) of the possible point zones.
-        jobs_probTij = model.computeProbabilities3modes(Tij)
-
-        # Jobs accessibility:
-        DjPred_road = Tij[0].sum(axis=1)
-        Ji_road = Calculate_Job_Accessibility(DjPred_road, cij_road_CAMKOX)
-
-        DjPred_bus = Tij[1].sum(axis=1)
-        Ji_bus = Calculate_Job_Accessibility(DjPred_bus, cij_bus_CAMKOX)
+        dfEi = pd.read_csv(inputs["Employment2050"])  # select the columns that I need from file
+        dfEi.rename(columns={'Jobs': 'employment_tot'}, inplace=True)
+        jobs = dfEi.join(other=zonecodes_EWS.set_index('areakey'), on='msoa')  # this codes dfEi by zonei
 
-        DjPred_rail = Tij[2].sum(axis=1)
-        Ji_rail = Calculate_Job_Accessibility(DjPred_rail, cij_rail_CAMKOX)
+        # Rename Scenario_pop_table's columns:
+        Scenario_pop_table.rename(columns={'Area Description':'zonei'}, inplace=True)
 
-        # Save output:
-        Jobs_accessibility_df = pd.DataFrame({'areakey': CAMKOX_MSOA_list, 'JAcar50': Ji_road, 'JAbus50': Ji_bus, 'JArail50': Ji_rail})
-        Jobs_accessibility_df.to_csv(outputs["NS_JobsAccessibility2050"])
+        # Update the population with the 2050 projection
+        HHZones = HHZones.join(Scenario_pop_table.set_index('zonei'), on=['zonei'])
+        HHZones['NS_NewPop_2021_2050'] = HHZones['NS_NewPop_2021_2050'].fillna(0)  # Replace NaN with 0
+        HHZones['Population_tot'] = HHZones['Population_tot'] + HHZones['NS_NewPop_2021_2050']
+        HHZones = HHZones[['zonei', 'Population_tot']]
 
-        # Housing Accessibility:
-        OiPred_road = Tij[0].sum(axis=0)
-        Hi_road = Calculate_Housing_Accessibility(OiPred_road, cij_road_CAMKOX)
+        # Update the number of dwellings with the 2050 projection
+        NS_NewHousingDev_table_2050 = pd.read_csv(inputs["CAMKOXNewHousingDev"], usecols=['Area Description', 'Tot_Alloc_N'])  # for 2050 read the entry up to year 2031
+        NS_NewHousingDev_table_2050.rename(columns={'Area Description': 'zonei', 'Tot_Alloc_N': 'NS_Newhouses_2021_2050'}, inplace=True)
 
-        OiPred_bus = Tij[1].sum(axis=0)
-        Hi_bus = Calculate_Housing_Accessibility(OiPred_bus, cij_bus_CAMKOX)
+        HHAttractors = HHAttractors.join(NS_NewHousingDev_table_2050.set_index('zonei'), on=['zonei'])  # Join the Attractors df with the new houses df
+        HHAttractors['NS_Newhouses_2021_2050'] = HHAttractors['NS_Newhouses_2021_2050'].fillna(0)  # Replace NaN with 0
+        HHAttractors['N_of_Dwellings'] = HHAttractors['N_of_Dwellings'] + HHAttractors['NS_Newhouses_2021_2050']
+        HHAttractors = HHAttractors[['zonei', 'N_of_Dwellings']]
 
-        OiPred_rail = Tij[2].sum(axis=0)
-        Hi_rail = Calculate_Housing_Accessibility(OiPred_rail, cij_bus_CAMKOX)
+        HHZones.to_csv(NS_data_HH_zones_2050)  # save file to csv in model-runs directory
+        HHAttractors.to_csv(NS_data_HH_attractors_2050)  # save file to csv in model-runs directory
 
-        # Save output:
-        Housing_accessibility_df = pd.DataFrame({'areakey': CAMKOX_MSOA_list, 'HAcar50': Hi_road, 'HAbus50': Hi_bus,'HArail50': Hi_rail})
-        Housing_accessibility_df.to_csv(outputs["NS_HousingAccessibility2050"])
+    return jobs, HHZones, HHAttractors
 
-        # Create a Oi Dj table
-        jobs['DjPred_Car_50'] = Tij[0].sum(axis=1)
-        jobs['DjPred_Bus_50'] = Tij[1].sum(axis=1)
-        jobs['DjPred_Rail_50'] = Tij[2].sum(axis=1)
-        jobs['DjPred_Tot_50'] = Tij[0].sum(axis=1) + Tij[1].sum(axis=1) + Tij[2].sum(axis=1)
-        jobs['OiPred_Car_50'] = Tij[0].sum(axis=0)
-        jobs['OiPred_Bus_50'] = Tij[1].sum(axis=0)
-        jobs['OiPred_Rail_50'] = Tij[2].sum(axis=0)
-        jobs['OiPred_Tot_50'] = Tij[0].sum(axis=0) + Tij[1].sum(axis=0) + Tij[2].sum(axis=0)
-        jobs['Job_accessibility_roads'] = Jobs_accessibility_df['JAcar50']
-        jobs['Jobs_accessibility_bus'] = Jobs_accessibility_df['JAbus50']
-        jobs['Jobs_accessibility_rail'] = Jobs_accessibility_df['JArail50']
-        jobs['Housing_accessibility_roads'] = Housing_accessibility_df['HAcar50']
-        jobs['Housing_accessibility_bus'] = Housing_accessibility_df['HAbus50']
-        jobs['Housing_accessibility_rail'] = Housing_accessibility_df['HArail50']
-        jobs.to_csv(outputs["NS_JobsDjOi2050"])
-
-
-        # Save output matrices
-        print("Saving output matrices...")
 
-        # Probabilities:
-        np.savetxt(outputs["NS_JobsProbTijRoads2050"], jobs_probTij[0], delimiter=",")
-        np.savetxt(outputs["NS_JobsProbTijBus2050"], jobs_probTij[1], delimiter=",")
-        np.savetxt(outputs["NS_JobsProbTijRail2050"], jobs_probTij[2], delimiter=",")
+"""
+runJourneyToWorkScenarios
+Run the Journey to work model without calibration for several 2050 scenarios
+(e.g. 'NewHousingDev_Expand_2050' and 'NewHousingDev_NewSettle_2050') that share
+the cost matrices and the calibrated Betas. All the scenarios are evaluated in
+one pass over the shared exp(-Beta * cij) kernels (see QUANTLHModel.run3modes_Scenarios),
+so an extra housing scenario costs little more than writing its outputs.
+@param Scenarios list of (Scenario, Scenario_pop_table)
+@param writer optional AsyncWriter to write the outputs in the background, else they are written before returning
+@returns list of DjPred dataframes (predicted population), one per scenario
+"""
+def runJourneyToWorkScenarios(CAMKOX_MSOA_list, zonecodes_EWS, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX, inputs, outputs, Scenarios, Beta_calibrated, writer=None):
+    print("Running Journey to Work ", [Scenario for Scenario, Scenario_pop_table in Scenarios], " models.")
+    start = time.perf_counter()
+    writer = AsyncWriter(workers=0) if writer is None else writer
+
+    # Use cij as cost matrix (MSOA to MSOA)
+    m, n = cij_road_CAMKOX.shape
+    model = QUANTJobsModel(m, n)
+    model.setCostMatrixCij(cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX)
+
+    scenario_jobs = []
+    Ei = np.zeros((len(Scenarios), m))
+    Aj = np.zeros((len(Scenarios), n))
+    for s, (Scenario, Scenario_pop_table) in enumerate(Scenarios):
+        jobs, HHZones, HHAttractors = loadJourneyToWorkData(zonecodes_EWS, inputs, Scenario, Scenario_pop_table)
+        model.setAttractorsAj(HHAttractors, 'zonei', 'N_of_Dwellings')
+        model.setPopulationEi(jobs, 'zonei', 'employment_tot')
+        scenario_jobs.append(jobs)
+        Ei[s] = model.Ei
+        Aj[s] = model.Aj
+
+    Tij_s, cbar_s = model.run3modes_Scenarios(Beta_calibrated, Ei, Aj)
+
+    # Jobs and housing accessibility of all the modes and scenarios in one call over the
+    # cached impedance kernels (see accessibility.py)
+    OiPreds = np.stack([Tij.columnSums for Tij in Tij_s])
+    Ji_s, Hi_s = scaleTo100(accessibilityGrid([np.stack([Tij.rowSums for Tij in Tij_s]), OiPreds], model.cij, [accessibilityMeasure])[0])
+    impedance, param = accessibilityMeasure
+    Hi_s[:, 2] = scaleTo100(accessibility(OiPreds[:, 2], cij_bus_CAMKOX, impedance, param))  # the 2050 rail housing accessibility has always used the bus costs
+
+    DjPreds = []
+    for s, (Scenario, Scenario_pop_table) in enumerate(Scenarios):
+        DjPreds.append(saveJourneyToWork2050Outputs(CAMKOX_MSOA_list, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX, inputs, outputs, Scenario, model, scenario_jobs[s], Tij_s[s], cbar_s[s], Ji_s[s], Hi_s[s], writer))
+        Tij_s[s] = None  # the flows of a scenario are computed when it is saved, and released after (once written)
+
+    end = time.perf_counter()
+    print("Journey to work models run elapsed time (secs)=", end - start)
+    print()
 
-        # People flows
-        np.savetxt(outputs["NS_JobsTijRoads2050"], Tij[0], delimiter=",")
-        np.savetxt(outputs["NS_JobsTijBus2050"], Tij[1], delimiter=",")
-        np.savetxt(outputs["NS_JobsTijRail2050"], Tij[2], delimiter=",")
+    return DjPreds
 
-        # Geojson flows files - arrows
-        flow_zonecodes = pd.read_csv(inputs["ZonesCoordinates"])
-        flow_car = flowArrowsGeoJSON(Tij[0], flow_zonecodes)
-        with open(outputs["NS_ArrowsFlowsCar2050"], 'w') as f:
-            dump(flow_car, f)
-        flow_bus = flowArrowsGeoJSON(Tij[1], flow_zonecodes)
-        with open(outputs["NS_ArrowsFlowsBus2050"], 'w') as f:
-            dump(flow_bus, f)
-        flow_rail = flowArrowsGeoJSON(Tij[2], flow_zonecodes)
-        with open(outputs["NS_ArrowsFlowsRail2050"], 'w') as f:
-            dump(flow_rail, f)
+"""
+saveJourneyToWork2050Outputs
+Probabilities, accessibility, Oi Dj table, flows and flow arrows of a 2050 scenario
+(the outputs of 'NewHousingDev_NewSettle_2050' have the NS_ prefix)
+@param Ji, Hi (n_modes, n) jobs and housing accessibility of the scenario
+@param writer AsyncWriter the outputs are submitted to
+@returns DjPred dataframe (predicted population)
+"""
+def saveJourneyToWork2050Outputs(CAMKOX_MSOA_list, cij_road_CAMKOX, cij_bus_CAMKOX, cij_rail_CAMKOX, inputs, outputs, Scenario, model, jobs, Tij, cbar_k, Ji, Hi, writer):
+    prefix = 'NS_' if Scenario == 'NewHousingDev_NewSettle_2050' else ''
+    m, n = cij_road_CAMKOX.shape
+
+    # Compute the probability of a flow from an MSOA zone to any (i.e. all) of the possible point zones.
+    # (lazily: each mode is computed when it is saved, so only one probability matrix is in memory)
+    jobs_probTij = Tij.probabilities
+
+    # Jobs accessibility:
+    Ji_road, Ji_bus, Ji_rail = Ji
+
+    # Save output:
+    Jobs_accessibility_df = pd.DataFrame({'areakey': CAMKOX_MSOA_list, 'JAcar50': Ji_road, 'JAbus50': Ji_bus, 'JArail50': Ji_rail})
+    writer.submit(Jobs_accessibility_df.to_csv, outputs[prefix + "JobsAccessibility2050"])
+
+    # Housing Accessibility:
+    Hi_road, Hi_bus, Hi_rail = Hi
+
+    # Save output:
+    Housing_accessibility_df = pd.DataFrame({'areakey': CAMKOX_MSOA_list, 'HAcar50': Hi_road, 'HAbus50': Hi_bus,'HArail50': Hi_rail})
+    writer.submit(Housing_accessibility_df.to_csv, outputs[prefix + "HousingAccessibility2050"])
+
+    # Create a Oi Dj table
+    jobs['DjPred_Car_50'] = Tij.rowSums[0]
+    jobs['DjPred_Bus_50'] = Tij.rowSums[1]
+    jobs['DjPred_Rail_50'] = Tij.rowSums[2]
+    jobs['DjPred_Tot_50'] = Tij.rowTotals
+    jobs['OiPred_Car_50'] = Tij.columnSums[0]
+    jobs['OiPred_Bus_50'] = Tij.columnSums[1]
+    jobs['OiPred_Rail_50'] = Tij.columnSums[2]
+    jobs['OiPred_Tot_50'] = Tij.columnTotals
+    jobs['Job_accessibility_roads'] = Jobs_accessibility_df['JAcar50']
+    jobs['Jobs_accessibility_bus'] = Jobs_accessibility_df['JAbus50']
+    jobs['Jobs_accessibility_rail'] = Jobs_accessibility_df['JArail50']
+    jobs['Housing_accessibility_roads'] = Housing_accessibility_df['HAcar50']
+    jobs['Housing_accessibility_bus'] = Housing_accessibility_df['HAbus50']
+    jobs['Housing_accessibility_rail'] = Housing_accessibility_df['HArail50']
+    writer.submit(jobs.to_csv, outputs[prefix + "JobsDjOi2050"])
+
+
+    # Save output matrices (in the background if writer has worker threads)
+    print("Saving output matrices...")
+
+    # Probabilities:
+    writer.submit(saveProbabilities, jobs_probTij, 0, outputs[prefix + "JobsProbTijRoads2050"])
+    writer.submit(saveProbabilities, jobs_probTij, 1, outputs[prefix + "JobsProbTijBus2050"])
+    writer.submit(saveProbabilities, jobs_probTij, 2, outputs[prefix + "JobsProbTijRail2050"])
+
+    # People flows
+    writer.submit(saveOutputMatrix, Tij[0], outputs[prefix + "JobsTijRoads2050"])
+    writer.submit(saveOutputMatrix, Tij[1], outputs[prefix + "JobsTijBus2050"])
+    writer.submit(saveOutputMatrix, Tij[2], outputs[prefix + "JobsTijRail2050"])
+
+    # Geojson flows files - arrows
+    flow_zonecodes = pd.read_csv(inputs["ZonesCoordinates"])
+    flow_car = flowArrowsGeoJSON(Tij[0], flow_zonecodes)
+    writer.submit(saveGeoJSON, flow_car, outputs[prefix + "ArrowsFlowsCar2050"])
+    flow_bus = flowArrowsGeoJSON(Tij[1], flow_zonecodes)
+    writer.submit(saveGeoJSON, flow_bus, outputs[prefix + "ArrowsFlowsBus2050"])
+    flow_rail = flowArrowsGeoJSON(Tij[2], flow_zonecodes)
+    writer.submit(saveGeoJSON, flow_rail, outputs[prefix + "ArrowsFlowsRail2050"])
+
+    print("JtW model", Scenario, " cbar [roads, bus, rail] = ", cbar_k)
+
+    # Calculate predicted population
+    DjPred = Tij.rowTotals
+    # Create a dataframe with Zone and people count
+    DjPred = pd.DataFrame(DjPred, columns=['population'])
+    DjPred['zonei'] = CAMKOX_MSOA_list
+
+    return DjPred
 
-        print("JtW model", Scenario, " cbar [roads, bus, rail] = ", cbar_k)
 
-        # Calculate predicted population
-        DjPred = np.zeros(n)
-        for k in range(len(Tij)):
-            DjPred += Tij[k].sum(axis=1)
-        # Create a dataframe with Zone and people count
-        DjPred = pd.DataFrame(DjPred, columns=['population'])
-        DjPred['zonei'] = CAMKOX_MSOA_list
+"""
+saveProbabilities
+Save the probabilities of mode k (see FlowResult.probabilities), which are
+only computed here, i.e. in the writer thread
+"""
+def saveProbabilities(probabilities, k, filename):
+    saveOutputMatrix(probabilities[k], filename)
 
-        end = time.perf_counter()
-        print("Journey to work model run elapsed time (secs)=", end - start)
-        # print("Journey to work model run elapsed time (mins)=", (end - start) / 60)
-        print()
+"""
+saveGeoJSON
+Save a GeoJSON object, e.g. the flow arrows of flowArrowsGeoJSON
+"""
+def saveGeoJSON(obj, filename):
+    with open(filename, 'w') as f:
+        dump(obj, f)
 
-        return Beta_calibrated, DjPred
- 
-    
 def Calculate_Job_Accessibility(DjPred, cij):
     # Job accessibility is the distribution of population around a job location.
 
-    Ji = np.zeros(len(DjPred))
-    for i in range(len(Ji)):
-        for j in range(len(Ji)):
-            Ji[i] += DjPred[j] / (cij[i, j] * cij[i, j])  # DjPred is residential totals
+    Ji = accessibility(DjPred, cij)  # DjPred is residential totals
 
     # now scale to 100
-    Sum = 0
-    for i in range(len(Ji)): Sum += Ji[i]
-    for i in range(len(Ji)): Ji[i] = 100.0 * Ji[i] / Sum
+    Ji = scaleTo100(Ji)
     return Ji
 
 def Calculate_Housing_Accessibility(OiPred, cij):
     # Housing accessibility is the distribution of jobs around a housing location.
 
-    Hi = np.zeros(len(OiPred))
-
     # Calculate housing accessibility for public transport
-    for i in range(len(Hi)):
-        for j in range(len(Hi)):
-            Hi[i] += OiPred[j] / (cij[i, j] * cij[i, j])  # OiPred_pu is employment totals
+    Hi = accessibility(OiPred, cij)  # OiPred_pu is employment totals
 
     # now scale to 100
-    Sum = 0
-    for i in range(len(Hi)): Sum += Hi[i]
-    for i in range(len(Hi)): Hi[i] = 100.0 * Hi[i] / Sum
+    Hi = scaleTo100(Hi)
     return Hi
 
 ################################################################################
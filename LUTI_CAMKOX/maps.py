@@ -4,6 +4,7 @@ maps.py
 Generate visualisation for population, accessibilities and flows 
 """
 from LUTI_CAMKOX.globals import *
+from LUTI_CAMKOX.utils import loadOutputMatrix
 import matplotlib.pyplot as plt
 import pandas as pd
 import geopandas as gpd
@@ -320,7 +321,7 @@ def flows_map_creation(inputs, outputs, flows_output_keys): # Using OSM
     Flows = []
 
     for kk, flows_output_key in enumerate(flows_output_keys):
-        Flows.append(pd.read_csv(outputs[flows_output_key], header=None))
+        Flows.append(loadOutputMatrix(outputs[flows_output_key], mmap=True))
 
         # Initialise weights to 0:
         for source, target in X.edges():
@@ -338,7 +339,7 @@ def flows_map_creation(inputs, outputs, flows_output_keys): # Using OSM
 
             for edge in list(path_edges):
                 for cc in range(len(Flows)):
-                    X[edge[0]][edge[1]][0]["Flows_" + str(cc)] += Flows[cc].iloc[n, m]
+                    X[edge[0]][edge[1]][0]["Flows_" + str(cc)] += Flows[cc][n, m]
 
     # save graph to shapefile
     output_folder_path = "./Outputs-CAMKOX_LON/" + "Flows_shp"
@@ -365,7 +366,7 @@ def rail_flows_map_creation(inputs, outputs, flows_output_keys): # Using OSM
     Flows = []
 
     for kk, flows_output_key in enumerate(flows_output_keys):
-        Flows.append(pd.read_csv(outputs[flows_output_key], header=None))
+        Flows.append(loadOutputMatrix(outputs[flows_output_key], mmap=True))
 
         # Initialise weights to 0:
         for source, target in X.edges():
@@ -383,7 +384,7 @@ def rail_flows_map_creation(inputs, outputs, flows_output_keys): # Using OSM
 
             for edge in list(path_edges):
                 for cc in range(len(Flows)):
-                    X[edge[0]][edge[1]][0]["Flows_" + str(cc)] += Flows[cc].iloc[n, m]
+                    X[edge[0]][edge[1]][0]["Flows_" + str(cc)] += Flows[cc][n, m]
 
     # save graph to shapefile
     output_folder_path = "./Outputs-CAMKOX_LON/" + "rail_Flows_shp"
@@ -0,0 +1,158 @@
+"""
+matrixcache.py
+
+Content addressed cache for the matrices built from the QUANT data (clipped
+cost matrices, observed trips). An entry is keyed by the hash of the source
+file, the hash of the zone list and the transform parameters, so a changed
+input can never pick up a stale matrix, and scenarios that swap inputs (e.g.
+2021 and 2050 rail) keep their own valid entries side by side.
+"""
+import hashlib
+import json
+import os
+import threading
+
+from LUTI_CAMKOX.utils import loadMatrix, saveMatrix, fileHash, readMatrixHeader
+
+class MatrixCache:
+    """
+    constructor
+    @param cacheDir directory holding the cache entries (created if needed)
+    @param maxBytes size budget for the entries, the least recently used
+        entries are evicted when it is exceeded
+    """
+
+    def __init__(self, cacheDir, maxBytes):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.hashesFilename = os.path.join(cacheDir, 'source-hashes.json')
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir, exist_ok=True)
+
+    ################################################################################
+
+    """
+    makeKey
+    Build a cache key from the source file hash, the zone list hash and the
+    transform parameters (e.g. min_cost=1 for the lower limit of 1 minute links).
+    """
+    @staticmethod
+    def makeKey(sourceHash, zonesHash, **params):
+        text = json.dumps({'source': sourceHash, 'zones': zonesHash, 'params': params}, sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    ################################################################################
+
+    """
+    sourceHash
+    Hash of a source file. Hashing a national QUANT matrix takes a while, so
+    the result is remembered against the file path, size and modification time.
+    """
+    def sourceHash(self, filename):
+        st = os.stat(filename)
+        stamp = [st.st_size, st.st_mtime_ns]
+        path = os.path.abspath(filename)
+        with self.lock:
+            hashes = self._loadHashes()
+            entry = hashes.get(path)
+        if entry is not None and entry['stamp'] == stamp:
+            return entry['sha1']
+        sha1 = fileHash(filename)
+        with self.lock:
+            hashes = self._loadHashes()
+            hashes[path] = {'stamp': stamp, 'sha1': sha1}
+            tmpname = self.hashesFilename + '.tmp' + str(os.getpid())
+            with open(tmpname, 'w') as f:
+                json.dump(hashes, f, indent=1)
+            os.replace(tmpname, self.hashesFilename)
+        return sha1
+
+    def _loadHashes(self):
+        if not os.path.isfile(self.hashesFilename):
+            return {}
+        with open(self.hashesFilename) as f:
+            return json.load(f)
+
+    ################################################################################
+
+    """
+    path
+    File name of the cache entry for a key
+    """
+    def path(self, key):
+        return os.path.join(self.cacheDir, key + '.bin')
+
+    ################################################################################
+
+    """
+    get
+    @returns the cached matrix for key (memory mapped read only by default), or
+        None if there is no entry
+    """
+    def get(self, key, mmap_mode='r'):
+        filename = self.path(key)
+        if not os.path.isfile(filename):
+            return None
+        header = readMatrixHeader(filename)
+        if header is None or header.get('key') != key:
+            return None
+        os.utime(filename) # mark as recently used for the eviction
+        return loadMatrix(filename, mmap_mode=mmap_mode)
+
+    ################################################################################
+
+    """
+    put
+    Store a matrix under key and evict old entries if the cache is over budget.
+    Metadata (zonesHash, sourceHash, ...) is stored in the matrix header.
+    """
+    def put(self, key, matrix, **metadata):
+        saveMatrix(matrix, self.path(key), key=key, **metadata)
+        self.evict(keep=key)
+
+    ################################################################################
+
+    """
+    fetch
+    Return the matrix for key from the cache, calling build() to make it (and
+    storing the result) if there is no entry.
+    """
+    def fetch(self, key, build, mmap_mode='r', **metadata):
+        matrix = self.get(key, mmap_mode=mmap_mode)
+        if matrix is None:
+            built = build()
+            self.put(key, built, **metadata)
+            matrix = self.get(key, mmap_mode=mmap_mode)
+            if matrix is None: # evicted by another writer in the meantime
+                matrix = built
+        return matrix
+
+    ################################################################################
+
+    """
+    evict
+    Delete the least recently used entries until the total size of the cache is
+    within maxBytes. The entry for keep (if any) is never deleted.
+    """
+    def evict(self, keep=None):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.cacheDir):
+                if not name.endswith('.bin'):
+                    continue
+                filename = os.path.join(self.cacheDir, name)
+                try:
+                    st = os.stat(filename)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name[:-4], filename))
+            total = sum(e[1] for e in entries)
+            for mtime, size, key, filename in sorted(entries):
+                if total <= self.maxBytes:
+                    break
+                if key == keep:
+                    continue
+                print("MatrixCache::evict", key, size, "bytes")
+                os.remove(filename)
+                total -= size
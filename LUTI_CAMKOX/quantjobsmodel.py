@@ -101,8 +101,8 @@ class QUANTJobsModel(QUANTLHModel):
     @staticmethod
     def loadObsData():
         # load observed trips for each mode:
-        SObs_0 = loadMatrix(os.path.join(modelRunsDir, SObsRoadFilename_CAMKOX))
-        SObs_1 = loadMatrix(os.path.join(modelRunsDir, SObsBusFilename_CAMKOX))
-        SObs_2 = loadMatrix(os.path.join(modelRunsDir, SObsRailFilename_CAMKOX))
+        SObs_0 = loadMatrix(os.path.join(modelRunsDir, SObsRoadFilename_CAMKOX), mmap_mode='r')
+        SObs_1 = loadMatrix(os.path.join(modelRunsDir, SObsBusFilename_CAMKOX), mmap_mode='r')
+        SObs_2 = loadMatrix(os.path.join(modelRunsDir, SObsRailFilename_CAMKOX), mmap_mode='r')
 
         return SObs_0, SObs_1, SObs_2
\ No newline at end of file
@@ -4,7 +4,230 @@ quantlhmodel.py
 Define attractor, Aj, Population Ei and cost matrix Cij, and run model
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+from LUTI_CAMKOX.globals import calibrationWarmStart, calibrationStoreFilename, calibrationStoreMaxEntries
+from LUTI_CAMKOX.globals import flowMemoryBudget, flowThreads, flowUseNumexpr, costResolution
+from LUTI_CAMKOX.calibration import calibrate, CalibrationStore
+from LUTI_CAMKOX import kernels
+from LUTI_CAMKOX.kernelcache import kernelCache
+from LUTI_CAMKOX.utils import QuantizedCosts
+
+"""
+FlowStatistics
+Statistics of the predicted flows accumulated by QUANTLHModel.evaluateFlows,
+one row per mode:
+CBar mean trip cost, dCBar its derivative with respect to Beta (or None),
+Oi row sums (trips from each origin i), Dj column sums (trips to each destination j).
+"""
+class FlowStatistics:
+    def __init__(self, CBar, dCBar, Oi, Dj):
+        self.CBar = CBar
+        self.dCBar = dCBar
+        self.Oi = Oi
+        self.Dj = Dj
+
+"""
+BaseRun
+Kernels of a base run kept by QUANTLHModel.setBaseRun for incremental updates:
+K[k,i,j] = exp(-Beta[k] * cij[k,i,j]), and per mode and origin row
+P[k,i] = sum_j Aj[j] * K[k,i,j] and Q[k,i] = sum_j Aj[j] * K[k,i,j] * cij[k,i,j],
+so the denominator of row i is D[i] = sum_k P[k,i].
+"""
+class BaseRun:
+    def __init__(self, Beta, Ei, Aj, K, P, Q):
+        self.Beta = Beta
+        self.Ei = Ei
+        self.Aj = Aj
+        self.K = K
+        self.P = P
+        self.Q = Q
+
+"""
+Probabilities
+Lazy probabilities of the flows Sij returned by
+QUANTLHModel.computeProbabilities3modes(Sij, lazy=True): only the row sums are
+kept and mode k is computed as Sij[k] / rowsum[k] when it is indexed, so the
+probabilities of all the modes are never held in memory together.
+"""
+class Probabilities:
+    def __init__(self, Sij, rowsums):
+        self.Sij = Sij
+        self.rowsums = rowsums
+
+    def __len__(self):
+        return len(self.Sij)
+
+    def __getitem__(self, k):
+        return self.Sij[k] / self.rowsums[k]
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array([self[k] for k in range(len(self))], dtype=dtype)
+
+"""
+FlowResult
+Predicted flows of a model run, returned by the run3modes methods in place of
+the bare Sij tensor. It indexes like Sij (FlowResult[k] is a view of Sij[k],
+no copy) and keeps everything derived from the flows once it is computed: the
+row sums (trips from each origin i, per mode), column sums (trips to each
+destination j, per mode), their totals over the modes, CBar and the
+probabilities. The marginals accumulated while the flows were evaluated (see
+FlowStatistics) are used as they are, so they need no pass over Sij at all.
+If Sij is not given, rows(i0, i1) computes blocks of rows on demand from the
+(cached) exp kernels of the model, and Sij is only computed when it is used.
+@param model the QUANTLHModel that was run (its costs MUST NOT change)
+@param Beta the Beta values of the run
+@param Sij (n_modes, m, n) flows, or None to compute them on demand
+@param stats FlowStatistics of the run (optional)
+@param Ei, Aj jobs and dwellings of the run (default those of the model)
+"""
+class FlowResult:
+    def __init__(self, model, Beta, Sij=None, stats=None, Ei=None, Aj=None):
+        self.model = model
+        self.Beta = np.array(Beta, dtype=float)
+        self.Ei = np.array(model.Ei if Ei is None else Ei, dtype=float)
+        self.Aj = np.array(model.Aj if Aj is None else Aj, dtype=float)
+        self.flows = Sij
+        self.stats = stats
+        self.cachedRowSums = None if stats is None else stats.Oi
+        self.cachedColumnSums = None if stats is None else stats.Dj
+        self.cachedCBar = None if stats is None else stats.CBar
+        self.cachedProbabilities = None
+
+    def __len__(self):
+        return self.model.n_modes
+
+    def __getitem__(self, k):
+        return self.Sij[k]
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.Sij, dtype=dtype)
+
+    @property
+    def shape(self):
+        return self.model.cij.shape
+
+    ################################################################################
+
+    """
+    Sij
+    The (n_modes, m, n) flows, computed (once) from rows() if they were not given
+    """
+    @property
+    def Sij(self):
+        if self.flows is None:
+            self.flows = self.rows(0, self.model.m)
+        return self.flows
+
+    ################################################################################
+
+    """
+    rows
+    Flows of the origin rows i0 to i1 for all the modes, a view of Sij if it
+    is there, otherwise computed from the exp kernels of the model (the whole
+    kernel from the kernel cache if it fits, else only the block of rows)
+    @returns (n_modes, i1 - i0, n) array
+    """
+    def rows(self, i0, i1):
+        if self.flows is not None:
+            return self.flows[:, i0:i1]
+        model = self.model
+        kernel = model.exponentialKernel(self.Beta)
+        if kernel is not None:
+            Sij = kernel[:, i0:i1] * self.Aj
+        else:
+            Sij = model.kernelBlock(-self.Beta, model.exponentialTable(self.Beta), i0, i1, np.empty((len(self), i1 - i0, model.n)))
+            Sij *= self.Aj
+        Sij *= (self.Ei[i0:i1] / Sij.sum(axis=(0, 2)))[None, :, None]
+        return Sij
+
+    ################################################################################
+
+    """
+    rowSums
+    (n_modes, m) sums of Sij over the destinations j, i.e. Sij[k].sum(axis=1)
+    """
+    @property
+    def rowSums(self):
+        if self.cachedRowSums is None:
+            self.cachedRowSums = self.Sij.sum(axis=2)
+        return self.cachedRowSums
+
+    ################################################################################
+
+    """
+    columnSums
+    (n_modes, n) sums of Sij over the origins i, i.e. Sij[k].sum(axis=0)
+    """
+    @property
+    def columnSums(self):
+        if self.cachedColumnSums is None:
+            self.cachedColumnSums = self.Sij.sum(axis=1)
+        return self.cachedColumnSums
+
+    ################################################################################
+
+    """
+    rowTotals, columnTotals
+    Row and column sums over all the modes
+    """
+    @property
+    def rowTotals(self):
+        return self.rowSums.sum(axis=0)
+
+    @property
+    def columnTotals(self):
+        return self.columnSums.sum(axis=0)
+
+    ################################################################################
+
+    """
+    totals
+    Total flows of each mode
+    """
+    @property
+    def totals(self):
+        return self.rowSums.sum(axis=1)
+
+    ################################################################################
+
+    """
+    CBar
+    Predicted mean trip cost of each mode
+    """
+    @property
+    def CBar(self):
+        if self.cachedCBar is None:
+            self.cachedCBar = self.model.computeCBar(self.Sij, self.model.cij)
+        return self.cachedCBar
+
+    ################################################################################
+
+    """
+    probabilities
+    Probabilities of the flows (see QUANTLHModel.computeProbabilities3modes),
+    computed per mode when indexed from the cached row sums
+    """
+    @property
+    def probabilities(self):
+        if self.cachedProbabilities is None:
+            rowsums = self.rowSums.copy()
+            rowsums[rowsums <= 0] = 1  # catch for divide by zero - just let the zero probs come through to the final matrix
+            self.cachedProbabilities = Probabilities(self, rowsums[:, :, None])
+        return self.cachedProbabilities
 
 class QUANTLHModel:
     """
@@ -19,12 +242,45 @@ class QUANTLHModel:
         self.n = n
         self.Ei = np.zeros(m)
         self.Aj = np.zeros(n)
-        self.cij_0 = np.zeros(1)  # costs matrix - set to something BIG later
-        self.cij_1 = np.zeros(1)  # costs matrix - set to something BIG later
-        self.cij_2 = np.zeros(1)  # costs matrix - set to something BIG later
-        self.SObs_0 = np.zeros(1)
-        self.SObs_1 = np.zeros(1)
-        self.SObs_2 = np.zeros(1)
+        self.cij = np.zeros((0, m, n))  # costs tensor (n_modes, m, n) - set by setCostMatrixCij
+        self.SObs = np.zeros((0, m, n))  # observed trips tensor (n_modes, m, n) - set by setObsMatrix
+        self.costResolution = None  # resolution of the quantized costs - set by setCostResolution
+        self.costIndex = None  # quantized costs (n_modes, m, n) as multiples of costResolution
+        self.costLevels = None  # number of cost levels of costIndex (the length of the exp lookup tables)
+
+    ################################################################################
+
+    """
+    n_modes
+    Number of modes, i.e. the length of the first axis of the cost tensor
+    """
+    @property
+    def n_modes(self):
+        return self.cij.shape[0]
+
+    ################################################################################
+
+    """
+    stackModes
+    Stack a list of m x n matrices (one per mode) into one contiguous float64
+    (n_modes, m, n) tensor. A single (n_modes, m, n) float32 or float64 tensor
+    is used as it is, so it can be a read only np.memmap (e.g. for the national
+    zone system, where the model is evaluated in row blocks).
+    """
+    def stackModes(self, matrices, name):
+        if len(matrices) == 1 and np.ndim(matrices[0]) == 3:
+            tensor = matrices[0]
+            if not isinstance(tensor, np.ndarray) or tensor.dtype not in (np.float32, np.float64):
+                tensor = np.ascontiguousarray(tensor, dtype=float)
+        else:
+            tensor = np.empty((len(matrices), self.m, self.n))
+            for k, matrix in enumerate(matrices):
+                i, j = np.shape(matrix)
+                assert i == self.m, "FATAL: " + name + " matrix is the wrong size, m=" + str(i) + " MUST match model definition of m=" + str(self.m)
+                assert j == self.n, "FATAL: " + name + " matrix is the wrong size, n=" + str(j) + " MUST match model definition of n=" + str(self.n)
+                tensor[k] = matrix
+        assert tensor.shape[1:] == (self.m, self.n), "FATAL: " + name + " tensor is the wrong size, shape=" + str(tensor.shape) + " MUST match model definition of m=" + str(self.m) + " n=" + str(self.n)
+        return tensor
 
     ################################################################################
 
@@ -71,45 +327,81 @@ class QUANTLHModel:
 
     """
     setCostsMatrix
-    Assign the cost matrix for the model to use when it runs.
+    Assign the cost matrices for the model to use when it runs, one per mode
+    (any number of modes), e.g. setCostMatrixCij(cij_road, cij_bus, cij_rail),
+    or a single (n_modes, m, n) tensor. They are stored as one contiguous
+    (n_modes, m, n) tensor in self.cij.
     NOTE: this MUST match the m x n order of the model and be a numpy array
     """
-    def setCostMatrixCij(self, cij_0, cij_1, cij_2):
-        i, j = cij_0.shape  # Hopefully cij_0.shape = cij_1.shape = cij_2.shape
-        assert i == self.m, "FATAL: setCostsMatrix cij matrix is the wrong size, cij.m=" + str(i) + " MUST match model definition of m=" + str(self.m)
-        assert j == self.n, "FATAL: setCostsMatrix cij matrix is the wrong size, cij.n=" + str(j) + " MUST match model definition of n=" + str(self.n)
-        self.cij_0 = cij_0
-        self.cij_1 = cij_1
-        self.cij_2 = cij_2
+    def setCostMatrixCij(self, *cij_k):
+        self.cij = self.stackModes(cij_k, "setCostsMatrix cij")
+        self.setCostResolution(costResolution)
+
+    ################################################################################
+
+    """
+    setCostResolution
+    Discretized mode for the exp kernels: quantize the costs to multiples of
+    resolution (e.g. 0.1 minutes) and keep only the integer index matrix
+    costIndex = rint(cij / resolution) (uint16, or uint32 for long costs),
+    a quarter of the memory of the float64 costs (or half), which are dropped:
+    self.cij becomes a QuantizedCosts view of the index (see utils.py), so the
+    mean trip costs and their derivatives are computed from the quantized
+    costs, block by block. exp(-Beta[k] * cij[k]) is evaluated once per cost
+    level into a lookup table (see exponentialTable) and gathered through the
+    index.
+    @param resolution the cost resolution, or None for exact exponentials
+        (of the quantized costs, if they were quantized before)
+    """
+    def setCostResolution(self, resolution):
+        if isinstance(self.cij, QuantizedCosts):
+            self.cij = np.asarray(self.cij)
+        self.costResolution = resolution
+        self.costIndex = None
+        self.costLevels = None
+        if resolution is None or self.n_modes == 0:
+            return
+        assert resolution > 0 and np.min(self.cij) >= 0, "FATAL: setCostResolution needs a positive resolution and non negative costs"
+        levels = int(np.rint(np.max(self.cij) / resolution)) + 1
+        dtype = np.uint16 if levels <= np.iinfo(np.uint16).max + 1 else np.uint32
+        self.costIndex = np.empty(self.cij.shape, dtype=dtype)
+        for k in range(self.n_modes):
+            self.costIndex[k] = np.rint(self.cij[k] / resolution)
+        self.costLevels = levels
+        self.cij = QuantizedCosts(self.costIndex, resolution)
+        print("setCostResolution: costs quantized to", resolution, "with", levels, "levels")
 
     ################################################################################
 
     """
     setObsMatrix
-    Assign the cost matrix for the model to use when it runs.
+    Assign the observed trips matrices for the model to calibrate against, one
+    per mode in the same order as the cost matrices, or a single
+    (n_modes, m, n) tensor. They are stored in self.SObs.
     NOTE: this MUST match the m x n order of the model and be a numpy array
     """
-    def setObsMatrix(self, SObs_0, SObs_1, SObs_2):
-        i, j = SObs_0.shape  # Hopefully cij_0.shape = SObs_0.shape = SObs_0.shape
-        assert i == self.m, "FATAL: setCostsMatrix cij matrix is the wrong size, cij.m=" + str(
-            i) + " MUST match model definition of m=" + str(self.m)
-        assert j == self.n, "FATAL: setCostsMatrix cij matrix is the wrong size, cij.n=" + str(
-            j) + " MUST match model definition of n=" + str(self.n)
-        self.SObs_0 = SObs_0
-        self.SObs_1 = SObs_1
-        self.SObs_2 = SObs_2
+    def setObsMatrix(self, *SObs_k):
+        self.SObs = self.stackModes(SObs_k, "setObsMatrix SObs")
 
     ################################################################################
 
     """
     computeCBar
     Compute average trip length TODO: VERY COMPUTATIONALLY INTENSIVE - FIX IT
+    Works on a single m x n matrix (returns a scalar) or on (n_modes, m, n)
+    tensors (returns one value per mode).
     @param Sij trips matrix containing the flow numbers between MSOA (i) and schools (j)
-    @param cij trip times between i and j
+    @param cij trip times between i and j (a QuantizedCosts tensor is evaluated per mode)
     """
     def computeCBar(self, Sij, cij):
-        CNumerator = np.sum(Sij * cij)
-        CDenominator = np.sum(Sij)
+        if isinstance(cij, QuantizedCosts):
+            # one mode at a time, so the costs are never all in float64
+            return np.array([self.computeCBar(Sij[k], cij[k]) for k in range(len(cij))])
+        if kernels.useNumba() and np.shape(Sij) == np.shape(cij) and np.ndim(Sij) in (2, 3):
+            cbar = kernels.cbarNumba(np.asarray(Sij).reshape((-1,) + np.shape(Sij)[-2:]), np.asarray(cij).reshape((-1,) + np.shape(cij)[-2:]))
+            return cbar if np.ndim(Sij) == 3 else cbar[0]
+        CNumerator = np.einsum('...ij,...ij->...', Sij, cij)  # sum of Sij * cij without the Sij * cij temporary
+        CDenominator = np.sum(Sij, axis=(-2, -1))
         cbar = CNumerator / CDenominator
         return cbar
 
@@ -131,12 +423,261 @@ class QUANTLHModel:
 
     ###############################################################################
 
+    """
+    blockRows
+    Number of origin rows evaluated at once by each thread of evaluateFlows so
+    that the working arrays of all the threads (the kernel block and the
+    temporaries of the reductions, about three float64 (n_modes, rows, n)
+    arrays per thread) fit in memoryBudget bytes.
+    @param memoryBudget bytes (default flowMemoryBudget in globals)
+    @param threads number of threads sharing the budget
+    """
+    def blockRows(self, memoryBudget=None, threads=1):
+        memoryBudget = flowMemoryBudget if memoryBudget is None else memoryBudget
+        rowBytes = 3 * max(self.n_modes, 1) * self.n * 8 * threads
+        return int(min(self.m, max(1, memoryBudget // rowBytes)))
+
+    ################################################################################
+
+    """
+    exponentialTable
+    Lookup table of exp(-Beta[k] * level * costResolution) for every mode and
+    cost level, or None if the costs are not discretized (see setCostResolution)
+    """
+    def exponentialTable(self, Beta):
+        if self.costIndex is None:
+            return None
+        levels = np.arange(self.costLevels) * self.costResolution
+        return np.exp(-np.asarray(Beta, dtype=float)[:, None] * levels[None, :])
+
+    ################################################################################
+
+    """
+    kernelBlock
+    Write exp(-Beta[k] * cij[k]) for the origin rows i0 to i1 into out, from the
+    lookup table if given (see exponentialTable), otherwise computed
+    @param mBeta -Beta, one per mode
+    @param out (n_modes, i1 - i0, n) float64 buffer
+    """
+    def kernelBlock(self, mBeta, table, i0, i1, out):
+        if table is not None:
+            for k in range(len(table)):
+                np.take(table[k], self.costIndex[k, i0:i1], out=out[k], mode='clip')
+        else:
+            np.multiply(self.cij[:, i0:i1], mBeta[:, None, None], out=out)
+            np.exp(out, out=out)
+        return out
+
+    ################################################################################
+
+    """
+    exponentialKernel
+    The kernels K[k] = exp(-Beta[k] * cij[k]) for all modes, from the process wide
+    kernel cache (see kernelcache.py), so runs at the same Betas and costs share
+    them. The whole kernel is only kept if it fits in the working memory of the
+    flow evaluation (flowMemoryBudget) as well as in the cache, unless the caller
+    needs it anyway (force). Otherwise returns None, then callers compute the
+    kernels block by block instead. Calibration does not use this, as every
+    iteration has new Betas.
+    @param Beta the Beta values, one per mode
+    @param force if True ignore flowMemoryBudget (e.g. setBaseRun, which keeps K)
+    """
+    def exponentialKernel(self, Beta, force=False):
+        nbytes = int(np.prod(self.cij.shape)) * 8
+        if not kernelCache.fits(nbytes) or (nbytes > flowMemoryBudget and not force):
+            return None
+        Beta = np.asarray(Beta, dtype=float)
+        build = lambda: self.kernelBlock(-Beta, self.exponentialTable(Beta), 0, self.m, np.empty(self.cij.shape))  # in place, no temporary
+        if self.costIndex is not None:
+            return kernelCache.fetch(self.cij, 'exp_table', np.append(Beta, self.costResolution), build)
+        return kernelCache.fetch(self.cij, 'exp', Beta, build)
+
+    ################################################################################
+
+    """
+    evaluateFlows
+    Evaluate the predicted flows for all modes, streaming blocks of origin rows
+    through the kernel:
+    Sij[k] = Ei[i] * Aj * exp(-Beta[k] * cij[k]) / sum over modes and j of (Aj * exp(-Beta[k] * cij[k]))
+    The denominator of a row only involves that row, so each block is complete
+    on its own. The statistics (CBar, its derivative, row and column sums) are
+    accumulated block by block, and the Sij blocks are only kept if a sink is
+    given, so memory use is bounded by the block size whatever the zone system.
+    The origin rows are split into contiguous ranges, one per thread. The NumPy
+    ufuncs and reductions release the GIL, so the threads run in parallel. With
+    numexpr (flowUseNumexpr) the blocks are evaluated one after the other and
+    numexpr spreads the exp kernel of each block over its own threads instead,
+    as it serialises calls made from several threads. With the Numba backend
+    (see kernels.py) the whole evaluation is one fused parallel loop with no
+    block temporaries.
+    For the derivative, with h[k,i] = sum_j Sij[k,i,j] * cij[k,i,j] / Ei[i] (the mean
+    cost of the trips from i by mode k), dSij[k,i,j]/dBeta[k] = Sij[k,i,j] * (h[k,i] - cij[k,i,j]), so
+    dN[k] = sum_i h[k,i] * N[k,i] - sum_ij Sij * cij^2 and dM[k] = sum_i h[k,i] * M[k,i] - N[k]
+    where N, M are the numerator and denominator of CBar, and
+    dCBar[k] = (dN[k] - CBar[k] * dM[k]) / M[k].
+    @param Beta Beta values, one per mode
+    @param sink optional (n_modes, m, n) array to write Sij into, e.g. a
+        buffer in memory or a memory mapped file (see utils.openMatrixSink)
+    @param derivatives if True also compute dCBar
+    @param blockRows rows per block (default from memoryBudget, see blockRows)
+    @param memoryBudget bytes of working memory (default flowMemoryBudget in globals)
+    @param threads number of threads (default flowThreads in globals)
+    @param kernel optional precomputed exp(-Beta * cij) tensor (see exponentialKernel)
+    @returns FlowStatistics
+    """
+    def evaluateFlows(self, Beta, sink=None, derivatives=False, blockRows=None, memoryBudget=None, threads=None, kernel=None):
+        shape = self.cij.shape
+        n_modes = shape[0]
+        assert sink is None or sink.shape == shape, "FATAL: evaluateFlows sink has shape " + str(sink.shape) + " expected " + str(shape)
+        threads = flowThreads if threads is None else threads
+        table = self.exponentialTable(Beta) if kernel is None else None
+        if kernel is None and table is None and kernels.useNumba():
+            Ni, Mi, Dj, Nc2 = kernels.flows(self.cij, self.Ei, self.Aj, Beta, sink=sink, derivatives=derivatives, threads=threads)
+            return self.flowStatistics(Ni, Mi, Dj, Nc2, derivatives)
+        useNumexpr = flowUseNumexpr and numexpr is not None and kernel is None and table is None
+        if useNumexpr:
+            numexpr.set_num_threads(threads)
+            threads = 1
+        threads = max(1, min(threads, self.m))
+        blockRows = self.blockRows(memoryBudget, threads) if blockRows is None else blockRows
+        mBeta = -np.asarray(Beta, dtype=float)
+        Ni = np.zeros((n_modes, self.m))  # row numerators of CBar
+        Mi = np.zeros((n_modes, self.m))  # row denominators of CBar (row sums of Sij)
+        bounds = np.linspace(0, self.m, threads + 1).astype(int)
+        if threads == 1:
+            partials = [self.evaluateRows(0, self.m, mBeta, blockRows, sink, derivatives, Ni, Mi, useNumexpr, kernel, table)]
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                futures = [pool.submit(self.evaluateRows, bounds[t], bounds[t + 1], mBeta, blockRows, sink, derivatives, Ni, Mi, useNumexpr, kernel, table)
+                           for t in range(threads)]
+                partials = [future.result() for future in futures]
+        Dj = sum(p[0] for p in partials)  # column sums of Sij
+        Nc2 = sum(p[1] for p in partials)
+        return self.flowStatistics(Ni, Mi, Dj, Nc2, derivatives)
+
+    ################################################################################
+
+    """
+    flowStatistics
+    Reduce the row statistics of evaluateFlows into FlowStatistics
+    @param Ni, Mi (n_modes, m) row numerators and denominators of CBar
+    @param Dj (n_modes, n) column sums
+    @param Nc2 sum of Sij * cij^2 per mode (used if derivatives)
+    """
+    def flowStatistics(self, Ni, Mi, Dj, Nc2, derivatives):
+        N = Ni.sum(axis=1)
+        M = Mi.sum(axis=1)
+        CBar = N / M
+        dCBar = None
+        if derivatives:
+            h = np.divide(Ni, self.Ei, out=np.zeros_like(Ni), where=self.Ei != 0)
+            dN = (h * Ni).sum(axis=1) - Nc2
+            dM = (h * Mi).sum(axis=1) - N
+            dCBar = (dN - CBar * dM) / M
+        return FlowStatistics(CBar, dCBar, Mi, Dj)
+
+    ################################################################################
+
+    """
+    evaluateRows
+    Evaluate the origin rows r0 to r1 for evaluateFlows in blocks of blockRows,
+    filling in their entries of Ni and Mi (and of sink). The exp kernels are
+    taken from kernel if given, or else from the lookup table if given.
+    @returns Dj, Nc2 the column sums and the sum of Sij * cij^2 of these rows
+    """
+    def evaluateRows(self, r0, r1, mBeta, blockRows, sink, derivatives, Ni, Mi, useNumexpr=False, kernel=None, table=None):
+        n_modes = len(mBeta)
+        Dj = np.zeros((n_modes, self.n))
+        Nc2 = np.zeros(n_modes)
+        buffer = np.empty((n_modes, max(0, min(blockRows, r1 - r0)), self.n))
+        # the quantized costs (see setCostResolution) are reduced as integers and scaled afterwards
+        scale = 1.0 if self.costIndex is None else self.costResolution
+        for i0 in range(r0, r1, blockRows):
+            i1 = min(i0 + blockRows, r1)
+            cij = self.cij[:, i0:i1] if self.costIndex is None else self.costIndex[:, i0:i1]
+            Sij = buffer[:, :i1 - i0]
+            if kernel is not None:
+                np.multiply(kernel[:, i0:i1], self.Aj, out=Sij)
+            elif useNumexpr:
+                for k in range(n_modes):
+                    numexpr.evaluate('exp(c * b) * a', local_dict={'c': cij[k], 'b': mBeta[k], 'a': self.Aj}, out=Sij[k], casting='same_kind')
+            else:
+                self.kernelBlock(mBeta, table, i0, i1, Sij)
+                Sij *= self.Aj
+            denom = Sij.sum(axis=(0, 2))  # sum over modes and destinations j, for each origin i
+            Sij *= (self.Ei[i0:i1] / denom)[None, :, None]
+            Ni[:, i0:i1] = np.einsum('kij,kij->ki', Sij, cij) * scale
+            Mi[:, i0:i1] = Sij.sum(axis=2)
+            Dj += Sij.sum(axis=1)
+            if derivatives:
+                Nc2 += np.einsum('kij,kij,kij->k', Sij, cij, cij) * (scale * scale)
+            if sink is not None:
+                sink[:, i0:i1] = Sij
+        return Dj, Nc2
+
+    ################################################################################
+
+    """
+    computeSij
+    Compute the predicted flows for all modes (see evaluateFlows).
+    @param Beta Beta values, one per mode
+    @param out optional (n_modes, m, n) buffer (or memory mapped file) to write Sij into
+    @returns Sij as a (n_modes, m, n) array
+    """
+    def computeSij(self, Beta, out=None):
+        if out is None:
+            out = np.empty(self.cij.shape)
+        self.evaluateFlows(Beta, sink=out)
+        return out
+
+    ################################################################################
+
+    """
+    computeCalibrationStatistics
+    Compute Sij and the predicted mean trip cost CBarPred for every mode and,
+    if derivatives is True, the derivative of CBarPred[k] with respect to Beta[k]
+    (see evaluateFlows).
+    @param Beta Beta values, one per mode
+    @param out optional (n_modes, m, n) buffer for Sij
+    @returns Sij, CBarPred, dCBar (None if derivatives is False)
+    """
+    def computeCalibrationStatistics(self, Beta, out=None, derivatives=False):
+        if out is None:
+            out = np.empty(self.cij.shape)
+        stats = self.evaluateFlows(Beta, sink=out, derivatives=derivatives)
+        return out, stats.CBar, stats.dCBar
+
+    ################################################################################
+
+    """
+    flowResult
+    Evaluate the flows at Beta (see evaluateFlows) as a FlowResult
+    @param Beta Beta values, one per mode
+    @param out optional (n_modes, m, n) buffer (or memory mapped file) for Sij
+    @param materialize if False Sij is not computed now, only its statistics
+        (the FlowResult computes the rows when they are used)
+    @returns FlowResult
+    """
+    def flowResult(self, Beta, out=None, materialize=True):
+        kernel = self.exponentialKernel(Beta)  # shared by the runs at the same Betas and costs
+        if not materialize:
+            return FlowResult(self, Beta, None, self.evaluateFlows(Beta, kernel=kernel))
+        if out is None:
+            out = np.empty(self.cij.shape)
+        stats = self.evaluateFlows(Beta, sink=out, kernel=kernel)  # the marginals are accumulated block by block, Sij is not read back
+        return FlowResult(self, Beta, out, stats)
+
+    ################################################################################
+
     """
     run Model run3modes
-    Quant model for three modes of transport
-    @returns Sij predicted flows between i and j
+    Quant model for any number of modes of transport (three in the JtW model), with calibration
+    @param solver calibration solver name or object (default calibrationSolver in globals)
+    @param maxIterations, maxTime calibration budgets (default calibrationMaxIterations, calibrationMaxTime in globals)
+    @param store CalibrationStore to warm start from (default the one in globals if calibrationWarmStart, False for none)
+    @returns Sij predicted flows between i and j (FlowResult), Beta, CBarPred
     """
-    def run3modes(self):
+    def run3modes(self, solver=None, maxIterations=None, maxTime=None, store=None):
         # run model
         # i = employment zone
         # j = residential zone
@@ -151,142 +692,198 @@ class QUANTLHModel:
         # Note the use of 1,2,3 for modes in the files different from 0,1,2 in the code.
         # Returns predicted flows per mode: "SPred_1.bin", "SPred_2.bin", "SPred_3.bin"
 
-        # Initialisation of parameters
-        converged = False  # initialise convergence check param
-        n_modes = 3  # Number of modes
-        cij_k = [self.cij_0, self.cij_1, self.cij_2]  # list of cost matrices
-        SObs_k = [self.SObs_0, self.SObs_1, self.SObs_2]  # list of obs trips matrices
+        # Calibration with CBar values: find Beta so that the mean predicted trip cost
+        # (CBarPred) matches the mean observed trip cost (CBarObs) for every mode.
+        # The solver (multiplicative, newton, secant) and its budgets are set in globals.
+        # Calibration starts from the Betas of the closest previous run (or skips straight
+        # to the answer if the inputs are identical) unless warm starting is turned off.
+        if store is None:
+            store = CalibrationStore(calibrationStoreFilename, calibrationStoreMaxEntries) if calibrationWarmStart else False
+        result = calibrate(self, solver=solver, maxIterations=maxIterations, maxTime=maxTime, store=store or None, materialize=False)
+        self.calibrationResult = result  # iterations, time and convergence of the last calibration
+        Sij = self.flowResult(result.Beta)
+        result.Sij = Sij.Sij
+        Beta, CBarPred = result.Beta, result.CBarPred
+
+        return Sij, Beta, CBarPred  # Note that Sij[k] = Sij_k (Sij is a FlowResult) and CBarPred = [CBarPred_0, CBarPred_1, CBarPred_2]
 
-        # Set up Beta for modes 0, 1 and 2 to 1.0
-        Beta = np.ones(n_modes)
+    ################################################################################
 
-        # Compute sum of origins and destinations
+    """
+    evaluateScenarios
+    Evaluate several scenarios of jobs Ei and dwellings Aj at the same Betas
+    and costs in one pass over the shared kernels K[k,i,j] = exp(-Beta[k] * cij[k,i,j]).
+    The kernels are computed once per block of origin rows and the scenarios
+    are all applied to that block as matrix products (see BaseRun for P and Q):
+    P[s,k,i] = sum_j K[k,i,j] * Aj[s,j], Q[s,k,i] = sum_j K[k,i,j] * cij[k,i,j] * Aj[s,j],
+    w[s,i] = Ei[s,i] / sum_k P[s,k,i] and Sij[s,k,i,j] = w[s,i] * Aj[s,j] * K[k,i,j],
+    so an extra scenario costs a few matrix products rather than a model run.
+    @param Beta the Beta values, one per mode
+    @param Ei (n_scenarios, m) jobs per origin for each scenario
+    @param Aj (n_scenarios, n) dwellings per destination for each scenario
+    @param sinks optional list of (n_modes, m, n) arrays, one per scenario, to write Sij into
+    @param blockRows rows per block (default from memoryBudget, see blockRows)
+    @param memoryBudget bytes of working memory (default flowMemoryBudget in globals)
+    @returns list of FlowStatistics (without derivatives), one per scenario
+    """
+    def evaluateScenarios(self, Beta, Ei, Aj, sinks=None, blockRows=None, memoryBudget=None):
+        Ei = np.atleast_2d(np.asarray(Ei, dtype=float))
+        Aj = np.atleast_2d(np.asarray(Aj, dtype=float))
+        n_scenarios = len(Ei)
+        n_modes = self.n_modes
+        assert Ei.shape == (n_scenarios, self.m) and Aj.shape == (n_scenarios, self.n), "FATAL: evaluateScenarios Ei, Aj MUST have shapes (n_scenarios, m=" + str(self.m) + ") and (n_scenarios, n=" + str(self.n) + ")"
+        assert sinks is None or len(sinks) == n_scenarios, "FATAL: evaluateScenarios needs one sink per scenario"
+        blockRows = self.blockRows(memoryBudget) if blockRows is None else blockRows
+        mBeta = -np.asarray(Beta, dtype=float)
+        kernel = self.exponentialKernel(Beta)
+        table = self.exponentialTable(Beta) if kernel is None else None
+        P = np.zeros((n_scenarios, n_modes, self.m))
+        Q = np.zeros((n_scenarios, n_modes, self.m))
+        Dj = np.zeros((n_scenarios, n_modes, self.n))
+        for i0 in range(0, self.m, blockRows):
+            i1 = min(i0 + blockRows, self.m)
+            cij = self.cij[:, i0:i1]
+            if kernel is not None:
+                K = kernel[:, i0:i1]
+            else:
+                K = self.kernelBlock(mBeta, table, i0, i1, np.empty(cij.shape))
+            P[:, :, i0:i1] = np.matmul(K, Aj.T).transpose(2, 0, 1)
+            Q[:, :, i0:i1] = np.matmul(K * cij, Aj.T).transpose(2, 0, 1)
+            w = Ei[:, i0:i1] / P[:, :, i0:i1].sum(axis=1)  # (n_scenarios, rows)
+            Dj += np.matmul(w[:, None, None, :], K[None]).squeeze(2) * Aj[:, None, :]
+            if sinks is not None:
+                for s in range(n_scenarios):
+                    np.multiply(K, w[s][None, :, None], out=sinks[s][:, i0:i1])
+                    sinks[s][:, i0:i1] *= Aj[s]
+        w = Ei[:, None, :] / P.sum(axis=1, keepdims=True)
+        return [self.flowStatistics(w[s] * Q[s], w[s] * P[s], Dj[s], None, False) for s in range(n_scenarios)]
 
-        '''
-        # OiObs : vector with dimension = number of oringins
-        OiObs = np.zeros(self.n)
-        for k in range(n_modes):
-            OiObs += SObs_k[k].sum(axis=1)
-        '''
+    ################################################################################
 
-        # DjObs : vector with dimension = number of destinations
-        DjObs = [[] for i in range(n_modes)]
-        for k in range(n_modes):
-            DjObs[k] = np.zeros(self.n)
-        for k in range(n_modes):
-            DjObs[k] += SObs_k[k].sum(axis=1)
-
-        DjPred = [[] for i in range(n_modes)]
-        DjPredSum = np.zeros(n_modes)
-        DjObsSum = np.zeros(n_modes)
-        delta = np.zeros(n_modes)
-
-
-        # Convergence loop:
-        print("Calibrating the model...")
-        iteration = 0
-        while converged != True:
-            iteration += 1
-            print("Iteration: ", iteration)
-
-            # Initialise variables:
-            Sij = [[] for i in range(n_modes)]  # initialise Sij with a number of empty lists equal to n_modes
-
-            # hold copy of pre multiplied copies of -Beta_k * cij[k] for each mode
-            ExpMBetaCijk = [[] for k in range(n_modes)]
-            for kk in range(n_modes):
-                ExpMBetaCijk[kk] = np.exp(-Beta[kk] * cij_k[kk])
-
-            for k in range(n_modes):  # mode loop
-                Sij[k] = np.zeros(self.m * self.n).reshape(self.m, self.n)
-                for i in range(self.m):
-                    denom = 0
-                    for kk in range(n_modes):
-                        denom += np.sum(self.Aj * ExpMBetaCijk[kk][i, :])
-                    Sij2 = self.Ei[i] * (self.Aj * ExpMBetaCijk[k][i, :] / denom)
-                    Sij[k][i, :] = Sij2  # put answer slice back in return array
-
-            # Calibration with CBar values
-            # Calculate mean predicted trips and mean observed trips (this is CBar)
-            CBarPred = np.zeros(n_modes)
-            CBarObs = np.zeros(n_modes)
-            delta = np.ones(n_modes)
-            for k in range(n_modes):
-                CBarPred[k] = self.computeCBar(Sij[k], cij_k[k])
-                CBarObs[k] = self.computeCBar(SObs_k[k], cij_k[k])
-                delta[k] = np.absolute(CBarPred[k] - CBarObs[k])  # the aim is to minimise delta[0]+delta[1]+...
-            # delta check on all betas (Beta0, Beta1, Beta2) stopping condition for convergence
-            # double gradient descent search on Beta0 and Beta1 and Beta2
-            converged = True
-            for k in range(n_modes):
-                if (delta[k] / CBarObs[k] > 0.001):
-                    Beta[k] = Beta[k] * CBarPred[k] / CBarObs[k]
-                    converged = False
-            '''
-            # Calibration with Observed flows
-            for k in range(n_modes):
-                DjPred[k] = self.calculateDj(Sij[k])
-                DjPredSum[k] = np.sum(DjPred[k])
-                DjObsSum[k] = np.sum(DjObs[k])
-                delta[k] = DjPredSum[k] - DjObsSum[k]
-            # delta check on beta stopping condition for convergence
-            # gradient descent search on beta
-            converged = True
-            for k in range(n_modes):
-                if (delta[k] / DjObsSum[k] > 0.001):
-                    Beta[k] = Beta[k] * DjPredSum[k] / DjObsSum[k]
-                    converged = False
-            '''
-            CBarPred = np.zeros(n_modes)
-            # Calculate CBar
-            for k in range(n_modes):
-                CBarPred[k] = self.computeCBar(Sij[k], cij_k[k])
+    """
+    run Model run3modes_Scenarios
+    Like run3modes_NoCalibration for several scenarios of jobs Ei and dwellings
+    Aj at the same Betas and costs, sharing the kernels (see evaluateScenarios).
+    Without sinks only the statistics of the scenarios are computed, in row
+    blocks within flowMemoryBudget, and each FlowResult computes its own Sij
+    (n_modes * m * n float64) when it is first used, so the flows of a scenario
+    are only in memory while it is, not those of all the scenarios at once.
+    With sinks every scenario is written in the same pass, which costs
+    n_scenarios * n_modes * m * n float64 if they are in memory.
+    @param Beta calibrated Beta values, one per mode
+    @param Ei (n_scenarios, m) jobs, Aj (n_scenarios, n) dwellings
+    @param sinks optional list of (n_modes, m, n) arrays (or memory mapped files), one per scenario, for Sij
+    @returns Sij list of n_scenarios FlowResult predicted flows between i and j, CBarPred (n_scenarios, n_modes)
+    """
+    def run3modes_Scenarios(self, Beta, Ei, Aj, sinks=None):
+        Ei = np.atleast_2d(np.asarray(Ei, dtype=float))
+        Aj = np.atleast_2d(np.asarray(Aj, dtype=float))
+        n_scenarios = len(Ei)
+        print("Running model for ", self.n_modes, " modes and ", n_scenarios, " scenarios.")
+        stats = self.evaluateScenarios(Beta, Ei, Aj, sinks=sinks)
+        Sij = [FlowResult(self, Beta, None if sinks is None else sinks[s], stats[s], Ei[s], Aj[s]) for s in range(n_scenarios)]
+        CBarPred = np.array([st.CBar for st in stats])
+        return Sij, CBarPred
 
-            # Debug:
-            # commuter sum blocks
-            TotalSij_roads = Sij[0].sum()
-            TotalSij_bus = Sij[1].sum()
-            TotalSij_rail = Sij[2].sum()
-            TotalEi = self.Ei.sum()  # total jobs = pu+pr above
-            # print("i= {0:d} beta_roads={1:.6f} beta_bus={2:.6f} beta_rail={3:.6f} cbar_pred_roads={4:.1f} cbar_pred_busr={5:.1f} cbar_pred_rail={6:.1f}"
-            #         .format(iteration, Beta[0], Beta[1], Beta[2], CBarPred[0], CBarPred[1], CBarPred[2]))
-            # print("TotalSij_roads={0:.1f} TotalSij_bus={1:.1f} TotalSij_rail={2:.1f} Total={3:.1f} ({4:.1f})"
-            #       .format(TotalSij_roads, TotalSij_bus, TotalSij_rail, TotalSij_roads + TotalSij_bus + TotalSij_rail, TotalEi))
+    ################################################################################
 
-        return Sij, Beta, CBarPred  # Note that Sij = [Sij_k=0 , Sij_k=1, Sij_k=2] and CBarPred = [CBarPred_0, CBarPred_1, CBarPred_2]
+    """
+    setBaseRun
+    Cache the kernels of a base run (see BaseRun) for incremental updates with
+    updateFlows, e.g. the 2021 jobs and dwellings at the calibrated Betas.
+    @param Beta the Beta values, one per mode
+    @param out optional (n_modes, m, n) buffer (or memory mapped file) for K,
+        otherwise K comes from the kernel cache if it fits (see exponentialKernel)
+    """
+    def setBaseRun(self, Beta, out=None):
+        Beta = np.asarray(Beta, dtype=float)
+        K = self.exponentialKernel(Beta, force=True) if out is None else None
+        if K is None:
+            K = self.kernelBlock(-Beta, self.exponentialTable(Beta), 0, self.m, np.empty(self.cij.shape) if out is None else out)
+        Aj = np.array(self.Aj, dtype=float)
+        P = np.einsum('kij,j->ki', K, Aj)
+        Q = np.stack([np.einsum('ij,ij,j->i', K[k], self.cij[k], Aj) for k in range(self.n_modes)])  # one mode of costs at a time
+        self.baseRun = BaseRun(Beta, np.array(self.Ei, dtype=float), Aj, K, P, Q)
+
+    ################################################################################
+
+    """
+    updateFlows
+    Update the base run (see setBaseRun) for new jobs Ei and dwellings Aj that
+    differ from the base in only a few zones, without computing any exp kernel.
+    With the changed destinations J and dA = Aj - Aj(base), the row sums get a
+    rank len(J) correction:
+    P[k,i] += sum over j in J of K[k,i,j] * dA[j], and the same for Q with K * cij,
+    and the rows are then rescaled by w[i] = Ei[i] / D[i], so
+    Sij[k,i,j] = w[i] * Aj[j] * K[k,i,j], Oi = w * P and the CBar numerators are w * Q.
+    A change of Ei alone only rescales rows.
+    The model Ei and Aj are set to the new values. The base is unchanged, so
+    every update is relative to it.
+    @param Ei new jobs per origin (default the base Ei)
+    @param Aj new dwellings per destination (default the base Aj)
+    @param out optional (n_modes, m, n) buffer (or memory mapped file) to write Sij into
+    @param columnSums if True compute the column sums Dj (a pass over K, done
+        anyway when out is given), otherwise Dj is None
+    @returns FlowStatistics (without derivatives)
+    """
+    def updateFlows(self, Ei=None, Aj=None, out=None, columnSums=False):
+        base = self.baseRun
+        Ei = base.Ei if Ei is None else np.asarray(Ei, dtype=float)
+        Aj = base.Aj if Aj is None else np.asarray(Aj, dtype=float)
+        assert len(Ei) == self.m and len(Aj) == self.n, "FATAL: updateFlows Ei, Aj MUST have lengths m=" + str(self.m) + " and n=" + str(self.n)
+        P, Q = base.P, base.Q
+        J = np.flatnonzero(Aj != base.Aj)
+        if J.size > 0:
+            dA = Aj[J] - base.Aj[J]
+            KJ = base.K[:, :, J]
+            P = P + np.einsum('kij,j->ki', KJ, dA)
+            Q = Q + np.einsum('kij,kij,j->ki', KJ, self.cij[:, :, J], dA)
+        w = Ei / P.sum(axis=0)
+        self.Ei = Ei
+        self.Aj = Aj
+        Dj = None
+        if out is not None:
+            np.multiply(base.K, w[None, :, None], out=out)
+            out *= Aj
+            Dj = out.sum(axis=1)
+        elif columnSums:
+            Dj = Aj * np.einsum('kij,i->kj', base.K, w)
+        return self.flowStatistics(w * Q, w * P, Dj, None, False)
+
+    ################################################################################
+
+    """
+    run Model run3modes_Incremental
+    Like run3modes_NoCalibration at the Betas of the base run, for new jobs Ei
+    and dwellings Aj, using the kernels of the base run (see updateFlows)
+    @param Ei, Aj new jobs and dwellings (default the base ones)
+    @param out optional (n_modes, m, n) buffer for Sij
+    @returns Sij predicted flows between i and j (FlowResult), CBarPred
+    """
+    def run3modes_Incremental(self, Ei=None, Aj=None, out=None):
+        print("Running model for ", self.n_modes, " modes (incremental).")
+        if out is None:
+            out = np.empty(self.cij.shape)
+        stats = self.updateFlows(Ei, Aj, out=out)
+        return FlowResult(self, self.baseRun.Beta, out, stats), stats.CBar
 
     ################################################################################
 
     """
     run Model run3modes_NoCalibration
-    Quant model for three modes of transport without calibration
-    @returns Sij predicted flows between i and j
+    Quant model for any number of modes of transport (three in the JtW model) without calibration
+    @param Beta calibrated Beta values, one per mode
+    @param out optional (n_modes, m, n) buffer for Sij, e.g. a memory mapped file
+        from utils.openMatrixSink for zone systems too large for memory
+    @returns Sij predicted flows between i and j (FlowResult), CBarPred
     """
-    def run3modes_NoCalibration(self, Beta):
+    def run3modes_NoCalibration(self, Beta, out=None):
         n_modes = len(Beta)  # Number of modes
+        assert n_modes == self.n_modes, "FATAL: run3modes_NoCalibration len(Beta)=" + str(n_modes) + " MUST equal the number of modes=" + str(self.n_modes)
         print("Running model for ", n_modes, " modes.")
 
-        # Initialise variables:
-        Sij = [[] for i in range(n_modes)]  # initialise Sij with a number of empty lists equal to n_modes
-        cij_k = [self.cij_0, self.cij_1, self.cij_2]  # list of cost matrices
-
-        # hold copy of pre multiplied copies of -Beta_k * cij[k] for each mode
-        ExpMBetaCijk = [[] for k in range(n_modes)]
-        for kk in range(n_modes):
-            ExpMBetaCijk[kk] = np.exp(-Beta[kk] * cij_k[kk])
-
-        for k in range(n_modes):  # mode loop
-            Sij[k] = np.zeros(self.m * self.n).reshape(self.m, self.n)
-            for i in range(self.m):
-                denom = 0
-                for kk in range(n_modes):
-                    denom += np.sum(self.Aj * ExpMBetaCijk[kk][i, :])
-                Sij2 = self.Ei[i] * (self.Aj * ExpMBetaCijk[k][i, :] / denom)
-                Sij[k][i, :] = Sij2  # put answer slice back in return array
-
-        CBarPred = np.zeros(n_modes)  # initialise CBarPred
-        for k in range(n_modes):
-            CBarPred[k] = self.computeCBar(Sij[k], cij_k[k])
+        Sij = self.flowResult(Beta, out=out)
+        CBarPred = Sij.CBar
 
         return Sij, CBarPred
 
@@ -295,18 +892,29 @@ class QUANTLHModel:
     """
     computeProbabilities3modes
     Compute the probability of a flow from an MSOA zone to any (i.e. all) of the possible point zones
+    (for all the modes in Sij, despite the name): every row of Sij[k] divided by its sum.
+    @param Sij flows, a (n_modes, m, n) tensor or a list of (m, n) matrices
+    @param inplace if True overwrite Sij with the probabilities instead of allocating new matrices
+    @param lazy if True return a Probabilities object computing each mode on demand
+    @returns the probabilities, indexed by mode like Sij
     """
-    def computeProbabilities3modes(self, Sij):
+    def computeProbabilities3modes(self, Sij, inplace=False, lazy=False):
         print("Computing probabilities")
-        n_modes = 3
-        probSij = [[] for i in range(n_modes)]  # initialise Sij with a number of empty list equal to n_modes
-
+        n_modes = len(Sij)
+        rowsums = []
         for k in range(n_modes):
-            probSij[k] = np.arange(self.m * self.n, dtype=float).reshape(self.m, self.n)
-            for i in range(self.m):
-                sum = np.sum(Sij[k][i,])
-                if sum <= 0:
-                    sum = 1  # catch for divide by zero - just let the zero probs come through to the final matrix
-                probSij[k][i,] = Sij[k][i,] / sum
+            rowsum = np.sum(Sij[k], axis=1, keepdims=True)
+            rowsum[rowsum <= 0] = 1  # catch for divide by zero - just let the zero probs come through to the final matrix
+            rowsums.append(rowsum)
+        if lazy:
+            return Probabilities(Sij, rowsums)
+        if kernels.useNumba() and isinstance(Sij, np.ndarray) and Sij.ndim == 3:
+            return kernels.probabilitiesNumba(Sij, Sij if inplace else np.empty(Sij.shape))
+
+        if inplace:
+            for k in range(n_modes):
+                np.divide(Sij[k], rowsums[k], out=Sij[k])
+            return Sij
+        probSij = [Sij[k] / rowsums[k] for k in range(n_modes)]
 
         return probSij
\ No newline at end of file
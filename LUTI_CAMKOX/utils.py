@@ -4,45 +4,337 @@ utils.py
 Data building utilities
 """
 
+import hashlib
+import json
+import os
 import numpy as np
+import pandas as pd
 import pickle
 import struct
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+###############################################################################
+
+# Matrix store format written by saveMatrix:
+# 8 byte magic, 4 byte little endian header length, JSON header (dtype, shape
+# and metadata such as the zone list and source file hashes), padded so that
+# the C order array data starts on a 64 byte boundary.
+MATRIX_MAGIC = b'LUTIMAT1'
+MATRIX_ALIGN = 64
+
 ###############################################################################
 
 """
-Load a numpy matrix from a file
+readMatrixHeader
+Read the metadata header of a matrix written by saveMatrix.
+@param filename The matrix file
+@returns dict with dtype, shape, offset and metadata, or None if the file is
+    in the old pickle format
 """
-def loadMatrix(filename):
+def readMatrixHeader(filename):
     with open(filename,'rb') as f:
-        matrix = pickle.load(f)
-    return matrix
+        if f.read(len(MATRIX_MAGIC)) != MATRIX_MAGIC:
+            return None
+        (length,) = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(length).decode('utf-8'))
+    header['offset'] = len(MATRIX_MAGIC) + 4 + length
+    return header
+
+###############################################################################
+
+"""
+Load a numpy matrix from a file
+@param filename The matrix file written by saveMatrix
+@param mmap_mode None to read the matrix into memory, or a np.memmap mode
+    ('r', 'r+', 'c') to map it, so that processes can share the pages.
+    Files in the old pickle format are always read into memory.
+"""
+def loadMatrix(filename, mmap_mode=None):
+    header = readMatrixHeader(filename)
+    if header is None: # old pickle format
+        with open(filename,'rb') as f:
+            matrix = pickle.load(f)
+        return matrix
+    dtype = np.dtype(header['dtype'])
+    shape = tuple(header['shape'])
+    if mmap_mode is not None:
+        return np.memmap(filename, dtype=dtype, mode=mmap_mode, offset=header['offset'], shape=shape)
+    count = int(np.prod(shape))
+    matrix = np.fromfile(filename, dtype=dtype, count=count, offset=header['offset'])
+    assert matrix.size == count, "FATAL: loadMatrix " + filename + " is truncated"
+    return matrix.reshape(shape)
 
 ###############################################################################
 
 """
 Save a numpy matrix to a file
+The file is written to a temporary name first and then moved into place, so a
+reader never sees a partially written matrix.
+@param matrix The numpy array to save
+@param filename The matrix file
+@param zonesHash Optional hash of the zone list the matrix is defined on (see listHash)
+@param sourceHash Optional hash of the file the matrix was built from (see fileHash)
+@param metadata Any other JSON serialisable values to store in the header
 """
-def saveMatrix(matrix,filename):
+def saveMatrix(matrix,filename,zonesHash=None,sourceHash=None,**metadata):
+    matrix = np.ascontiguousarray(matrix)
+    header = dict(metadata)
+    header.update({'dtype': matrix.dtype.str, 'shape': list(matrix.shape),
+                   'zones_hash': zonesHash, 'source_hash': sourceHash})
+    data = json.dumps(header).encode('utf-8')
+    pad = -(len(MATRIX_MAGIC) + 4 + len(data)) % MATRIX_ALIGN
+    data += b' ' * pad
+    tmpname = filename + '.tmp' + str(os.getpid())
+    with open(tmpname,'wb') as f:
+        f.write(MATRIX_MAGIC)
+        f.write(struct.pack('<I', len(data)))
+        f.write(data)
+        matrix.tofile(f)
+    os.replace(tmpname, filename)
+
+###############################################################################
+
+"""
+openMatrixSink
+Create a matrix file in the saveMatrix format and map it for writing, so a
+large matrix can be filled block by block (e.g. the Sij blocks written by
+QUANTLHModel.evaluateFlows) without ever being held in memory. The file can be
+read back with loadMatrix. Unlike saveMatrix the file is written in place.
+@param filename The matrix file
+@param shape The shape of the matrix
+@param dtype The dtype of the matrix (float64 by default)
+@param metadata Any other JSON serialisable values to store in the header
+@returns a np.memmap in 'r+' mode
+"""
+def openMatrixSink(filename, shape, dtype=float, **metadata):
+    dtype = np.dtype(dtype)
+    header = dict(metadata)
+    header.update({'dtype': dtype.str, 'shape': list(shape), 'zones_hash': None, 'source_hash': None})
+    data = json.dumps(header).encode('utf-8')
+    pad = -(len(MATRIX_MAGIC) + 4 + len(data)) % MATRIX_ALIGN
+    data += b' ' * pad
+    offset = len(MATRIX_MAGIC) + 4 + len(data)
     with open(filename,'wb') as f:
-        pickle.dump(matrix,f)
+        f.write(MATRIX_MAGIC)
+        f.write(struct.pack('<I', len(data)))
+        f.write(data)
+        f.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+    return np.memmap(filename, dtype=dtype, mode='r+', offset=offset, shape=tuple(shape))
+
+###############################################################################
+
+# Output matrices (e.g. the flows and probabilities in config outputs) are
+# written and read in the format given by the extension of their file name:
+# .npy binary numpy (the default, about 3x smaller than CSV and read back as a
+# memory map), .parquet one float column per destination (needs pyarrow) or
+# .csv comma separated text as written by np.savetxt (export only, it is slow).
+
+def saveOutputCSV(matrix, filename):
+    np.savetxt(filename, matrix, delimiter=",")
+
+def saveOutputNPY(matrix, filename):
+    np.save(filename, np.asarray(matrix))
+
+def saveOutputParquet(matrix, filename):
+    assert pyarrow is not None, "FATAL: saveOutputMatrix " + filename + " needs pyarrow to write parquet files, pip install pyarrow or use .npy"
+    matrix = np.asarray(matrix)
+    table = pyarrow.table({str(j): matrix[:, j] for j in range(matrix.shape[1])})
+    pyarrow.parquet.write_table(table, filename)
+
+def loadOutputCSV(filename, mmap=False):
+    return pd.read_csv(filename, header=None).to_numpy()
+
+def loadOutputNPY(filename, mmap=False):
+    return np.load(filename, mmap_mode='r' if mmap else None)
+
+def loadOutputParquet(filename, mmap=False):
+    assert pyarrow is not None, "FATAL: loadOutputMatrix " + filename + " needs pyarrow to read parquet files, pip install pyarrow"
+    table = pyarrow.parquet.read_table(filename, memory_map=mmap)
+    return np.column_stack([column.to_numpy() for column in table.columns])
+
+outputWriters = {'.csv': saveOutputCSV, '.npy': saveOutputNPY, '.parquet': saveOutputParquet}
+outputReaders = {'.csv': loadOutputCSV, '.npy': loadOutputNPY, '.parquet': loadOutputParquet}
+
+"""
+saveOutputMatrix
+Save an output matrix in the format given by the extension of filename (see above)
+@param matrix The matrix to save, e.g. Tij[k]
+@param filename The output file, e.g. outputs["JobsTijRoads2021"]
+"""
+def saveOutputMatrix(matrix, filename):
+    extension = os.path.splitext(filename)[1].lower()
+    assert extension in outputWriters, "FATAL: saveOutputMatrix unknown output format " + extension + " of " + filename + ", use one of " + str(list(outputWriters))
+    outputWriters[extension](matrix, filename)
+
+"""
+loadOutputMatrix
+Load an output matrix written by saveOutputMatrix
+@param filename The output file
+@param mmap If True memory map the file if the format allows it (.npy, .parquet)
+@returns the matrix as a numpy array
+"""
+def loadOutputMatrix(filename, mmap=False):
+    extension = os.path.splitext(filename)[1].lower()
+    assert extension in outputReaders, "FATAL: loadOutputMatrix unknown output format " + extension + " of " + filename + ", use one of " + str(list(outputReaders))
+    return outputReaders[extension](filename, mmap)
+
+###############################################################################
+
+"""
+fileHash
+SHA-1 of the contents of a file, read in blocks so large QUANT matrices are
+never held in memory.
+"""
+def fileHash(filename, blocksize=1<<24):
+    h = hashlib.sha1()
+    with open(filename,'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+###############################################################################
+
+"""
+QuantizedCosts
+A cost tensor stored as integer multiples of a resolution (see
+QUANTLHModel.setCostResolution). It is indexed like the float64 tensor it
+replaces, each slice computed as index[key] * resolution, so the costs of a
+block of rows are only in float64 while that block is used.
+@param index integer (n_modes, m, n) array, the costs divided by resolution
+@param resolution the cost resolution
+"""
+class QuantizedCosts:
+    def __init__(self, index, resolution):
+        self.index = index
+        self.resolution = resolution
+        self.shape = index.shape
+        self.ndim = index.ndim
+        self.dtype = np.dtype(float)
+        self.nbytes = index.nbytes
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        return self.index[key] * self.resolution
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.index * self.resolution, dtype=dtype)
+
+###############################################################################
+
+"""
+arrayHash
+SHA-1 of the dtype, shape and contents of a numpy array. QuantizedCosts are
+hashed from their index and resolution, without the float64 costs.
+"""
+def arrayHash(array):
+    if isinstance(array, QuantizedCosts):
+        return hashlib.sha1((arrayHash(array.index) + repr(float(array.resolution))).encode('utf-8')).hexdigest()
+    array = np.ascontiguousarray(array)
+    h = hashlib.sha1()
+    h.update(array.dtype.str.encode('utf-8'))
+    h.update(str(array.shape).encode('utf-8'))
+    h.update(array.data)
+    return h.hexdigest()
+
+###############################################################################
+
+"""
+listHash
+SHA-1 of a list of values (e.g. zone codes), order sensitive.
+"""
+def listHash(values):
+    h = hashlib.sha1()
+    for v in values:
+        h.update(str(v).encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+###############################################################################
+
+"""
+readQUANTHeader
+Read the 8 byte header of a QUANT format matrix.
+@param filename The QUANT .bin file
+@returns (m,n) the row and column count of the matrix
+"""
+def readQUANTHeader(filename):
+    with open(filename,'rb') as f:
+        (m,n) = struct.unpack('ii', f.read(8))
+    return m, n
 
 ###############################################################################
 
 """
 Load a QUANT format matrix into python.
 A QUANT matrix stores the row count (m), column count (n) and then m x n IEEE754 floats (4 byte) of data
+The payload is read in a single call straight into a float32 array, rather than
+row by row through struct.
+@param filename The QUANT .bin file
+@param dtype The dtype of the returned matrix. The default (float) upcasts to
+    float64 as before, np.float32 keeps the data as stored in the file.
+@param mmap If True, memory map the payload instead of reading it. With
+    dtype=np.float32 this returns a read only np.memmap and no data is copied.
 """
-def loadQUANTMatrix(filename):
-    with open(filename,'rb') as f:
-        (m,) = struct.unpack('i', f.read(4))
-        (n,) = struct.unpack('i', f.read(4))
-        print("loadQUANTMatrix::m=",m,"n=",n)
-        matrix = np.arange(m*n,dtype=float).reshape(m, n) #and hopefully m===n, but I'm not relying on it
-        for i in range(0,m):
-            data = struct.unpack('{0}f'.format(n), f.read(4*n)) #read a row back from the stream - data=list of floats
-            for j in range(0,n):
-                matrix[i,j] = data[j]
+def loadQUANTMatrix(filename, dtype=float, mmap=False):
+    m, n = readQUANTHeader(filename)
+    print("loadQUANTMatrix::m=",m,"n=",n)
+    if mmap:
+        matrix = np.memmap(filename, dtype=np.float32, mode='r', offset=8, shape=(m, n))
+    else:
+        matrix = np.fromfile(filename, dtype=np.float32, count=m*n, offset=8)
+        assert matrix.size == m*n, "FATAL: loadQUANTMatrix " + filename + " is truncated, expected " + str(m*n) + " floats, found " + str(matrix.size)
+        matrix = matrix.reshape(m, n) #and hopefully m===n, but I'm not relying on it
+    if np.dtype(dtype) != np.float32:
+        matrix = matrix.astype(dtype)
     return matrix
 
 ###############################################################################
 
+"""
+loadQUANTSubMatrix
+Load only the rows and columns of a QUANT format matrix for a subset of zones,
+without reading the full national matrix into memory. The file is memory
+mapped and the required rows are gathered in file order (so the reads are
+sequential), then the columns are selected from those rows only.
+@param filename The QUANT .bin file
+@param rows Zone indices (row numbers in the QUANT matrix) to extract
+@param cols Zone indices for the columns, defaults to rows
+@param dtype The dtype of the returned matrix (float64 by default)
+@returns a len(rows) x len(cols) matrix in the order given by rows and cols
+"""
+def loadQUANTSubMatrix(filename, rows, cols=None, dtype=float):
+    m, n = readQUANTHeader(filename)
+    print("loadQUANTSubMatrix::m=",m,"n=",n)
+    rows = np.asarray(rows, dtype=np.intp)
+    cols = rows if cols is None else np.asarray(cols, dtype=np.intp)
+    assert rows.size == 0 or (rows.min() >= 0 and rows.max() < m), "FATAL: loadQUANTSubMatrix row index out of range for m=" + str(m)
+    assert cols.size == 0 or (cols.min() >= 0 and cols.max() < n), "FATAL: loadQUANTSubMatrix column index out of range for n=" + str(n)
+    matrix = np.memmap(filename, dtype=np.float32, mode='r', offset=8, shape=(m, n))
+    order = np.argsort(rows, kind='stable')
+    sub = np.empty((rows.size, cols.size), dtype=dtype)
+    sub[order] = matrix[rows[order]][:, cols]
+    del matrix
+    return sub
+
+###############################################################################
+
+"""
+zoneIndices
+Convert a list of zone codes into their positions in a reference list of
+zone codes, e.g. the positions of the CAMKOX MSOAs in the EWS zone codes.
+@param zonecodes The reference list of zone codes (e.g. zonecodes_EWS_list)
+@param codes The zone codes to look up
+@returns numpy array of indices into zonecodes
+"""
+def zoneIndices(zonecodes, codes):
+    lookup = {code: i for i, code in enumerate(zonecodes)}
+    missing = [code for code in codes if code not in lookup]
+    assert len(missing) == 0, "FATAL: zoneIndices zone codes not found: " + str(missing[:10])
+    return np.array([lookup[code] for code in codes], dtype=np.intp)
+
+###############################################################################
@@ -39,12 +39,12 @@ outputs["JobsAccessibility2021"]            = "./Outputs-CAMKOX_LON/jobs_accessi
 outputs["HousingAccessibility2021"]         = "./Outputs-CAMKOX_LON/housing_accessibility_2021.csv"
 outputs["JobsDjOi2021"]                     = "./Outputs-CAMKOX_LON/Jobs_DjOi_2021.csv"
 
-outputs["JobsProbTijRoads2021"]             = "./Outputs-CAMKOX_LON/jobsProbTij_roads_2021.csv"
-outputs["JobsProbTijBus2021"]               = "./Outputs-CAMKOX_LON/jobsProbTij_bus_2021.csv"
-outputs["JobsProbTijRail2021"]              = "./Outputs-CAMKOX_LON/jobsProbTij_rail_2021.csv"
-outputs["JobsTijRoads2021"]                 = "./Outputs-CAMKOX_LON/jobsTij_roads_2021.csv"
-outputs["JobsTijBus2021"]                   = "./Outputs-CAMKOX_LON/jobsTij_bus_2021.csv"
-outputs["JobsTijRail2021"]                  = "./Outputs-CAMKOX_LON/jobsTij_rail_2021.csv"
+outputs["JobsProbTijRoads2021"]             = "./Outputs-CAMKOX_LON/jobsProbTij_roads_2021.npy"
+outputs["JobsProbTijBus2021"]               = "./Outputs-CAMKOX_LON/jobsProbTij_bus_2021.npy"
+outputs["JobsProbTijRail2021"]              = "./Outputs-CAMKOX_LON/jobsProbTij_rail_2021.npy"
+outputs["JobsTijRoads2021"]                 = "./Outputs-CAMKOX_LON/jobsTij_roads_2021.npy"
+outputs["JobsTijBus2021"]                   = "./Outputs-CAMKOX_LON/jobsTij_bus_2021.npy"
+outputs["JobsTijRail2021"]                  = "./Outputs-CAMKOX_LON/jobsTij_rail_2021.npy"
 outputs["ArrowsFlowsCar2021"]               = "./Outputs-CAMKOX_LON/flows_2021_car.geojson"
 outputs["ArrowsFlowsBus2021"]               = "./Outputs-CAMKOX_LON/flows_2021_bus.geojson"
 outputs["ArrowsFlowsRail2021"]              = "./Outputs-CAMKOX_LON/flows_2021_rail.geojson"
@@ -53,12 +53,12 @@ outputs["JobsAccessibility2050"]            = "./Outputs-CAMKOX_LON/jobs_accessi
 outputs["HousingAccessibility2050"]         = "./Outputs-CAMKOX_LON/housing_accessibility_2050.csv"
 outputs["JobsDjOi2050"]                     = "./Outputs-CAMKOX_LON/Jobs_DjOi_2050.csv"
 
-outputs["JobsProbTijRoads2050"]             = "./Outputs-CAMKOX_LON/jobsProbTij_roads_2050.csv"
-outputs["JobsProbTijBus2050"]               = "./Outputs-CAMKOX_LON/jobsProbTij_bus_2050.csv"
-outputs["JobsProbTijRail2050"]              = "./Outputs-CAMKOX_LON/jobsProbTij_rail_2050.csv"
-outputs["JobsTijRoads2050"]                 = "./Outputs-CAMKOX_LON/jobsTij_roads_2050.csv"
-outputs["JobsTijBus2050"]                   = "./Outputs-CAMKOX_LON/jobsTij_bus_2050.csv"
-outputs["JobsTijRail2050"]                  = "./Outputs-CAMKOX_LON/jobsTij_rail_2050.csv"
+outputs["JobsProbTijRoads2050"]             = "./Outputs-CAMKOX_LON/jobsProbTij_roads_2050.npy"
+outputs["JobsProbTijBus2050"]               = "./Outputs-CAMKOX_LON/jobsProbTij_bus_2050.npy"
+outputs["JobsProbTijRail2050"]              = "./Outputs-CAMKOX_LON/jobsProbTij_rail_2050.npy"
+outputs["JobsTijRoads2050"]                 = "./Outputs-CAMKOX_LON/jobsTij_roads_2050.npy"
+outputs["JobsTijBus2050"]                   = "./Outputs-CAMKOX_LON/jobsTij_bus_2050.npy"
+outputs["JobsTijRail2050"]                  = "./Outputs-CAMKOX_LON/jobsTij_rail_2050.npy"
 outputs["ArrowsFlowsCar2050"]               = "./Outputs-CAMKOX_LON/flows_2050_car.geojson"
 outputs["ArrowsFlowsBus2050"]               = "./Outputs-CAMKOX_LON/flows_2050_bus.geojson"
 outputs["ArrowsFlowsRail2050"]              = "./Outputs-CAMKOX_LON/flows_2050_rail.geojson"
@@ -67,12 +67,12 @@ outputs["NS_JobsAccessibility2050"]            = "./Outputs-CAMKOX_LON/jobs_acce
 outputs["NS_HousingAccessibility2050"]         = "./Outputs-CAMKOX_LON/housing_accessibility_NS_2050.csv"
 outputs["NS_JobsDjOi2050"]                     = "./Outputs-CAMKOX_LON/Jobs_DjOi_NS_2050.csv"
 
-outputs["NS_JobsProbTijRoads2050"]             = "./Outputs-CAMKOX_LON/NS_jobsProbTij_roads_2050.csv"
-outputs["NS_JobsProbTijBus2050"]               = "./Outputs-CAMKOX_LON/NS_jobsProbTij_bus_2050.csv"
-outputs["NS_JobsProbTijRail2050"]              = "./Outputs-CAMKOX_LON/NS_jobsProbTij_rail_2050.csv"
-outputs["NS_JobsTijRoads2050"]                 = "./Outputs-CAMKOX_LON/NS_jobsTij_roads_2050.csv"
-outputs["NS_JobsTijBus2050"]                   = "./Outputs-CAMKOX_LON/NS_jobsTij_bus_2050.csv"
-outputs["NS_JobsTijRail2050"]                  = "./Outputs-CAMKOX_LON/NS_jobsTij_rail_2050.csv"
+outputs["NS_JobsProbTijRoads2050"]             = "./Outputs-CAMKOX_LON/NS_jobsProbTij_roads_2050.npy"
+outputs["NS_JobsProbTijBus2050"]               = "./Outputs-CAMKOX_LON/NS_jobsProbTij_bus_2050.npy"
+outputs["NS_JobsProbTijRail2050"]              = "./Outputs-CAMKOX_LON/NS_jobsProbTij_rail_2050.npy"
+outputs["NS_JobsTijRoads2050"]                 = "./Outputs-CAMKOX_LON/NS_jobsTij_roads_2050.npy"
+outputs["NS_JobsTijBus2050"]                   = "./Outputs-CAMKOX_LON/NS_jobsTij_bus_2050.npy"
+outputs["NS_JobsTijRail2050"]                  = "./Outputs-CAMKOX_LON/NS_jobsTij_rail_2050.npy"
 outputs["NS_ArrowsFlowsCar2050"]               = "./Outputs-CAMKOX_LON/NS_flows_2050_car.geojson"
 outputs["NS_ArrowsFlowsBus2050"]               = "./Outputs-CAMKOX_LON/NS_flows_2050_bus.geojson"
 outputs["NS_ArrowsFlowsRail2050"]              = "./Outputs-CAMKOX_LON/NS_flows_2050_rail.geojson"